@@ -0,0 +1,358 @@
+import asyncio
+import functools
+import weakref
+from urllib.parse import urlsplit
+import aiohttp
+import http_client
+import rate_limit
+import metadata_cache
+import metrics
+import fetch_paintings
+import generate_dzi as dzi_generator
+import download_images
+import deepzoom
+import manifest
+from site_urls import token_urls, list_urls, detail_urls, paint_urls, gv_urls
+
+################################################################
+## asyncio api
+################################################################
+
+# async counterparts of fetch_page, fetch_detail, generate_dzi_file and
+# download_image for embedding the scripts in an event loop
+# they share the parsing, decryption, rate limiting, caches and metrics of the
+# blocking functions, and reuse http_client.settings for retries, backoff,
+# timeouts and url_map
+settings = {
+    # maximum number of requests in flight on one event loop
+    'concurrency': 100,
+    # maximum number of dezoomify-rs processes running at once
+    'max_processes': 2,
+}
+
+_sessions = weakref.WeakKeyDictionary() # event loop -> aiohttp session
+_request_slots = weakref.WeakKeyDictionary() # event loop -> semaphore
+_process_slots = weakref.WeakKeyDictionary()
+
+def configure(**kwargs):
+    for key in kwargs:
+        if not key in settings:
+            raise ValueError(f'Unknown async api setting: {key}')
+    settings.update(kwargs)
+    _request_slots.clear()
+    _process_slots.clear()
+
+# the session of the running event loop, created on first use
+def get_session():
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=settings['concurrency'])
+        session = aiohttp.ClientSession(connector=connector, headers={'Connection': 'keep-alive'})
+        _sessions[loop] = session
+    return session
+
+# close the session of the running event loop
+async def close():
+    session = _sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None: await session.close()
+
+def get_slots(slots, size):
+    loop = asyncio.get_running_loop()
+    if not loop in slots: slots[loop] = asyncio.Semaphore(size)
+    return slots[loop]
+
+def get_timeout(url):
+    connect, read = http_client.get_timeout(url)
+    return aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+
+# response with the body already read, mirroring the attributes of requests
+class Response:
+    def __init__(self, url, status_code, headers, content, encoding):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding or 'utf-8'
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, errors='replace')
+
+# send a request, retrying connection errors and the statuses in
+# http_client.settings['status_forcelist'] with backoff
+# at most settings['concurrency'] requests are in flight, further requests
+# wait for a slot
+async def request(method, url, **kwargs):
+    url = http_client.map_url(url)
+    host = urlsplit(url).hostname
+    kwargs.setdefault('timeout', get_timeout(url))
+    retries = http_client.settings['retries']
+    for attempt in range(retries + 1):
+        await rate_limit.acquire_async(url)
+        try:
+            async with get_slots(_request_slots, settings['concurrency']):
+                with metrics.span('http', host, method=method, url=url):
+                    async with get_session().request(method, url, **kwargs) as res:
+                        content = await res.read()
+                        response = Response(url, res.status, res.headers, content, res.charset)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            metrics.count('failures', site=host)
+            if attempt == retries: raise
+            metrics.count('retries', site=host)
+            await asyncio.sleep(http_client.get_backoff_time(attempt))
+            continue
+        metrics.count('requests', site=host)
+        metrics.count('bytes', len(content), site=host)
+        rate_limit.update(url, response.status_code, response.headers.get('Retry-After'))
+        if not response.status_code in http_client.settings['status_forcelist'] or attempt == retries: break
+        metrics.count('retries', site=host)
+        await asyncio.sleep(http_client.get_backoff_time(attempt))
+    if response.status_code >= 400: metrics.count('failures', site=host)
+    return response
+
+async def get(url, **kwargs):
+    return await request('GET', url, **kwargs)
+
+async def post(url, **kwargs):
+    return await request('POST', url, **kwargs)
+
+async def get_text_from_url(url, method='GET', **kwargs):
+    res = await request(method, url, **kwargs)
+    if res.status_code != 200:
+        raise ValueError(f'Encountered error when visiting {url}: {res.status_code}')
+    return res.text
+
+# run `function` on every item with at most `limit` calls pending
+# items are taken from the iterable only when a slot is free, so that long or
+# unbounded iterables are consumed lazily; results are yielded as
+# (item, result or exception) in completion order
+# pending calls are cancelled if the consumer stops or is cancelled
+async def map_bounded(function, items, limit):
+    items = iter(items)
+    pending = {}
+    try:
+        while True:
+            while len(pending) < limit:
+                item = next(items, StopIteration)
+                if item is StopIteration: break
+                pending[asyncio.ensure_future(function(item))] = item
+            if len(pending) == 0: return
+
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                item = pending.pop(task)
+                if task.cancelled(): continue
+                error = task.exception()
+                yield item, error if error is not None else task.result()
+    finally:
+        for task in pending: task.cancel()
+        if len(pending) > 0: await asyncio.gather(*pending, return_exceptions=True)
+
+################################################################
+## catalog
+################################################################
+
+async def get_xsrf_token():
+    url = token_urls['mhj']
+    res = await get(url)
+    return fetch_paintings.parse_xsrf_token(res.headers.get('Set-Cookie', ''), url)
+
+# fetch a listing page, the xsrf token is fetched first if not given (mhj)
+async def fetch_page(website, page, xsrf_token=None):
+    if website == 'mhj':
+        if xsrf_token is None: xsrf_token = await get_xsrf_token()
+        url = list_urls['mhj'].format(page=page)
+        headers = {
+            'Cookie': f'XSRF-TOKEN={xsrf_token}',
+            'X-XSRF-TOKEN': xsrf_token
+        }
+        return fetch_paintings.parse_page_mhj(await get_text_from_url(url, 'POST', headers=headers))
+    elif website == 'collection':
+        url = list_urls['collection'].format(page=page)
+        return fetch_paintings.parse_page_collection(await get_text_from_url(url, 'POST'))
+    elif website == 'digicol':
+        url = list_urls['digicol']
+        data = {
+            'page': page,
+            'size': fetch_paintings.digicol_page_size,
+            'cateList': fetch_paintings.digicol_category
+        }
+        return fetch_paintings.parse_page_digicol(await get_text_from_url(url, 'POST', data=data))
+    else:
+        raise ValueError(f'Unknown website: {website}')
+
+# fetch listing pages with up to `concurrency` pages in flight until an empty
+# page is seen, and return the paintings in page order
+async def fetch_pages(website, start_page=1, concurrency=8):
+    xsrf_token = await get_xsrf_token() if website == 'mhj' else None
+    results = {}
+    end_page = None
+
+    def pages():
+        page = start_page
+        while end_page is None:
+            yield page
+            page += 1
+
+    async def fetch(page):
+        return await fetch_page(website, page, xsrf_token)
+
+    async for page, paintings in map_bounded(fetch, pages(), concurrency):
+        if isinstance(paintings, Exception): raise paintings
+        if len(paintings) == 0:
+            if end_page is None or page < end_page: end_page = page
+        else:
+            results[page] = paintings
+
+    paintings = []
+    for page in sorted(results):
+        if page < end_page: paintings += results[page]
+    return paintings
+
+# fetch the raw details of a painting, see normalize.normalize_details()
+async def fetch_detail(website, paint_id):
+    if not website in detail_urls:
+        raise ValueError(f'Unknown website: {website}')
+    url = detail_urls[website].format(paint_id=paint_id)
+    if website == 'mhj':
+        return fetch_paintings.parse_detail_mhj(paint_id, await get_text_from_url(url))
+    elif website == 'collection':
+        return fetch_paintings.parse_detail_collection(paint_id, await get_text_from_url(url))
+    else:
+        return fetch_paintings.parse_detail_digicol(paint_id, await get_text_from_url(url))
+
+################################################################
+## dzi files
+################################################################
+
+async def get_encrypted_text(url):
+    return dzi_generator.parse_encrypted_text(url, await get_text_from_url(url))
+
+async def get_dzi_infos_mhj(paint_id, info):
+    paint_url = paint_urls['mhj'].format(paint_id=paint_id)
+    paint_detail_urls = dzi_generator.get_leaf_urls_mhj(paint_url, await get_text_from_url(paint_url))
+    key, iv, xmlns, overlap = dzi_generator.get_keys_mhj(info)
+    encrypted_texts = await asyncio.gather(*[get_encrypted_text(url) for url in paint_detail_urls])
+    return [dzi_generator.make_dzi_info(dzi_generator.decrypt(encrypted, key, iv), xmlns, overlap) for encrypted in encrypted_texts]
+
+async def get_dzi_infos_collection(paint_id, info=None):
+    url = paint_urls['collection'].format(paint_id=paint_id)
+    tilegenerator_urls = dzi_generator.get_tilegenerator_urls(await get_text_from_url(url))
+
+    async def fetch_descriptor(tilegenerator_url):
+        html_string = await get_text_from_url(tilegenerator_url)
+        if 'bigimg' in tilegenerator_url: return dzi_generator.parse_dzi_info_bigimg(tilegenerator_url, html_string)
+        return dzi_generator.parse_tilegenerator(tilegenerator_url, html_string)
+
+    return list(await asyncio.gather(*[fetch_descriptor(url) for url in tilegenerator_urls]))
+
+async def get_dzi_infos_digicol(paint_id, info):
+    paint_url = paint_urls['digicol'].format(paint_id=paint_id)
+    paint_detail_urls = dzi_generator.get_image_urls_digicol(await get_text_from_url(paint_url))
+    key, iv = dzi_generator.get_keys_digicol(info)
+    encrypted_texts = await asyncio.gather(*[get_encrypted_text(url) for url in paint_detail_urls])
+    return [dzi_generator.make_dzi_info(dzi_generator.decrypt(encrypted, key, iv), dzi_generator.xmlns_digicol, '1') for encrypted in encrypted_texts]
+
+# gv info of a website (from the metadata cache when possible)
+async def get_info(website):
+    return await asyncio.to_thread(dzi_generator.get_info, website)
+
+# generate the dzi files of a painting and return their paths
+# as get_cached_dzi_infos(), the dzi info is cached and the key material is
+# fetched again once if decryption fails
+async def generate_dzi(website, paint_id, info=None):
+    get_dzi_infos = {
+        'mhj': get_dzi_infos_mhj,
+        'collection': get_dzi_infos_collection,
+        'digicol': get_dzi_infos_digicol,
+    }
+    if not website in get_dzi_infos:
+        raise ValueError(f'Unknown website {website}')
+
+    key = f'dzi:{website}:{paint_id}'
+    dzi_infos = await asyncio.to_thread(metadata_cache.get, key)
+    if dzi_infos is not None:
+        metrics.count('metadata_cache_hits', site=website)
+    else:
+        info = dzi_generator.get_current_info(website, info)
+        if info is None: info = await get_info(website)
+        try:
+            with metrics.span('dzi_info', website):
+                dzi_infos = await get_dzi_infos[website](paint_id, info)
+        except dzi_generator.DecryptionError:
+            metrics.count('decryption_failures', site=website)
+            info = await asyncio.to_thread(dzi_generator.refresh_info, website, info, functools.partial(dzi_generator.get_info, website), gv_urls[website])
+            dzi_infos = await get_dzi_infos[website](paint_id, info)
+        if len(dzi_infos) > 0: await asyncio.to_thread(metadata_cache.put, key, dzi_infos)
+
+    return await asyncio.to_thread(dzi_generator.write_dzi_files, paint_id, dzi_infos)
+
+################################################################
+## downloads
+################################################################
+
+# run dezoomify-rs, the process is killed if the task is cancelled
+async def run_dezoomify(command):
+    async with get_slots(_process_slots, settings['max_processes']):
+        process = await asyncio.create_subprocess_exec(*command)
+        try:
+            return await process.wait()
+        except asyncio.CancelledError:
+            process.kill()
+            await process.wait()
+            raise
+
+# download a painting, generating its dzi files first if needed
+# `backend` is either 'dezoomify' (dezoomify-rs) or 'native' (deepzoom.py,
+# through the global tile queue); `sizes` is handled as in download_images.download_dzi_files()
+# the steps are those of download_images.get_download_steps(); blocking work
+# (manifest, stitching, waiting for the tile queue) runs in threads
+async def download(website, paint_id, info=None, download_largest=True, backend='dezoomify', sizes=None):
+    dzi_files = await asyncio.to_thread(download_images.get_existing_dzi_files, paint_id)
+    if len(dzi_files) == 0:
+        dzi_files = await generate_dzi(website, paint_id, info)
+
+    steps = await asyncio.to_thread(download_images.get_download_steps, dzi_files, download_largest, backend, sizes)
+    failed_files = []
+    jobs = []
+    try:
+        for step, dzi_file, target in steps:
+            if step == 'export':
+                written_files = await asyncio.to_thread(deepzoom.export_dzi, dzi_file, target)
+                await asyncio.to_thread(download_images.record_outputs, written_files)
+            elif step == 'native':
+                paint_file, level, streaming = target
+                job = await asyncio.to_thread(deepzoom.get_tile_queue().submit, dzi_file, paint_file, level=level, streaming=streaming)
+                jobs.append((dzi_file, paint_file, job))
+            else:
+                paint_file, command = target
+                with metrics.span('dezoomify', file=paint_file):
+                    returncode = await run_dezoomify(command)
+                if returncode != 0:
+                    metrics.count('failures')
+                    failed_files.append(dzi_file)
+                else:
+                    await asyncio.to_thread(manifest.put_output, paint_file)
+
+        failed_files += await asyncio.to_thread(download_images.wait_jobs, jobs)
+    except asyncio.CancelledError:
+        # stop the leaves already queued
+        for _, _, job in jobs: job.cancel()
+        raise
+    except Exception:
+        # the leaves already queued are finished and recorded before giving up
+        await asyncio.to_thread(download_images.wait_jobs, jobs)
+        raise
+    download_images.raise_failures(failed_files)
+
+# download many paintings with at most `concurrency` paintings in progress,
+# yielding (paint_id, None or exception) as each one finishes
+async def download_many(website, paint_ids, concurrency=8, download_largest=True, backend='dezoomify', sizes=None):
+    info = await get_info(website)
+
+    async def download_painting(paint_id):
+        return await download(website, paint_id, info, download_largest=download_largest, backend=backend, sizes=sizes)
+
+    async for paint_id, result in map_bounded(download_painting, paint_ids, concurrency):
+        yield paint_id, result
@@ -0,0 +1,275 @@
+import base64
+import io
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from Crypto.Cipher import AES
+from Crypto.Util.Padding import pad
+from PIL import Image
+
+################################################################
+## local stand-in for the museum websites
+################################################################
+
+# the mock serves, under one host:
+#   /mhj/...        minghuaji.dpm.org.cn (listing, details, gve.js, encrypted pages)
+#   /collection/... www.dpm.org.cn (listing, details)
+#   /en/...         en.dpm.org.cn (tilegenerator xml)
+#   /digicol/...    digicol.dpm.org.cn (listing, details, gve.js, image list, encrypted pages)
+#   /tiles/...      synthetic deep zoom tile pyramids
+# every response can be delayed by `latency` seconds and fails with 503 with
+# probability `error_rate`
+
+MHJ_KEY = b'0123456789abcdef'
+MHJ_IV = b'fedcba9876543210'
+DIGICOL_KEY = b'abcdefghijklmnop'
+DIGICOL_IV = b'ponmlkjihgfedcba'
+XMLNS = 'http://schemas.microsoft.com/deepzoom/2009'
+
+def to_hex_string(data):
+    return ''.join(f'\\x{b:02x}' for b in data)
+
+def encrypt(text, key, iv):
+    cipher = AES.new(key, AES.MODE_CBC, iv)
+    return base64.b64encode(cipher.encrypt(pad(text.encode('utf-8'), 16))).decode('ascii')
+
+class MockSite:
+    def __init__(self, paintings=100, page_size=20, leaves=1, width=2048, height=1024, tilesize=254, overlap=1,
+                 latency=0.0, error_rate=0.0, seed=0):
+        self.paintings = paintings
+        self.page_size = page_size
+        self.leaves = leaves
+        self.width = width
+        self.height = height
+        self.tilesize = tilesize
+        self.overlap = overlap
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.tile_cache = {}
+        self.tile_lock = threading.Lock()
+        self.requests = 0
+        self.base_url = None
+        self.server = None
+
+    def paint_ids(self):
+        return [f'{idx:032x}' for idx in range(1, self.paintings + 1)]
+
+    # url prefixes to pass to http_client.configure(url_map=...)
+    def url_map(self):
+        return {
+            'https://minghuaji.dpm.org.cn': f'{self.base_url}/mhj',
+            'https://www.dpm.org.cn': f'{self.base_url}/collection',
+            'http://en.dpm.org.cn': f'{self.base_url}/en',
+            'https://en.dpm.org.cn': f'{self.base_url}/en',
+            'https://digicol.dpm.org.cn': f'{self.base_url}/digicol',
+        }
+
+    def start(self, port=0):
+        site = self
+        class Handler(MockHandler):
+            mock = site
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.base_url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    ################################################################
+    ## pages
+    ################################################################
+
+    def page_items(self, page):
+        paint_ids = self.paint_ids()
+        return paint_ids[(page - 1) * self.page_size:page * self.page_size]
+
+    def mhj_gve(self):
+        strings = [f'filler{idx}' for idx in range(30)]
+        strings[1] = to_hex_string(MHJ_KEY)
+        strings[4] = to_hex_string(MHJ_IV)
+        strings[28] = to_hex_string(XMLNS.encode('utf-8'))
+        strings[29] = to_hex_string(str(self.overlap).encode('utf-8'))
+        return 'var _0x = [' + ', '.join(f'"{string}"' for string in strings) + '];'
+
+    def mhj_list(self, page):
+        items = ''.join(
+            f'<li><div class="img_box" tagid="{paint_id}" tagname="画{paint_id[-4:]}" tagauthor="作者" tagdynasty="宋"></div></li>'
+            for paint_id in self.page_items(page)
+        )
+        return f'<ul>{items}</ul>'
+
+    def mhj_detail(self, paint_id):
+        return f'<html><body><div class="pf_main"><h3>宋，作者，绢本，设色，纵{100 + int(paint_id, 16) % 50}.5厘米，横45厘米</h3></div></body></html>'
+
+    def mhj_appreciate(self, paint_id, leaf):
+        items = ''.join(f'<li value="{idx}"></li>' for idx in range(self.leaves))
+        script = ''
+        if leaf is not None:
+            decrypted = f'{self.base_url}/tiles/mhj-{paint_id}-{leaf}_files/^jpg^{self.width}.0^{self.height}.0^{self.tilesize}'
+            script = f'<script>gv.init("{encrypt(decrypted, MHJ_KEY, MHJ_IV)}", 1);</script>'
+        return f'<html><body><ul id="gundong_id">{items}</ul>{script}</body></html>'
+
+    def collection_list(self, page):
+        rows = ''.join(
+            f'<tr><td><a href="/collection/paint/{paint_id}.html">画{paint_id[-4:]}</a></td><td>宋</td><td>绘画</td><td>作者</td></tr>'
+            for paint_id in self.page_items(page)
+        )
+        return f'<html><body><table class="table1"><tr><th>名称</th><th>时代</th><th>类别</th><th>作者</th></tr>{rows}</table></body></html>'
+
+    def collection_detail(self, paint_id):
+        images = ''.join(
+            f'<img custom_tilegenerator="http://en.dpm.org.cn/dyx.html?path=/tiles/collection-{paint_id}-{idx}.xml" />'
+            for idx in range(self.leaves)
+        )
+        return (
+            '<html><body>'
+            f'<a href="https://minghuaji.dpm.org.cn/paint/detail?id={paint_id}">名画记</a>'
+            f'<script>var objno="故{int(paint_id, 16):08d}";</script>'
+            f'<div class="content_edit"><p>作者，绢本，设色，纵100.5厘米，横45厘米。</p></div>'
+            f'{images}</body></html>'
+        )
+
+    def tilegenerator(self):
+        return (
+            f'<?xml version="1.0" encoding="UTF-8"?><Image xmnls="{XMLNS}" TileSize="{self.tilesize}" '
+            f'Overlap="{self.overlap}" Format="jpg"><Size Width="{self.width}" Height="{self.height}"/></Image>'
+        )
+
+    def digicol_gve(self):
+        values = [f'v{idx}' for idx in range(50)]
+        values[35] = DIGICOL_KEY.decode('ascii')
+        values[45] = DIGICOL_IV.decode('ascii')
+        encoded = to_hex_string('|'.join(values).encode('utf-8'))
+        return f'var _0x = ["a", "b", "c", "{encoded}"];'
+
+    def digicol_list(self, page):
+        rows = [
+            {'uuid': paint_id, 'name': f'画{paint_id[-4:]}', 'author': '作者', 'dynastyName': '宋', 'culturalRelicNo': f'故{int(paint_id, 16):08d}'}
+            for paint_id in self.page_items(page)
+        ]
+        return json.dumps({'total': self.paintings, 'rows': rows}, ensure_ascii=False)
+
+    def digicol_paint_detail(self, paint_id):
+        items = ['类别：绘画', '质地：绢本', '色彩：设色', f'尺寸：纵{100 + int(paint_id, 16) % 50}.5厘米，横45厘米']
+        return '<html><body><ul class="info_table">' + ''.join(f'<li>{item}</li>' for item in items) + '</ul></body></html>'
+
+    def digicol_images(self, paint_id):
+        divs = ''.join(f'<div value="{paint_id}-{idx}"></div>' for idx in range(self.leaves))
+        return f'<html><body><div id="swiper-wrapper-img">{divs}</div></body></html>'
+
+    def digicol_detail(self, image_id):
+        decrypted = f'{self.base_url}/tiles/digicol-{image_id}_files/^jpg^{self.width}.0^{self.height}.0^{self.tilesize}'
+        return f'<html><body><script>gv.init("{encrypt(decrypted, DIGICOL_KEY, DIGICOL_IV)}");</script></body></html>'
+
+    # a synthetic tile of the right size for its position in the pyramid
+    def tile(self, level, col, row):
+        max_level = math.ceil(math.log2(max(self.width, self.height)))
+        scale = 2 ** (max_level - level)
+        width, height = math.ceil(self.width / scale), math.ceil(self.height / scale)
+        x0 = max(0, col * self.tilesize - self.overlap)
+        y0 = max(0, row * self.tilesize - self.overlap)
+        x1 = min(width, (col + 1) * self.tilesize + self.overlap)
+        y1 = min(height, (row + 1) * self.tilesize + self.overlap)
+        if x0 >= x1 or y0 >= y1: return None
+
+        size = (x1 - x0, y1 - y0)
+        color = ((col * 40) % 256, (row * 40) % 256, (level * 20) % 256)
+        with self.tile_lock:
+            if not (size, color) in self.tile_cache:
+                buffer = io.BytesIO()
+                Image.new('RGB', size, color).save(buffer, format='JPEG')
+                self.tile_cache[(size, color)] = buffer.getvalue()
+            return self.tile_cache[(size, color)]
+
+    # return (status, content type, body) for a request
+    def handle(self, method, path, query):
+        page = int(query.get('page', ['0'])[0] or 0)
+        paint_id = query.get('id', [''])[0]
+
+        if path == '/mhj/paint/list':
+            return 200, 'text/html', '<html></html>'
+        if path == '/mhj/paint/queryList':
+            return 200, 'text/html', self.mhj_list(page)
+        if path == '/mhj/paint/detail':
+            return 200, 'text/html', self.mhj_detail(paint_id)
+        if path == '/mhj/paint/appreciate':
+            return 200, 'text/html', self.mhj_appreciate(paint_id, query.get('type', [None])[0])
+        if path == '/mhj/js/gve.js':
+            return 200, 'application/javascript', self.mhj_gve()
+
+        match = re.fullmatch(r'/collection/searchs/paints/category_id/91/p/(\d+)\.html', path)
+        if match: return 200, 'text/html', self.collection_list(int(match.group(1)))
+        match = re.fullmatch(r'/collection/collection/paint/(\w+)\.html', path)
+        if match: return 200, 'text/html', self.collection_detail(match.group(1))
+        if re.fullmatch(r'/en/tiles/[\w-]+\.xml', path):
+            return 200, 'application/xml', self.tilegenerator()
+
+        if path == '/digicol/js/gve.js':
+            return 200, 'application/javascript', self.digicol_gve()
+        if path == '/digicol/cultural/queryList':
+            return 200, 'application/json', self.digicol_list(page)
+        if path == '/digicol/cultural/detail':
+            return 200, 'text/html', self.digicol_paint_detail(paint_id)
+        if path == '/digicol/cultural/listCulturalImage':
+            return 200, 'text/html', self.digicol_images(paint_id)
+        if path == '/digicol/cultural/details':
+            return 200, 'text/html', self.digicol_detail(paint_id)
+
+        match = re.fullmatch(r'/(?:en/)?tiles/[\w-]+_files/(\d+)/(\d+)_(\d+)\.jpg', path)
+        if match:
+            tile = self.tile(*[int(group) for group in match.groups()])
+            if tile is not None: return 200, 'image/jpeg', tile
+
+        return 404, 'text/plain', 'Not found'
+
+class MockHandler(BaseHTTPRequestHandler):
+    mock = None
+    protocol_version = 'HTTP/1.1'
+
+    def respond(self, method):
+        mock = self.mock
+        mock.requests += 1
+        if mock.latency > 0: time.sleep(mock.latency)
+        with mock.random_lock:
+            failed = mock.random.random() < mock.error_rate
+
+        # consume the request body so that the connection can be reused, and
+        # accept form parameters like query parameters
+        length = int(self.headers.get('Content-Length') or 0)
+        data = self.rfile.read(length).decode('utf-8') if length > 0 else ''
+
+        url = urlsplit(self.path)
+        if failed:
+            status, content_type, body = 503, 'text/plain', 'Service unavailable'
+        else:
+            status, content_type, body = mock.handle(method, url.path, {**parse_qs(data), **parse_qs(url.query)})
+        if isinstance(body, str): body = body.encode('utf-8')
+
+        self.send_response(status)
+        if not content_type.startswith('image/'): content_type += '; charset=utf-8'
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if url.path == '/mhj/paint/list':
+            self.send_header('Set-Cookie', 'XSRF-TOKEN=mock-token; Path=/')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.respond('GET')
+
+    def do_POST(self):
+        self.respond('POST')
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,153 @@
+import argparse
+import functools
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import http_client
+import rate_limit
+import tile_cache
+import metadata_cache
+import fetch_paintings
+import generate_dzi
+import download_images
+from mock_server import MockSite
+
+################################################################
+## offline benchmarks against the local mock of the websites
+################################################################
+
+# record the duration of every call of a module function
+class Timer:
+    def __init__(self):
+        self.durations = []
+        self.lock = threading.Lock()
+
+    def wrap(self, module, name):
+        function = getattr(module, name)
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.durations.append(time.perf_counter() - started_at)
+        setattr(module, name, timed)
+        return function
+
+def percentile(values, q):
+    if len(values) == 0: return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+# run `run` while timing each call of module.name, and report the throughput
+def benchmark(name, run, module, function_name, unit):
+    timer = Timer()
+    original = timer.wrap(module, function_name)
+    started_at = time.perf_counter()
+    try:
+        run()
+    finally:
+        setattr(module, function_name, original)
+    elapsed = time.perf_counter() - started_at
+
+    result = {
+        'name': name,
+        'unit': unit,
+        'count': len(timer.durations),
+        'seconds': elapsed,
+        'throughput': len(timer.durations) / elapsed if elapsed > 0 else None,
+        'p50': percentile(timer.durations, 50),
+        'p99': percentile(timer.durations, 99),
+    }
+    p50 = f'{result["p50"] * 1000:.1f} ms' if result['p50'] is not None else '-'
+    p99 = f'{result["p99"] * 1000:.1f} ms' if result['p99'] is not None else '-'
+    print(f'{name:<32} {result["count"]:>6} {unit:<10} {elapsed:>8.2f} s {result["throughput"] or 0:>9.1f} /s   p50 {p50:>10}   p99 {p99:>10}')
+    return result
+
+def run_benchmarks(args):
+    mock = MockSite(
+        paintings=args.paintings, page_size=args.page_size, leaves=args.leaves,
+        width=args.width, height=args.height, tilesize=args.tilesize,
+        latency=args.latency, error_rate=args.error_rate
+    ).start()
+
+    # the scripts work on the current directory
+    work_dir = tempfile.mkdtemp(prefix='dpm-bench-')
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        http_client.configure(url_map=mock.url_map(), pool_size=args.workers, backoff_factor=0.05, backoff_jitter=0.05)
+        rate_limit.configure(enabled=False)
+        tile_cache.configure(cache_dir=os.path.join(work_dir, 'cache', 'tiles'))
+        metadata_cache.configure(path=os.path.join(work_dir, 'cache', 'metadata.db'))
+
+        results = []
+        for website in ['mhj', 'collection', 'digicol']:
+            if os.path.exists('paintings.csv'): os.remove('paintings.csv')
+            results.append(benchmark(
+                f'fetch_all ({website})',
+                lambda: fetch_paintings.fetch_all(website, workers=args.workers),
+                fetch_paintings, f'fetch_page_{website}', 'pages'
+            ))
+            results.append(benchmark(
+                f'fetch_details ({website})',
+                lambda: fetch_paintings.fetch_details(website, workers=args.workers),
+                fetch_paintings, f'fetch_detail_{website}', 'paintings'
+            ))
+
+        paint_ids = mock.paint_ids()[:args.dzi_paintings]
+        for website in ['mhj', 'collection', 'digicol']:
+            # regenerate from the network rather than from the metadata cache
+            metadata_cache.configure(enabled=False)
+            shutil.rmtree('paintings', ignore_errors=True)
+            results.append(benchmark(
+                f'generate_dzi_file ({website})',
+                lambda: generate_dzi.generate_dzi_files(website, paint_ids, workers=args.workers),
+                generate_dzi, 'generate_dzi_file', 'paintings'
+            ))
+            metadata_cache.configure(enabled=True)
+
+        # full downloads with the native backend
+        shutil.rmtree('paintings', ignore_errors=True)
+        tile_cache.configure(enabled=False)
+        download_ids = mock.paint_ids()[:args.download_paintings]
+        def download():
+            for paint_id in download_ids:
+                download_images.download_image('mhj', paint_id, backend='native')
+        results.append(benchmark('download_image (mhj, native)', download, download_images, 'download_dzi_files', 'paintings'))
+
+        print(f'{mock.requests} requests served')
+        return results
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+        mock.stop()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the scripts against a local mock of the websites.')
+    parser.add_argument('--paintings', type=int, default=200, help='number of paintings listed by the mock')
+    parser.add_argument('--page-size', type=int, default=20)
+    parser.add_argument('--leaves', type=int, default=2, help='images per painting')
+    parser.add_argument('--width', type=int, default=2048)
+    parser.add_argument('--height', type=int, default=1024)
+    parser.add_argument('--tilesize', type=int, default=254)
+    parser.add_argument('--latency', type=float, default=0.02, help='delay of every response in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='probability of a 503 response')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--dzi-paintings', type=int, default=50)
+    parser.add_argument('--download-paintings', type=int, default=3)
+    parser.add_argument('--output', help='write the results as json to this file')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
@@ -0,0 +1,185 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qs
+import pandas as pd
+import generate_dzi
+from site_urls import paint_urls, gv_urls
+import metadata_cache
+from catalog import open_catalog
+
+################################################################
+## offline bulk generation of dzi files
+################################################################
+
+# the pages needed to generate the dzi files of a painting are kept in
+# [pages_dir]/[website]/[paint_id]/: the painting page as index.html and each
+# leaf page (or tile generator descriptor) named by get_page_filename(), with
+# the key material of the website in [pages_dir]/[website]/gve.js
+# the dzi files of a whole catalog can then be regenerated from these pages
+# without any network request, e.g. after the key has been rotated, with the
+# parsing and decryption spread over a pool of processes
+
+# paintings per progress report
+report_every = 500
+
+# name of the file of a leaf page: the leaf (type) or image id of the url,
+# or the file name of a tile generator descriptor
+def get_page_filename(url):
+    url = urlparse(url)
+    query = parse_qs(url.query)
+    for key in ['type', 'id']:
+        if key in query: return f'{query[key][0]}.html'
+    return os.path.basename(url.path)
+
+def get_painting_dir(pages_dir, website, paint_id):
+    return os.path.join(pages_dir, website, str(paint_id))
+
+def read_text(path):
+    with open(path, 'r', encoding='utf-8') as file:
+        return file.read()
+
+def write_text(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f'{path}.tmp', 'w', encoding='utf-8') as file:
+        file.write(text)
+    os.replace(f'{path}.tmp', path)
+
+# urls of the leaf pages (or descriptors) listed on a painting page
+def get_leaf_urls(website, paint_url, html_string):
+    if website == 'mhj':
+        return generate_dzi.get_leaf_urls_mhj(paint_url, html_string)
+    elif website == 'collection':
+        return generate_dzi.get_tilegenerator_urls(html_string)
+    elif website == 'digicol':
+        return generate_dzi.get_image_urls_digicol(html_string)
+    else:
+        raise ValueError(f'Unknown website {website}')
+
+# gv info of a website, from the saved gve.js if there is one
+def get_info(website, pages_dir):
+    if not website in gv_urls: return None
+    gv_file = os.path.join(pages_dir, website, 'gve.js')
+    if not os.path.exists(gv_file): return generate_dzi.get_info(website)
+    if website == 'mhj': return generate_dzi.parse_info_mhj(gv_file, read_text(gv_file))
+    return generate_dzi.parse_info_digicol(read_text(gv_file))
+
+# get the dzi info of all images of a painting from its saved pages
+def extract_dzi_infos(website, painting_dir, paint_id, info):
+    paint_url = paint_urls[website].format(paint_id=paint_id)
+    leaf_urls = get_leaf_urls(website, paint_url, read_text(os.path.join(painting_dir, 'index.html')))
+    leaf_texts = [read_text(os.path.join(painting_dir, get_page_filename(url))) for url in leaf_urls]
+
+    if website == 'collection':
+        return [
+            generate_dzi.parse_dzi_info_bigimg(url, text) if 'bigimg' in url else generate_dzi.parse_tilegenerator(url, text)
+            for url, text in zip(leaf_urls, leaf_texts)
+        ]
+
+    if website == 'mhj':
+        key, iv, xmlns, overlap = generate_dzi.get_keys_mhj(info)
+    else:
+        key, iv = generate_dzi.get_keys_digicol(info)
+        xmlns, overlap = generate_dzi.xmlns_digicol, '1'
+    return [
+        generate_dzi.make_dzi_info(generate_dzi.decrypt_cbc(generate_dzi.parse_encrypted_text(url, text), key, iv), xmlns, overlap)
+        for url, text in zip(leaf_urls, leaf_texts)
+    ]
+
+# website, pages directory and gv info of the worker processes, set once per process
+_worker = {}
+
+def init_worker(website, pages_dir, info):
+    _worker.update(website=website, pages_dir=pages_dir, info=info)
+
+# runs in a worker process; returns the dzi infos or the exception
+def extract_painting(paint_id):
+    try:
+        painting_dir = get_painting_dir(_worker['pages_dir'], _worker['website'], paint_id)
+        return extract_dzi_infos(_worker['website'], painting_dir, paint_id, _worker['info'])
+    except Exception as e:
+        return e
+
+# generate the dzi files of all paintings saved in pages_dir (or of `paint_ids`)
+# paintings are sent to `workers` processes in chunks of `chunksize`; the dzi
+# files are written and the metadata cache is updated by this process
+# returns the dzi file paths of each painting, or the exception if it failed
+def generate_offline(website, pages_dir, paint_ids=None, workers=None, chunksize=None):
+    if not website in paint_urls:
+        raise ValueError(f'Unknown website {website}')
+    if paint_ids is None:
+        site_dir = os.path.join(pages_dir, website)
+        paint_ids = sorted(name for name in os.listdir(site_dir) if os.path.isdir(os.path.join(site_dir, name)))
+    if workers is None: workers = os.cpu_count() or 1
+    # a few chunks per process keep the processes busy until the end
+    if chunksize is None: chunksize = max(1, min(256, len(paint_ids) // (workers * 4)))
+    info = get_info(website, pages_dir)
+
+    print(f'Generating the dzi files of {len(paint_ids)} paintings with {workers} processes...')
+    results = {}
+    failures = 0
+    started_at = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(website, pages_dir, info)) as executor:
+        for paint_id, dzi_infos in zip(paint_ids, executor.map(extract_painting, paint_ids, chunksize=chunksize)):
+            if isinstance(dzi_infos, Exception):
+                print(f'Failed to generate dzi files for painting {paint_id}: {dzi_infos}')
+                failures += 1
+                results[paint_id] = dzi_infos
+            else:
+                if len(dzi_infos) > 0: metadata_cache.put(f'dzi:{website}:{paint_id}', dzi_infos)
+                results[paint_id] = generate_dzi.write_dzi_files(paint_id, dzi_infos)
+
+            if len(results) % report_every == 0 or len(results) == len(paint_ids):
+                elapsed = time.perf_counter() - started_at
+                print(f'{len(results)}/{len(paint_ids)} paintings, {failures} failed, {len(results) / elapsed:.1f} paintings/s')
+    return results
+
+# save the pages needed by generate_offline() for the given paintings
+# paintings whose pages are already saved are skipped
+def save_pages(website, paint_ids, pages_dir, workers=8):
+    if website in gv_urls:
+        write_text(os.path.join(pages_dir, website, 'gve.js'), generate_dzi.get_text_from_url(gv_urls[website]))
+
+    def save(paint_id):
+        painting_dir = get_painting_dir(pages_dir, website, paint_id)
+        index_file = os.path.join(painting_dir, 'index.html')
+        if os.path.exists(index_file): return
+        try:
+            paint_url = paint_urls[website].format(paint_id=paint_id)
+            html_string = generate_dzi.get_text_from_url(paint_url)
+            for url in get_leaf_urls(website, paint_url, html_string):
+                write_text(os.path.join(painting_dir, get_page_filename(url)), generate_dzi.get_text_from_url(url))
+            # the painting page is written last, so only complete paintings are skipped
+            write_text(index_file, html_string)
+        except Exception as e:
+            print(f'Failed to save the pages of painting {paint_id}: {e}')
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(save, paint_ids))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate dzi files from saved pages without network access.')
+    parser.add_argument('website', choices=['mhj', 'collection', 'digicol'])
+    parser.add_argument('pages_dir')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes (all cpus by default)')
+    parser.add_argument('--chunksize', type=int, default=None, help='paintings sent to a process at once')
+    parser.add_argument('--save', action='store_true', help='first save the pages of the paintings in paintings.csv (or --db)')
+    parser.add_argument('--db', help='sqlite catalog to read the paintings from')
+    args = parser.parse_args()
+
+    # create the directory to store the dzi files
+    if not os.path.exists('paintings'): os.makedirs('paintings')
+
+    paint_ids = None
+    if args.save:
+        catalog = open_catalog(args.db)
+        if catalog is not None:
+            paint_ids = catalog.get_ids(args.website)
+        else:
+            paint_ids = pd.read_csv('paintings.csv')['id'].astype(str).tolist()
+        save_pages(args.website, paint_ids, args.pages_dir)
+
+    started_at = time.perf_counter()
+    results = generate_offline(args.website, args.pages_dir, paint_ids=paint_ids, workers=args.workers, chunksize=args.chunksize)
+    print(f'Generated the dzi files of {len(results)} paintings in {time.perf_counter() - started_at:.2f} s')
@@ -0,0 +1,186 @@
+import os
+import sqlite3
+import threading
+import time
+import pandas as pd
+
+################################################################
+## sqlite catalog store
+################################################################
+
+# painting columns stored in the catalog (besides site and id)
+columns = ['name', 'author', 'dynasty', 'category', 'mhj_id', 'inventory_id', 'detail_text', 'material', 'color', 'height', 'width']
+
+# status of a painting in the workflow
+# 'duplicate' paintings are skipped because another website has a better copy
+statuses = ['listed', 'enriched', 'dzi-generated', 'downloaded', 'failed', 'duplicate']
+
+# catalog of paintings of all websites in a sqlite database (WAL mode)
+# rows are indexed by (site, id) and can be updated one at a time by concurrent writers
+class Catalog:
+    def __init__(self, path='paintings.db'):
+        self.path = path
+        self.local = threading.local()
+        connection = self.get_connection()
+        connection.execute(f'''
+            CREATE TABLE IF NOT EXISTS paintings (
+                site TEXT NOT NULL,
+                id TEXT NOT NULL,
+                {", ".join(f"{col} TEXT" for col in columns)},
+                status TEXT NOT NULL DEFAULT 'listed',
+                error TEXT,
+                updated_at REAL,
+                PRIMARY KEY (site, id)
+            )''')
+        # add the columns introduced after the database was created
+        existing = [row[1] for row in connection.execute('PRAGMA table_info(paintings)')]
+        for col in columns:
+            if not col in existing: connection.execute(f'ALTER TABLE paintings ADD COLUMN {col} TEXT')
+        connection.execute('CREATE INDEX IF NOT EXISTS paintings_status ON paintings (site, status)')
+        connection.commit()
+
+    # each thread uses its own connection to the database
+    def get_connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=60)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.row_factory = sqlite3.Row
+            self.local.connection = connection
+        return connection
+
+    # insert or update paintings, only changing the columns present in each painting
+    # new paintings get the status 'listed' unless `status` is given
+    def upsert(self, site, paintings, status=None):
+        if status is not None and not status in statuses:
+            raise ValueError(f'Unknown status: {status}')
+
+        # group paintings by their columns so that each group is one statement
+        groups = {}
+        for painting in paintings:
+            keys = tuple(col for col in columns if col in painting)
+            groups.setdefault(keys, []).append(painting)
+
+        connection = self.get_connection()
+        now = time.time()
+        with connection:
+            for keys, group in groups.items():
+                insert_cols = ['site', 'id', *keys, 'status', 'updated_at']
+                updates = [f'{col} = excluded.{col}' for col in keys] + ['updated_at = excluded.updated_at']
+                if status is not None: updates += ['status = excluded.status', 'error = NULL']
+                sql = f'''
+                    INSERT INTO paintings ({", ".join(insert_cols)})
+                    VALUES ({", ".join("?" for _ in insert_cols)})
+                    ON CONFLICT (site, id) DO UPDATE SET {", ".join(updates)}'''
+                rows = [
+                    [site, str(painting['id']), *[to_text(painting[col]) for col in keys], status or 'listed', now]
+                    for painting in group
+                ]
+                connection.executemany(sql, rows)
+
+    def set_status(self, site, paint_id, status, error=None):
+        if not status in statuses:
+            raise ValueError(f'Unknown status: {status}')
+        connection = self.get_connection()
+        with connection:
+            connection.execute(
+                'UPDATE paintings SET status = ?, error = ?, updated_at = ? WHERE site = ? AND id = ?',
+                (status, error, time.time(), site, str(paint_id))
+            )
+
+    # paintings marked as duplicates of a painting (which has failed) are listed
+    # again, so that another copy is downloaded instead
+    # returns the (site, id) of the revived paintings
+    def revive_duplicates(self, site, paint_id):
+        connection = self.get_connection()
+        with connection:
+            revived = connection.execute(
+                "SELECT site, id FROM paintings WHERE status = 'duplicate' AND error = ?", (f'{site}:{paint_id}',)
+            ).fetchall()
+            connection.execute(
+                "UPDATE paintings SET status = 'listed', error = NULL, updated_at = ? WHERE status = 'duplicate' AND error = ?",
+                (time.time(), f'{site}:{paint_id}')
+            )
+        return [(row[0], row[1]) for row in revived]
+
+    def get(self, site, paint_id):
+        row = self.get_connection().execute(
+            'SELECT * FROM paintings WHERE site = ? AND id = ?', (site, str(paint_id))
+        ).fetchone()
+        return None if row is None else dict(row)
+
+    # ids of the paintings of a site, optionally only those with one of the given
+    # statuses and those whose `missing` columns are all empty
+    def get_ids(self, site, status=None, missing=None):
+        sql = 'SELECT id FROM paintings WHERE site = ?'
+        params = [site]
+        if status is not None:
+            if isinstance(status, str): status = [status]
+            sql += f' AND status IN ({", ".join("?" for _ in status)})'
+            params += list(status)
+        for col in missing or []:
+            if not col in columns:
+                raise ValueError(f'Unknown column: {col}')
+            sql += f" AND ({col} IS NULL OR {col} = '')"
+        return [row[0] for row in self.get_connection().execute(sql + ' ORDER BY rowid', params)]
+
+    # paintings of a site as dataframes of at most `chunksize` rows, in rowid order
+    # each chunk is a separate query, so no read transaction is held open
+    # while the paintings are processed
+    def iter_chunks(self, site, status=None, chunksize=10000):
+        sql = 'SELECT rowid, * FROM paintings WHERE site = ? AND rowid > ?'
+        status_list = []
+        if status is not None:
+            status_list = [status] if isinstance(status, str) else list(status)
+            sql += f' AND status IN ({", ".join("?" for _ in status_list)})'
+        sql += ' ORDER BY rowid LIMIT ?'
+        last_rowid = 0
+        while True:
+            rows = self.get_connection().execute(sql, [site, last_rowid, *status_list, chunksize]).fetchall()
+            if len(rows) == 0: return
+            last_rowid = rows[-1]['rowid']
+            yield pd.DataFrame([dict(row) for row in rows]).drop(columns=['rowid'])
+
+    def count(self, site):
+        rows = self.get_connection().execute(
+            'SELECT status, COUNT(*) FROM paintings WHERE site = ? GROUP BY status', (site,)
+        )
+        return {row[0]: row[1] for row in rows}
+
+    def to_dataframe(self, site):
+        return pd.read_sql_query(
+            'SELECT * FROM paintings WHERE site = ? ORDER BY rowid', self.get_connection(), params=(site,)
+        )
+
+    # import paintings from a csv file (e.g. paintings.csv)
+    def import_csv(self, csv_file, site):
+        df = pd.read_csv(csv_file, dtype=str)
+        df = df[[col for col in ['id', *columns] if col in df.columns]]
+        self.upsert(site, [
+            {key: value for key, value in row.items() if not pd.isna(value)}
+            for row in df.to_dict('records')
+        ])
+
+    # export the paintings of a site to a csv file compatible with paintings.csv
+    def export_csv(self, csv_file, site):
+        df = self.to_dataframe(site).drop(columns=['site', 'updated_at'])
+        df = df.dropna(axis=1, how='all')
+        tmp_file = f'{csv_file}.tmp'
+        df.to_csv(tmp_file, index=False)
+        os.replace(tmp_file, csv_file)
+
+    def close(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+def to_text(value):
+    if value is None or (isinstance(value, float) and pd.isna(value)): return None
+    return str(value)
+
+# accept a Catalog, a path to the database or None
+def open_catalog(catalog):
+    if catalog is None or isinstance(catalog, Catalog): return catalog
+    return Catalog(catalog)
@@ -0,0 +1,443 @@
+import io
+import itertools
+import math
+import os
+import queue
+import struct
+import threading
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+import http_client
+import tile_cache
+import metrics
+
+################################################################
+## Deep Zoom tile downloader (alternative to dezoomify-rs)
+################################################################
+
+# headers sent with every tile request
+tile_headers = {'Referer': 'https://www.dpm.org.cn'}
+
+# read the dzi file written by write_dzi_file
+def read_dzi_file(dzi_file):
+    root = ET.parse(dzi_file).getroot()
+    size = root.find('{*}Size')
+    if size is None:
+        raise ValueError(f'Cannot find image size in {dzi_file}')
+
+    url = root.attrib['Url']
+    if not url.endswith('/'): url += '/'
+
+    return {
+        'url': url,
+        'overlap': int(root.attrib['Overlap']),
+        'tilesize': int(root.attrib['TileSize']),
+        'format': root.attrib['Format'],
+        'width': int(size.attrib['Width']),
+        'height': int(size.attrib['Height'])
+    }
+
+# the largest level holds the full resolution image, each level below halves its size
+def get_max_level(dzi):
+    return math.ceil(math.log2(max(dzi['width'], dzi['height'], 1)))
+
+def get_level_size(dzi, level):
+    scale = 2 ** (get_max_level(dzi) - level)
+    return math.ceil(dzi['width'] / scale), math.ceil(dzi['height'] / scale)
+
+# number of tile columns and rows of a level
+def get_tile_grid(dzi, level):
+    width, height = get_level_size(dzi, level)
+    return math.ceil(width / dzi['tilesize']), math.ceil(height / dzi['tilesize'])
+
+def get_tile_url(dzi, level, col, row):
+    return f'{dzi["url"]}{level}/{col}_{row}.{dzi["format"]}'
+
+# position of the top left pixel of a tile in the level image
+# tiles other than the first in each direction start `overlap` pixels earlier
+def get_tile_position(dzi, col, row):
+    x = col * dzi['tilesize'] - (dzi['overlap'] if col > 0 else 0)
+    y = row * dzi['tilesize'] - (dzi['overlap'] if row > 0 else 0)
+    return x, y
+
+# download the encoded bytes of a tile, unless it is already in the tile cache
+def fetch_tile(dzi, level, col, row):
+    data = tile_cache.get(dzi['url'], level, col, row)
+    if data is not None:
+        metrics.count('tile_cache_hits')
+        return data
+
+    url = get_tile_url(dzi, level, col, row)
+    res = http_client.get(url, headers=tile_headers)
+    # check for successful request
+    if res.status_code != 200:
+        raise ValueError(f'Encountered error when visiting {url}: {res.status_code}')
+
+    metrics.count('tiles')
+    tile_cache.put(dzi['url'], level, col, row, res.content)
+    return res.content
+
+def decode_tile(data):
+    with metrics.span('decode_tile'):
+        tile = Image.open(io.BytesIO(data))
+        tile.load()
+        return tile.convert('RGB')
+
+# decode a fetched tile; a tile that cannot be decoded is removed from the tile
+# cache, so that the next attempt downloads it again
+def decode_fetched_tile(dzi, level, col, row, data):
+    try:
+        return decode_tile(data)
+    except Exception:
+        tile_cache.delete(dzi['url'], level, col, row)
+        raise
+
+# fetch the tiles of a level concurrently and yield the level image band by band
+# each band is one row of tiles high (without overlap); only the tiles of the
+# current and the next row are held in memory at any time
+def iter_bands(dzi, level, workers=8):
+    width, height = get_level_size(dzi, level)
+    cols, rows = get_tile_grid(dzi, level)
+    tilesize = dzi['tilesize']
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        def submit_row(row):
+            return [executor.submit(fetch_tile, dzi, level, col, row) for col in range(cols)]
+
+        next_row = submit_row(0)
+        for row in range(rows):
+            current_row = next_row
+            if row + 1 < rows: next_row = submit_row(row + 1)
+
+            band = Image.new('RGB', (width, min(tilesize, height - row * tilesize)))
+            for col, future in enumerate(current_row):
+                x, y = get_tile_position(dzi, col, row)
+                band.paste(decode_fetched_tile(dzi, level, col, row, future.result()), (x, y - row * tilesize))
+            yield band
+
+# images larger than this number of pixels (or than the jpeg size limit) are
+# streamed to a tiff file instead of being stitched in memory
+stream_pixels = 100000000
+max_jpeg_size = 65500
+
+def needs_streaming(dzi, level):
+    width, height = get_level_size(dzi, level)
+    return width * height > stream_pixels or max(width, height) > max_jpeg_size
+
+# download all tiles of a level and stitch them into one image
+# with `streaming`, the image is written band by band to an uncompressed
+# (big)tiff file so that memory use does not depend on the image size
+def download_dzi(dzi_file, paint_file, level=None, workers=8, streaming=False):
+    dzi = read_dzi_file(dzi_file)
+    if level is None: level = get_max_level(dzi)
+    width, height = get_level_size(dzi, level)
+    cols, rows = get_tile_grid(dzi, level)
+    print(f'Downloading {cols * rows} tiles of {dzi_file} at level {level} ({width}x{height})...')
+
+    http_client.ensure_pool_size(workers)
+    with metrics.span('stitch', file=paint_file, tiles=cols * rows):
+        stitch_level(dzi, level, paint_file, workers, streaming)
+    print(f'Saved {paint_file}')
+
+def stitch_level(dzi, level, paint_file, workers=8, streaming=False):
+    width, height = get_level_size(dzi, level)
+    # write to a temporary file so that an interrupted download never looks complete
+    tmp_file = f'{paint_file}.part'
+    if streaming:
+        writer = TiffWriter(tmp_file, width, height, dzi['tilesize'])
+        try:
+            for band in iter_bands(dzi, level, workers):
+                writer.write_strip(band.tobytes())
+        finally:
+            writer.close()
+        os.replace(tmp_file, paint_file)
+    else:
+        save_image(stitch_image(dzi, level, workers), paint_file)
+
+# stitch a level in memory
+def stitch_image(dzi, level, workers=8):
+    image = Image.new('RGB', get_level_size(dzi, level))
+    for row, band in enumerate(iter_bands(dzi, level, workers)):
+        image.paste(band, (0, row * dzi['tilesize']))
+    return image
+
+def save_image(image, paint_file):
+    tmp_file = f'{paint_file}.part'
+    image.save(tmp_file, format=Image.registered_extensions()[os.path.splitext(paint_file)[1].lower()])
+    os.replace(tmp_file, paint_file)
+
+################################################################
+## global tile queue
+################################################################
+
+# a level of a dzi file downloaded through the tile queue
+# tiles may arrive in any order; each row is written as soon as it and all
+# rows above it are complete, so streamed images only buffer out of order rows
+class ImageJob:
+    def __init__(self, dzi_file, paint_file, level=None, streaming=False):
+        self.dzi_file = dzi_file
+        self.paint_file = paint_file
+        self.dzi = read_dzi_file(dzi_file)
+        self.level = get_max_level(self.dzi) if level is None else level
+        self.width, self.height = get_level_size(self.dzi, self.level)
+        self.cols, self.rows = get_tile_grid(self.dzi, self.level)
+        self.streaming = streaming
+        self.remaining = self.cols * self.rows
+        self.tiles = {} # row -> {col: tile}
+        self.next_row = 0
+        self.writer = None
+        self.image = None
+        self.error = None
+        self.started_at = time.perf_counter()
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+
+    def add_tile(self, col, row, data):
+        tile = decode_fetched_tile(self.dzi, self.level, col, row, data)
+        with self.lock:
+            if self.done.is_set(): return
+            try:
+                self.tiles.setdefault(row, {})[col] = tile
+                self.remaining -= 1
+                while self.next_row < self.rows and len(self.tiles.get(self.next_row, {})) == self.cols:
+                    self.write_row(self.next_row, self.tiles.pop(self.next_row))
+                    self.next_row += 1
+                if self.remaining == 0: self.finish()
+            except Exception as e:
+                self.fail(e)
+
+    def write_row(self, row, tiles):
+        tilesize = self.dzi['tilesize']
+        band = Image.new('RGB', (self.width, min(tilesize, self.height - row * tilesize)))
+        for col, tile in tiles.items():
+            x, y = get_tile_position(self.dzi, col, row)
+            band.paste(tile, (x, y - row * tilesize))
+
+        if self.streaming:
+            if self.writer is None: self.writer = TiffWriter(f'{self.paint_file}.part', self.width, self.height, tilesize)
+            self.writer.write_strip(band.tobytes())
+        else:
+            if self.image is None: self.image = Image.new('RGB', (self.width, self.height))
+            self.image.paste(band, (0, row * tilesize))
+
+    def finish(self):
+        if self.streaming:
+            self.writer.close()
+            os.replace(f'{self.paint_file}.part', self.paint_file)
+        else:
+            save_image(self.image, self.paint_file)
+            self.image = None
+        metrics.record('stitch', time.perf_counter() - self.started_at, file=self.paint_file, tiles=self.cols * self.rows)
+        print(f'Saved {self.paint_file}')
+        self.done.set()
+
+    # give up on the image, removing the partial output
+    def fail(self, error):
+        if self.done.is_set(): return
+        self.error = error
+        self.tiles.clear()
+        self.image = None
+        if self.writer is not None:
+            self.writer.close()
+            if os.path.exists(f'{self.paint_file}.part'): os.remove(f'{self.paint_file}.part')
+        metrics.record('stitch', time.perf_counter() - self.started_at, error=type(error).__name__, file=self.paint_file)
+        self.done.set()
+
+    # stop the image; its queued tiles are skipped by the workers
+    def cancel(self):
+        with self.lock:
+            self.fail(ValueError(f'Cancelled the download of {self.paint_file}'))
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None: raise self.error
+
+# tiles of all submitted images are fetched by `workers` threads from one
+# priority queue; images are served in submission order (and each image row by
+# row), so the earliest images finish first while the next ones keep the
+# workers busy, instead of each image downloading on its own
+class TileQueue:
+    def __init__(self, workers=16):
+        self.queue = queue.PriorityQueue()
+        self.jobs = itertools.count()
+        self.threads = [threading.Thread(target=self.work, daemon=True) for _ in range(workers)]
+        http_client.ensure_pool_size(workers)
+        for thread in self.threads: thread.start()
+
+    def submit(self, dzi_file, paint_file, level=None, streaming=False):
+        job = ImageJob(dzi_file, paint_file, level, streaming)
+        print(f'Queueing {job.cols * job.rows} tiles of {dzi_file} at level {job.level} ({job.width}x{job.height})...')
+        priority = next(self.jobs)
+        for row in range(job.rows):
+            for col in range(job.cols):
+                self.queue.put((priority, row, col, job))
+        return job
+
+    def work(self):
+        while True:
+            _, row, col, job = self.queue.get()
+            if job is None: return
+            if job.done.is_set(): continue
+            try:
+                job.add_tile(col, row, fetch_tile(job.dzi, job.level, col, row))
+            except Exception as e:
+                with job.lock:
+                    job.fail(e)
+
+    # stop the workers once the queued tiles are done
+    def close(self):
+        for _ in self.threads: self.queue.put((math.inf, 0, 0, None))
+        for thread in self.threads: thread.join()
+
+# number of threads fetching tiles for all images downloaded with the native backend
+tile_workers = 16
+_tile_queue = None
+_tile_queue_lock = threading.Lock()
+
+def get_tile_queue():
+    global _tile_queue
+    with _tile_queue_lock:
+        if _tile_queue is None: _tile_queue = TileQueue(tile_workers)
+        return _tile_queue
+
+def set_tile_workers(workers):
+    global _tile_queue, tile_workers
+    with _tile_queue_lock:
+        if workers == tile_workers and _tile_queue is not None: return
+        tile_workers = workers
+        old_queue, _tile_queue = _tile_queue, None
+    if old_queue is not None: old_queue.close()
+
+################################################################
+## multi-resolution export
+################################################################
+
+# smallest level whose longer side is at least `max_size` pixels, so that the
+# output can be downscaled from it (the largest level if `max_size` is None)
+def get_level_for_size(dzi, max_size):
+    max_level = get_max_level(dzi)
+    if max_size is None: return max_level
+    for level in range(max_level + 1):
+        if max(get_level_size(dzi, level)) >= max_size: return level
+    return max_level
+
+# write several sizes of an image from the matching pyramid levels
+# `outputs` maps each output file to the maximum size of its longer side
+# (None for the full resolution); every level is fetched only once, and small
+# outputs only need the few tiles of a low level instead of the full image
+# outputs of levels too large to be stitched in memory are streamed to a tiff
+# file at the level size
+# returns the files written
+def export_dzi(dzi_file, outputs, workers=8):
+    dzi = read_dzi_file(dzi_file)
+    levels = {}
+    for paint_file, max_size in outputs.items():
+        levels.setdefault(get_level_for_size(dzi, max_size), []).append((paint_file, max_size))
+
+    http_client.ensure_pool_size(workers)
+    written_files = []
+    for level, level_outputs in sorted(levels.items()):
+        width, height = get_level_size(dzi, level)
+        cols, rows = get_tile_grid(dzi, level)
+        if needs_streaming(dzi, level):
+            for paint_file, _ in level_outputs:
+                paint_file = os.path.splitext(paint_file)[0] + '.tif'
+                print(f'Downloading {cols * rows} tiles of {dzi_file} at level {level} ({width}x{height})...')
+                with metrics.span('stitch', file=paint_file, tiles=cols * rows):
+                    stitch_level(dzi, level, paint_file, workers, streaming=True)
+                print(f'Saved {paint_file}')
+                written_files.append(paint_file)
+            continue
+
+        print(f'Downloading {cols * rows} tiles of {dzi_file} at level {level} ({width}x{height})...')
+        with metrics.span('stitch', file=dzi_file, tiles=cols * rows):
+            image = stitch_image(dzi, level, workers)
+        for paint_file, max_size in level_outputs:
+            output = image
+            if max_size is not None and max(width, height) > max_size:
+                output = image.copy()
+                output.thumbnail((max_size, max_size), Image.LANCZOS)
+            save_image(output, paint_file)
+            print(f'Saved {paint_file} ({output.width}x{output.height})')
+            written_files.append(paint_file)
+
+    return written_files
+
+################################################################
+## streaming tiff writer
+################################################################
+
+# tiff field types
+SHORT = 3
+LONG = 4
+LONG8 = 16
+
+# write an uncompressed rgb tiff strip by strip
+# the ifd is written after the pixel data, so nothing needs to be kept in memory;
+# bigtiff is used when the pixel data does not fit in 4 GB
+class TiffWriter:
+    def __init__(self, filename, width, height, rows_per_strip):
+        self.width = width
+        self.height = height
+        self.rows_per_strip = rows_per_strip
+        self.strip_offsets = []
+        self.strip_byte_counts = []
+        self.bigtiff = width * height * 3 > 2 ** 32 - 2 ** 24
+        self.file = open(filename, 'wb')
+        if self.bigtiff:
+            self.file.write(b'II' + struct.pack('<HHHQ', 43, 8, 0, 0))
+        else:
+            self.file.write(b'II' + struct.pack('<HI', 42, 0))
+
+    def write_strip(self, data):
+        self.strip_offsets.append(self.file.tell())
+        self.strip_byte_counts.append(len(data))
+        self.file.write(data)
+
+    def close(self):
+        if self.file.closed: return
+        offset_type = LONG8 if self.bigtiff else LONG
+        entries = [
+            (256, LONG, [self.width]),
+            (257, LONG, [self.height]),
+            (258, SHORT, [8, 8, 8]),
+            (259, SHORT, [1]),
+            (262, SHORT, [2]),
+            (273, offset_type, self.strip_offsets),
+            (277, SHORT, [3]),
+            (278, LONG, [self.rows_per_strip]),
+            (279, offset_type, self.strip_byte_counts),
+            (284, SHORT, [1])
+        ]
+        # (number of entries, entry count, value / offset) formats and inline value size
+        if self.bigtiff:
+            num_fmt, count_fmt, offset_fmt, inline_size = 'Q', 'Q', 'Q', 8
+        else:
+            num_fmt, count_fmt, offset_fmt, inline_size = 'H', 'I', 'I', 4
+        value_fmts = {SHORT: 'H', LONG: 'I', LONG8: 'Q'}
+
+        # the ifd starts on a word boundary
+        if self.file.tell() % 2 == 1: self.file.write(b'\0')
+        ifd_offset = self.file.tell()
+        ifd_size = struct.calcsize(f'<{num_fmt}') + len(entries) * struct.calcsize(f'<HH{count_fmt}{offset_fmt}') + struct.calcsize(f'<{offset_fmt}')
+
+        # values that do not fit in an entry are stored after the ifd
+        ifd = struct.pack(f'<{num_fmt}', len(entries))
+        extra = b''
+        for tag, type, values in entries:
+            value = struct.pack(f'<{len(values)}{value_fmts[type]}', *values)
+            if len(value) > inline_size:
+                field = struct.pack(f'<{offset_fmt}', ifd_offset + ifd_size + len(extra))
+                extra += value
+            else:
+                field = value.ljust(inline_size, b'\0')
+            ifd += struct.pack(f'<HH{count_fmt}', tag, type, len(values)) + field
+        ifd += struct.pack(f'<{offset_fmt}', 0)
+
+        self.file.write(ifd + extra)
+        # point the header to the ifd
+        self.file.seek(8 if self.bigtiff else 4)
+        self.file.write(struct.pack(f'<{offset_fmt}', ifd_offset))
+        self.file.close()
@@ -1,57 +1,379 @@
-import pandas as pd
 import subprocess
+import threading
 import os
 import sys
-import re
-import glob
+from concurrent.futures import ThreadPoolExecutor
 from generate_dzi import generate_dzi_file, get_info
+import http_client
+import deepzoom
+import tile_cache
+import rate_limit
+import metrics
+import sources
+import manifest
+from catalog import open_catalog
+from identity import IdentityIndex
 
-def download_image(website, paint_id, info=None, download_largest=True):
-    # check if dzi files exist
-    # note that there may be multiple dzi files for an album
-    dzi_files = glob.glob(f'paintings/{paint_id}*.dzi')
-    if len(dzi_files) == 0:
-        try:
-            generate_dzi_file(website, paint_id, info=info)
-        except Exception as e:
-            print(f'Failed to generate dzi files for painting {paint_id}: {e}')
-            # clean files
-            dzi_files = glob.glob(f'paintings/{paint_id}*.dzi')
-            for dzi_file in dzi_files: os.remove(dzi_file)
-            return
+# global cap on the number of dezoomify-rs processes running at the same time
+max_dezoomify_processes = 2
+dezoomify_slots = threading.BoundedSemaphore(max_dezoomify_processes)
+
+def set_max_processes(max_processes):
+    global dezoomify_slots, max_dezoomify_processes
+    max_dezoomify_processes = max_processes
+    dezoomify_slots = threading.BoundedSemaphore(max_processes)
+
+# generate the dzi files of a painting if they do not exist yet
+# returns an empty list if the dzi files cannot be generated
+def prepare_dzi_files(website, paint_id, info=None):
+    dzi_files = get_existing_dzi_files(paint_id)
+    if len(dzi_files) > 0: return dzi_files
+
+    try:
+        return generate_dzi_file(website, paint_id, info=info)
+    except Exception as e:
+        print(f'Failed to generate dzi files for painting {paint_id}: {e}')
+        # clean files
+        for dzi_file in manifest.get_dzi_files(paint_id):
+            if os.path.exists(dzi_file): os.remove(dzi_file)
+        manifest.delete_dzi_files(paint_id)
+        return []
 
-    dzi_files = glob.glob(f'paintings/{paint_id}*.dzi')
-    format = re.search('Format="(\w+)"', open(dzi_files[0], 'r').read()).group(1)
+# the dzi files of a painting in the manifest, or an empty list if they are
+# not recorded or some of them are missing
+# note that there may be multiple dzi files for an album
+def get_existing_dzi_files(paint_id):
+    dzi_files = manifest.get_dzi_files(paint_id)
+    if not all(os.path.exists(dzi_file) for dzi_file in dzi_files): return []
+    return dzi_files
+
+# the steps to download the images described by the dzi files of a painting,
+# shared by download_dzi_files() and async_api.download(), as tuples of
+# - ('export', dzi_file, outputs): sizes exported with deepzoom.export_dzi()
+# - ('native', dzi_file, (paint_file, level, streaming)): an image to submit to the tile queue
+# - ('dezoomify', dzi_file, (paint_file, command)): a dezoomify-rs process to run
+# images already in the manifest are skipped, and partial files left behind by
+# an interrupted download are removed
+def get_download_steps(dzi_files, download_largest=True, backend='dezoomify', sizes=None):
+    if not backend in ['dezoomify', 'native']:
+        raise ValueError(f'Unknown backend: {backend}')
+    if len(dzi_files) == 0: return []
+    steps = []
+    format = manifest.get_dzi_format(dzi_files[0])
 
     for dzi_file in dzi_files:
-        paint_file = dzi_file.replace('.dzi', f'.{format}')
+        largest = download_largest
+        if sizes is not None:
+            outputs = get_export_outputs(dzi_file, format, sizes, backend)
+            if len(outputs) > 0: steps.append(('export', dzi_file, outputs))
+            if not (None in sizes and backend == 'dezoomify'): continue
+            largest = True
+
+        paint_file, level, streaming = get_download_target(dzi_file, format, largest, backend)
 
         # check if image already exists
-        if os.path.exists(paint_file):
+        if manifest.has_output(paint_file):
+            print(f'Painting {paint_file} already exists.')
+            continue
+        remove_partial_file(paint_file)
+
+        if backend == 'native':
+            steps.append(('native', dzi_file, (paint_file, level, streaming)))
+        else:
+            steps.append(('dezoomify', dzi_file, (paint_file, get_dezoomify_command(dzi_file, paint_file, largest))))
+    return steps
+
+def record_outputs(paint_files):
+    for paint_file in paint_files: manifest.put_output(paint_file)
+
+# wait for the images submitted to the tile queue, as (dzi_file, paint_file, job),
+# recording the completed ones; returns the dzi files that failed
+def wait_jobs(jobs):
+    failed_files = []
+    for dzi_file, paint_file, job in jobs:
+        try:
+            job.wait()
+            manifest.put_output(paint_file)
+        except Exception as e:
+            print(f'Failed to download {dzi_file}: {e}')
+            metrics.count('failures')
+            failed_files.append(dzi_file)
+    return failed_files
+
+def raise_failures(failed_files):
+    if len(failed_files) > 0:
+        raise ValueError(f'Failed to download {", ".join(failed_files)}')
+
+# download the images described by the dzi files of a painting
+# `backend` is either 'dezoomify' (dezoomify-rs) or 'native' (deepzoom.py)
+# with the native backend, the tiles of all leaves (and of the paintings
+# downloaded by other threads) go through the global tile queue of deepzoom.py
+# with `sizes` (maximum sizes of the longer side, None for the full resolution),
+# one image is saved per size, see get_export_outputs()
+def download_dzi_files(dzi_files, download_largest=True, backend='dezoomify', sizes=None):
+    failed_files = []
+    jobs = []
+
+    try:
+        for step, dzi_file, target in get_download_steps(dzi_files, download_largest, backend, sizes):
+            if step == 'export':
+                record_outputs(deepzoom.export_dzi(dzi_file, target))
+            elif step == 'native':
+                paint_file, level, streaming = target
+                jobs.append((dzi_file, paint_file, deepzoom.get_tile_queue().submit(dzi_file, paint_file, level=level, streaming=streaming)))
+            else:
+                paint_file, command = target
+                with dezoomify_slots:
+                    with metrics.span('dezoomify', file=paint_file):
+                        result = subprocess.run(command)
+                if result.returncode != 0:
+                    metrics.count('failures')
+                    failed_files.append(dzi_file)
+                else:
+                    manifest.put_output(paint_file)
+    except Exception:
+        # the leaves already queued are finished and recorded before giving up
+        wait_jobs(jobs)
+        raise
+
+    # wait for the leaves downloaded through the tile queue
+    failed_files += wait_jobs(jobs)
+    raise_failures(failed_files)
+
+# output file of an image resized to `max_size` (None for the full resolution)
+def get_sized_file(paint_file, max_size):
+    if max_size is None: return paint_file
+    base, extension = os.path.splitext(paint_file)
+    return f'{base}_{max_size}{extension}'
+
+# the files (mapped to their maximum size) to export from the pyramid levels of
+# a dzi file with deepzoom.export_dzi(), which fetches each level only once
+# the full resolution is left to dezoomify-rs when it is the backend
+# existing outputs (possibly streamed to tiff) are skipped
+def get_export_outputs(dzi_file, format, sizes, backend='dezoomify'):
+    outputs = {}
+    for max_size in sizes:
+        if max_size is None and backend == 'dezoomify': continue
+        paint_file = get_sized_file(dzi_file.replace('.dzi', f'.{format}'), max_size)
+        if manifest.has_output(paint_file) or manifest.has_output(os.path.splitext(paint_file)[0] + '.tif'):
             print(f'Painting {paint_file} already exists.')
             continue
+        outputs[paint_file] = max_size
+    return outputs
 
-        # dezoomify-rs
-        dezoomify = os.environ.get('DEZOOMIFY_RS')
-        if dezoomify is None: dezoomify = 'dezoomify-rs'
+# parse sizes such as 'full,4096,256'
+def parse_sizes(text):
+    sizes = []
+    for size in text.split(','):
+        size = size.strip()
+        if size == 'full':
+            sizes.append(None)
+        elif size.isdigit() and int(size) > 0:
+            sizes.append(int(size))
+        else:
+            raise ValueError(f'Invalid size: {size}')
+    return sizes
 
-        command = f'{dezoomify} --dezoomer deepzoom "{dzi_file}" --header "Referer: https://www.dpm.org.cn" --retries 1 {"--largest " if download_largest else ""}{paint_file}'
-        subprocess.run(command, shell=True)
+# an image on disk that is not in the manifest was left behind by an
+# interrupted download; remove it so that dezoomify-rs does not skip it
+def remove_partial_file(paint_file):
+    if os.path.exists(paint_file):
+        print(f'Removing incomplete painting {paint_file}')
+        os.remove(paint_file)
 
-def download_all(website):
-    # read painting ids from csv
-    df = pd.read_csv('paintings.csv')
+# output file of a dzi file, and for the native backend the level to download
+# and whether the image is streamed to a tiff file
+def get_download_target(dzi_file, format, download_largest=True, backend='dezoomify'):
+    paint_file = dzi_file.replace('.dzi', f'.{format}')
+    level, streaming = None, False
+    if backend == 'native':
+        # the native backend downloads the largest level unless told otherwise
+        dzi = deepzoom.read_dzi_file(dzi_file)
+        level = deepzoom.get_max_level(dzi) if download_largest else deepzoom.get_max_level(dzi) - 1
+        # huge images are streamed to a tiff file to keep memory use bounded
+        streaming = deepzoom.needs_streaming(dzi, level)
+        if streaming: paint_file = dzi_file.replace('.dzi', '.tif')
+    return paint_file, level, streaming
+
+# arguments of the dezoomify-rs process downloading a dzi file
+def get_dezoomify_command(dzi_file, paint_file, download_largest=True):
+    dezoomify = os.environ.get('DEZOOMIFY_RS')
+    if dezoomify is None: dezoomify = 'dezoomify-rs'
+
+    command = [dezoomify, '--dezoomer', 'deepzoom', dzi_file, '--header', 'Referer: https://www.dpm.org.cn', '--retries', str(http_client.settings['retries'])]
+
+    # let dezoomify-rs keep its tiles so that an interrupted download can be resumed
+    if tile_cache.settings['enabled']:
+        command += ['--tile-cache', tile_cache.settings['dezoomify_dir']]
+
+    # share the rate of the tile host between the dezoomify-rs processes
+    if rate_limit.settings['enabled']:
+        tile_url = deepzoom.read_dzi_file(dzi_file)['url']
+        min_interval = rate_limit.get_min_interval(tile_url, max_dezoomify_processes)
+        command += ['--min-interval', f'{int(min_interval * 1000)}ms']
+
+    if download_largest: command.append('--largest')
+    command.append(paint_file)
+    return command
+
+def download_image(website, paint_id, info=None, download_largest=True, backend='dezoomify', sizes=None):
+    dzi_files = prepare_dzi_files(website, paint_id, info=info)
+    download_dzi_files(dzi_files, download_largest=download_largest, backend=backend, sizes=sizes)
+
+# download all paintings in paintings.csv
+# dzi files of upcoming paintings are generated by `dzi_workers` threads while
+# `download_workers` threads download the paintings whose dzi files are ready,
+# with at most `max_processes` dezoomify-rs processes running at once
+# with the native backend, the tiles of the paintings being downloaded share
+# `tile_workers` threads (see deepzoom.TileQueue)
+# with `catalog`, paintings not downloaded yet are read from the sqlite catalog
+# and their status is updated as they move through the stages
+# with `dedup` (requires `catalog`), paintings also listed on another website
+# are only downloaded from the website with the highest resolution, see
+# identity.IdentityIndex; the others are marked as 'duplicate'
+# `source` replaces paintings.csv (or the catalog) with another csv file ('-'
+# for stdin) or an iterable of ids; it is read lazily in chunks, keeping only
+# the paintings of `shard` (index, count) that match `filters`, see sources.py
+def download_all(website, dzi_workers=4, download_workers=2, max_processes=None, download_largest=True, backend='dezoomify', catalog=None, sizes=None, tile_workers=None, dedup=False, source=None, shard=None, filters=None):
+    catalog = open_catalog(catalog)
+    identity_index = None
+    if dedup:
+        if catalog is None:
+            raise ValueError('Deduplication requires a catalog')
+        identity_index = IdentityIndex(catalog.path)
+        identity_index.build(catalog)
+    if source is None and catalog is not None:
+        source = catalog.iter_chunks(website, status=['listed', 'enriched', 'dzi-generated', 'failed'], chunksize=sources.chunksize)
+    elif source is None:
+        # read painting ids from csv
+        source = 'paintings.csv'
+    paint_ids = sources.iter_paint_ids(source, shard=shard, filters=filters, site=website)
+
+    # record the status of a painting in the catalog
+    def set_status(paint_id, status, error=None):
+        if catalog is None: return
+        catalog.set_status(website, paint_id, status, error=error)
+        if status == 'failed' and dedup: catalog.revive_duplicates(website, paint_id)
 
     info = get_info(website)
-    for index, row in df.iterrows():
-        paint_id = row['id']
-        print(f'Painting {paint_id} ({index + 1}/{len(df)}) ...')
-        download_image(website, paint_id, info=info, download_largest=True)
+    set_max_processes(max_processes or download_workers)
+    if tile_workers is not None: deepzoom.set_tile_workers(tile_workers)
+    http_client.ensure_pool_size(dzi_workers)
+
+    # limit the number of paintings scheduled ahead of the downloads
+    window_size = 2 * (dzi_workers + download_workers)
+    window = threading.BoundedSemaphore(window_size)
+
+    with ThreadPoolExecutor(max_workers=dzi_workers) as dzi_pool, \
+         ThreadPoolExecutor(max_workers=download_workers) as download_pool:
+
+        def download(paint_id, dzi_files):
+            try:
+                download_dzi_files(dzi_files, download_largest=download_largest, backend=backend, sizes=sizes)
+                set_status(paint_id, 'downloaded')
+            except Exception as e:
+                print(f'Failed to download painting {paint_id}: {e}')
+                set_status(paint_id, 'failed', error=str(e))
+            finally:
+                window.release()
+
+        # generate the dzi files and find the best source of the painting
+        def prepare(paint_id):
+            dzi_files = prepare_dzi_files(website, paint_id, info)
+            best_source = (website, str(paint_id))
+            if identity_index is not None and len(dzi_files) > 0:
+                identity_index.record_dzi_files(website, paint_id, dzi_files)
+                best_source = identity_index.get_best_source(website, paint_id, catalog, fetch_missing=True)
+            return dzi_files, best_source
+
+        # hand the painting over to the download stage once its dzi files are ready
+        # this runs as a done callback, whose exceptions would be swallowed, so
+        # the window slot is released on every path that does not reach download()
+        def schedule_download(paint_id, future):
+            handed_over = False
+            try:
+                try:
+                    dzi_files, best_source = future.result()
+                except Exception as e:
+                    print(f'Failed to generate dzi files for painting {paint_id}: {e}')
+                    dzi_files = []
+                if len(dzi_files) == 0:
+                    set_status(paint_id, 'failed', error='Failed to generate dzi files')
+                    return
+                if best_source != (website, str(paint_id)):
+                    print(f'Skipping painting {paint_id}, which is downloaded from {best_source[0]} ({best_source[1]})')
+                    set_status(paint_id, 'duplicate', error=f'{best_source[0]}:{best_source[1]}')
+                    return
+                set_status(paint_id, 'dzi-generated')
+                download_pool.submit(download, paint_id, dzi_files)
+                handed_over = True
+            except Exception as e:
+                print(f'Failed to schedule painting {paint_id}: {e}')
+            finally:
+                if not handed_over: window.release()
+
+        for index, paint_id in enumerate(paint_ids):
+            window.acquire()
+            print(f'Painting {paint_id} ({index + 1}) ...')
+            future = dzi_pool.submit(prepare, paint_id)
+            future.add_done_callback(lambda future, paint_id=paint_id: schedule_download(paint_id, future))
+
+        # wait for all scheduled paintings to finish
+        for _ in range(window_size): window.acquire()
+
+    metrics.export()
+
+# remove an option and its value from the command line arguments
+def pop_option(name):
+    if not name in sys.argv: return None
+    value = sys.argv.pop(sys.argv.index(name) + 1)
+    sys.argv.remove(name)
+    return value
 
 if __name__ == '__main__':
+    # read paintings from the sqlite catalog instead of paintings.csv
+    catalog = pop_option('--db')
+    # skip paintings with a better copy on another website (requires --db)
+    dedup = '--dedup' in sys.argv
+    if dedup: sys.argv.remove('--dedup')
+    # keep the files of each painting in one of 256 subdirectories
+    if '--sharded' in sys.argv:
+        sys.argv.remove('--sharded')
+        manifest.configure(sharded=True)
+    # save several sizes of each image, e.g. --sizes full,4096,256
+    sizes = None
+    if '--sizes' in sys.argv:
+        sizes = parse_sizes(sys.argv.pop(sys.argv.index('--sizes') + 1))
+        sys.argv.remove('--sizes')
+    # read paintings from another csv file ('-' for stdin), or ids from a file
+    # with one id per line ('-' for stdin)
+    source = pop_option('--csv')
+    ids_file = pop_option('--ids')
+    if ids_file is not None: source = sources.read_id_file(ids_file)
+    # only download one shard of the paintings, e.g. --shard 0/4 on the first of four machines
+    shard = pop_option('--shard')
+    if shard is not None: shard = sources.parse_shard(shard)
+    # only download the paintings matching the filters
+    filters = {key: pop_option(f'--{key}') for key in sources.filter_columns}
+    for key in ['min_size', 'max_size']:
+        value = pop_option(f'--{key.replace("_", "-")}')
+        filters[key] = float(value) if value is not None else None
+
+    # download the images with dezoomify-rs (default) or natively
+    backend = pop_option('--backend') or 'dezoomify'
+    if not backend in ['dezoomify', 'native']:
+        raise ValueError(f'Unknown backend {backend}')
+
     website = sys.argv[1]
+    # number of threads generating dzi files and downloading paintings
+    dzi_workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    download_workers = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+    # maximum number of dezoomify-rs processes running at once
+    max_processes = int(sys.argv[4]) if len(sys.argv) > 4 else None
 
     # create directory if not exists
     if not os.path.exists('paintings'): os.makedirs('paintings')
 
-    download_all(website)
\ No newline at end of file
+    with metrics.profile():
+        download_all(website, dzi_workers=dzi_workers, download_workers=download_workers, max_processes=max_processes, backend=backend, catalog=catalog, sizes=sizes, dedup=dedup, source=source, shard=shard, filters=filters)
+    metrics.print_summary()
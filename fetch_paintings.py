@@ -1,21 +1,30 @@
-import requests
 import re
-from bs4 import BeautifulSoup
 import pandas as pd
 import os
 import sys
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
+import http_client
+from parsing import make_soup, only_tag, only_class
+from site_urls import token_urls, list_urls, detail_urls
+from catalog import open_catalog
+from normalize import normalize_details, derived_columns
+import metrics
 
 ################################################################
 ## Minghua Ji (https://minghuaji.dpm.org.cn/)
 ################################################################
 
 def get_xsrf_token():
-    url = 'https://minghuaji.dpm.org.cn/paint/list'
-    response = requests.get(url)
+    url = token_urls['mhj']
+    response = http_client.get(url)
     headers = response.headers
     cookie = headers["set-cookie"]
+    return parse_xsrf_token(cookie, url)
 
-    # obtain the xsrf token from the cookie
+# obtain the xsrf token from the cookie
+def parse_xsrf_token(cookie, url):
     match = re.search(r'XSRF-TOKEN=(.*?);', cookie)
     if match:
         token = match.group(1)
@@ -24,27 +33,28 @@ def get_xsrf_token():
         raise ValueError(f'Cannot find xsrf token in response headers from {url}')
 
 def fetch_page_mhj(page, xsrf_token):
-    url = f'https://minghuaji.dpm.org.cn/paint/queryList?page={page}&showType=0'
+    url = list_urls['mhj'].format(page=page)
     headers = {
-        'Connection': 'keep-alive',
         'Cookie': f'XSRF-TOKEN={xsrf_token}',
         'X-XSRF-TOKEN': xsrf_token
     }
 
-    res = requests.post(url, headers=headers)
+    res = http_client.post(url, headers=headers)
     # check for successful request
     if res.status_code != 200:
         raise ValueError(f'Encountered error when visiting {url}: {res.status_code}')
 
-    # parse the response text and extract painting info
-    html_string = res.text
-    soup = BeautifulSoup(html_string, 'html.parser')
+    return parse_page_mhj(res.text)
+
+# parse the response text and extract painting info
+def parse_page_mhj(html_string):
+    soup = make_soup(html_string, parse_only=only_tag('li'))
     paint_items = soup.find_all('li')
 
     paintings = []
 
     for paint_item in paint_items:
-        img_box = paint_item.select_one('.img_box')
+        img_box = paint_item.find(class_='img_box')
         if img_box is None: continue
         author = img_box.get('tagauthor')
         dynasty = img_box.get('tagdynasty')
@@ -62,56 +72,25 @@ def fetch_page_mhj(page, xsrf_token):
 
 # obtain more details about a specific painting
 def fetch_detail_mhj(id):
-    url = f'https://minghuaji.dpm.org.cn/paint/detail?id={id}'
+    url = detail_urls['mhj'].format(paint_id=id)
 
-    res = requests.get(url)
+    res = http_client.get(url)
     # check for successful request
     if res.status_code != 200:
         raise ValueError(f'Encountered error when visiting {url}: {res.status_code}')
 
-    # parse the response text and extract painting info
-    html_string = res.text
-    soup = BeautifulSoup(html_string, 'html.parser')
-    info = soup.select_one('.pf_main').select_one('h3')
-    splitted = [x.strip() for x in info.text.split('，')]
-
-    # extract details
-    if splitted[2][0] == '纵':
-        material = ''
-        color = ''
-        height = splitted[2]
-        width = splitted[3]
-    elif splitted[3][0] == '纵':
-        material = splitted[2]
-        color = ''
-        height = splitted[3]
-        width = splitted[4]
-    elif splitted[4][0] == '纵':
-        material = splitted[2]
-        color = splitted[3]
-        height = splitted[4]
-        width = splitted[5]
-    elif splitted[5][0] == '纵':
-        material = splitted[2]
-        color = f'{splitted[3]}，{splitted[4]}'
-        height = splitted[5]
-        width = splitted[6]
-
-    # check width and height
-    if height[0] != '纵': raise ValueError(f'Cannot find height in {info.text}')
-    if width[0] != '横': raise ValueError(f'Cannot find width in {info.text}')
-
-    # extract the numbers
-    height = float(re.findall('[\d\.,]+',height)[0].replace(',',''))
-    width = float(re.findall('[\d\.,]+',width)[0].replace(',',''))
-
-    print(f'id: {id}, material: {material}, color: {color}, height: {height}, width: {width}')
+    return parse_detail_mhj(id, res.text)
+
+# parse the response text and extract the detail text
+# material, color, height and width are derived from it by normalize.py
+def parse_detail_mhj(id, html_string):
+    soup = make_soup(html_string, parse_only=only_class('pf_main'))
+    text = soup.find(class_='pf_main').find('h3').text.strip()
+
+    print(f'id: {id}, detail: {text}')
 
     return {
-        'material': material,
-        'color': color,
-        'height': height,
-        'width': width
+        'detail_text': text
     }
 
 ################################################################
@@ -119,28 +98,31 @@ def fetch_detail_mhj(id):
 ################################################################
 
 def fetch_page_collection(page):
-    url = f'https://www.dpm.org.cn/searchs/paints/category_id/91/p/{page}.html'
+    url = list_urls['collection'].format(page=page)
 
-    res = requests.post(url)
+    res = http_client.post(url)
     # check for successful request
     if res.status_code != 200:
         raise ValueError(f'Encountered error when visiting {url}: {res.status_code}')
 
-    # parse the response text and extract painting info
-    html_string = res.text
-    soup = BeautifulSoup(html_string, 'html.parser')
-    paint_items = soup.select_one('.table1').find_all('tr')[1:]
+    return parse_page_collection(res.text)
+
+# parse the response text and extract painting info
+def parse_page_collection(html_string):
+    soup = make_soup(html_string, parse_only=only_class('table1'))
+    paint_items = soup.find(class_='table1').find_all('tr')[1:]
 
     if len(paint_items) <=1: return []
 
     paintings = []
 
     for paint_item in paint_items:
-        paint_id = paint_item.select_one('td:nth-child(1)').select_one('a').get('href').split('/')[-1].split('.')[0]
-        name = paint_item.select_one('td:nth-child(1)').text.strip()
-        dynasty = paint_item.select_one('td:nth-child(2)').text.strip()
-        category = paint_item.select_one('td:nth-child(3)').text.strip()
-        author = paint_item.select_one('td:nth-child(4)').text.strip()
+        cells = paint_item.find_all('td', recursive=False)
+        paint_id = cells[0].find('a').get('href').split('/')[-1].split('.')[0]
+        name = cells[0].text.strip()
+        dynasty = cells[1].text.strip()
+        category = cells[2].text.strip()
+        author = cells[3].text.strip()
         print(f'{paint_id} {name} {author} {dynasty}')
         paintings.append({
             'id': paint_id,
@@ -154,27 +136,27 @@ def fetch_page_collection(page):
 
 # obtain more details about a specific painting
 def fetch_detail_collection(id):
-    url = f'https://www.dpm.org.cn/collection/paint/{id}.html'
+    url = detail_urls['collection'].format(paint_id=id)
 
-    res = requests.get(url)
+    res = http_client.get(url)
     # check for successful request
     if res.status_code != 200:
         raise ValueError(f'Encountered error when visiting {url}: {res.status_code}')
 
-    # parse the response text and extract painting info
-    html_string = res.text
-    soup = BeautifulSoup(html_string, 'html.parser')
+    return parse_detail_collection(id, res.text)
+
+# parse the response text and extract painting info
+def parse_detail_collection(id, html_string):
+    soup = make_soup(html_string)
 
     # extract minghuaji id
-    links = soup.find_all('a')
+    link = soup.find('a', href=re.compile('minghuaji.dpm.org.cn/paint'))
     mhj_id = ''
-    for link in links:
-        if link.get('href') and 'minghuaji.dpm.org.cn/paint' in link.get('href'):
-            mhj_id = link.get('href').split('=')[-1]
-            break
+    if link is not None:
+        mhj_id = link.get('href').split('=')[-1]
 
     # extract inventory number
-    scripts = soup.find_all('script')
+    scripts = soup.find_all('script', string=re.compile('objno'))
     inventory_id = ''
     for script in scripts:
         if 'objno' in script.text:
@@ -185,126 +167,386 @@ def fetch_detail_collection(id):
                 text = script.text.replace(' ','')
             inventory_id = re.search('objno="([^"]+?)"', text).group(1)
 
-    # extract details
-    info = soup.select_one('.content_edit')
+    # extract details (material, color, height and width are derived by normalize.py)
+    info = soup.find(class_='content_edit')
     # fix encoding issue
     try:
-        text = info.text.encode('latin-1').decode('utf-8').replace(' ','')
+        text = info.text.encode('latin-1').decode('utf-8').strip()
     except:
-        text = info.text.replace(' ', '')
-    materials = ['绢本', '纸本', '金笺']
-    colors = ['设色', '淡设色', '水墨', '墨笔']
+        text = info.text.strip()
 
-    material = ''
-    material_match = re.search(f'({"|".join(materials)})[，。]', text)
-    if material_match is not None: material = material_match.group(1)
+    print(f'id: {id}, mhj_id: {mhj_id}, inventory_id: {inventory_id}, detail: {text}')
+
+    return {
+        'mhj_id': mhj_id,
+        'inventory_id': inventory_id,
+        'detail_text': text
+    }
+
+################################################################
+## Digital Catalog (https://digicol.dpm.org.cn/)
+################################################################
+
+# category of paintings in the catalog search and the number of items per page
+digicol_category = '1'
+digicol_page_size = 20
+
+def fetch_page_digicol(page):
+    url = list_urls['digicol']
+    data = {
+        'page': page,
+        'size': digicol_page_size,
+        'cateList': digicol_category
+    }
+
+    res = http_client.post(url, data=data)
+    # check for successful request
+    if res.status_code != 200:
+        raise ValueError(f'Encountered error when visiting {url}: {res.status_code}')
+
+    return parse_page_digicol(res.text)
+
+# parse the json response and extract painting info
+def parse_page_digicol(json_string):
+    paint_items = json.loads(json_string).get('rows') or []
+
+    paintings = []
+
+    for paint_item in paint_items:
+        paint_id = paint_item.get('uuid')
+        if not paint_id: continue
+        name = (paint_item.get('name') or '').strip()
+        author = (paint_item.get('author') or '').strip()
+        dynasty = (paint_item.get('dynastyName') or '').strip()
+        inventory_id = (paint_item.get('culturalRelicNo') or '').strip()
+        print(f'{paint_id} {name} {author} {dynasty}')
+        paintings.append({
+            'id': paint_id,
+            'name': name,
+            'author': author,
+            'dynasty': dynasty,
+            'inventory_id': inventory_id
+        })
+
+    return paintings
+
+# obtain more details about a specific painting
+def fetch_detail_digicol(id):
+    url = detail_urls['digicol'].format(paint_id=id)
 
-    color = ''
-    color_match = re.search(f'[，。]({"|".join(colors)})[，。]', text)
-    if color_match is not None: color = color_match.group(1)
+    res = http_client.get(url)
+    # check for successful request
+    if res.status_code != 200:
+        raise ValueError(f'Encountered error when visiting {url}: {res.status_code}')
 
-    height = ''
-    height_match = re.search('[，。]纵([\d\.,]+)厘米', text)
-    if height_match is not None: height = float(height_match.group(1).replace(',',''))
+    return parse_detail_digicol(id, res.text)
 
-    width = ''
-    width_match = re.search('[，。]横([\d\.,]+)厘米', text)
-    if width_match is not None: width = float(width_match.group(1).replace(',',''))
+# parse the response text and extract the detail text
+# (material, color, height and width are derived by normalize.py)
+def parse_detail_digicol(id, html_string):
+    soup = make_soup(html_string, parse_only=only_class('info_table'))
+    info = soup.find(class_='info_table')
+    if info is None:
+        raise ValueError(f'Cannot find details of painting {id}')
+    # keep the values of the 'label：value' items
+    # only the text of each item itself is used, since html.parser nests the
+    # following items into an unclosed <li>
+    items = info.find_all('li')
+    texts = [''.join(text.strip() for text in item.find_all(string=True) if text.find_parent('li') is item) for item in items]
+    text = '，'.join(text.split('：')[-1] for text in texts) + '。'
 
-    print(f'id: {id}, mhj_id: {mhj_id}, inventory_id: {inventory_id}, material: {material}, color: {color}, height: {height}, width: {width}')
+    print(f'id: {id}, detail: {text}')
 
     return {
-        'mhj_id': mhj_id,
-        'inventory_id': inventory_id,
-        'material': material,
-        'color': color,
-        'height': height,
-        'width': width
+        'detail_text': text
     }
 
 ################################################################
 ## common functions
 ################################################################
 
+# fetch listing pages concurrently with up to `workers` pages in flight
+# pages ahead of the current one are fetched speculatively, and the crawl stops
+# once an empty page is seen; the results are merged in page order
+# `should_stop` is called with the paintings of each page in page order and
+# can end the crawl early by returning True
+# `on_page` is called with the paintings of each page as soon as it is fetched
+def fetch_pages(fetch_page, start_page=1, workers=8, should_stop=None, on_page=None):
+    results = {}
+    end_page = None # first page that is not part of the result
+    next_page = start_page
+    next_checked = start_page # first page not yet passed to should_stop
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+        while True:
+            # keep the pool busy with pages before the known end of the list
+            while len(pending) < workers and (end_page is None or next_page < end_page):
+                pending[executor.submit(fetch_page, next_page)] = next_page
+                next_page += 1
+            if len(pending) == 0: break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                page = pending.pop(future)
+                try:
+                    paintings = future.result()
+                except Exception:
+                    for other in pending: other.cancel()
+                    raise
+                if len(paintings) == 0:
+                    # reach the end of the list
+                    if end_page is None or page < end_page: end_page = page
+                else:
+                    results[page] = paintings
+                    if on_page is not None: on_page(paintings)
+
+            # check the fetched pages in page order
+            while should_stop is not None and next_checked in results and (end_page is None or next_checked < end_page):
+                if should_stop(results[next_checked]): end_page = next_checked + 1
+                next_checked += 1
+
+    # drop speculative pages fetched beyond the end of the list
+    paintings = []
+    for page in sorted(results):
+        if end_page is not None and page >= end_page: continue
+        paintings += results[page]
+
+    return paintings
+
+# get a function fetching the listing page of a website by page number
+def get_page_fetcher(website):
+    if website == 'mhj': xsrf_token = get_xsrf_token()
+
+    def fetch_page(page):
+        print(f'Fetching page {page}...')
+        if website == 'mhj':
+            return fetch_page_mhj(page, xsrf_token)
+        elif website == 'collection':
+            return fetch_page_collection(page)
+        elif website == 'digicol':
+            return fetch_page_digicol(page)
+        else:
+            raise ValueError(f'Unknown website: {website}')
+
+    return fetch_page
+
+# get the function fetching the details of a painting, or None if the website has no details
+def get_detail_fetcher(website):
+    if website == 'mhj':
+        return fetch_detail_mhj
+    elif website == 'collection':
+        return fetch_detail_collection
+    elif website == 'digicol':
+        return fetch_detail_digicol
+    return None
+
+# crawl state of each website, used to report changes between runs
+state_file = 'crawl_state.json'
+
+def load_crawl_state():
+    if not os.path.exists(state_file): return {}
+    with open(state_file, 'r') as file:
+        return json.load(file)
+
+def save_crawl_state(state):
+    tmp_file = f'{state_file}.tmp'
+    with open(tmp_file, 'w') as file:
+        json.dump(state, file, indent=2, ensure_ascii=False)
+    os.replace(tmp_file, state_file)
+
 # fetch all pages and save to csv
-def fetch_all(website, start_page=1, details=False):
+# with `incremental`, the crawl stops after `known_run` consecutive paintings
+# that are already in the csv, so that only newly listed paintings are fetched;
+# removed paintings can only be detected by a full crawl
+# with `catalog` (a Catalog or the path to its database), paintings are stored
+# in the sqlite catalog instead of paintings.csv
+def fetch_all(website, start_page=1, details=False, workers=8, incremental=False, known_run=50, catalog=None):
     # read the existing csv if available, otherwise create a new one
     csv_file = 'paintings.csv'
     columns = {
         'mhj': ['id', 'name', 'author', 'dynasty'],
         'collection': ['id', 'name', 'author', 'dynasty', 'category'],
+        'digicol': ['id', 'name', 'author', 'dynasty', 'inventory_id'],
     }
     if not website in columns:
         raise ValueError(f'Unknown website: {website}')
 
-    if os.path.exists(csv_file):
-        df = pd.read_csv(csv_file)
+    catalog = open_catalog(catalog)
+    if catalog is not None:
+        known_ids = set(catalog.get_ids(website))
     else:
-        df = pd.DataFrame(columns=columns[website])
+        if os.path.exists(csv_file):
+            # ids are kept as text, as the ids of the listed paintings
+            df = pd.read_csv(csv_file, dtype={'id': str})
+        else:
+            df = pd.DataFrame(columns=columns[website])
+        known_ids = set(df['id'].astype(str))
 
     # fetch all pages
-    if website == 'mhj': xsrf_token = get_xsrf_token()
-    page = start_page
-    while True:
-        print(f'Fetching page {page}...')
-        if website == 'mhj':
-            paintings = fetch_page_mhj(page, xsrf_token)
-        elif website == 'collection':
-            paintings = fetch_page_collection(page)
-
-        # reach the end of the list
-        if len(paintings) == 0: break
-
+    http_client.ensure_pool_size(workers)
+    fetch_website_page = get_page_fetcher(website)
+
+    pages_fetched = []
+    def fetch_page(page):
+        pages_fetched.append(page)
+        return fetch_website_page(page)
+
+    # stop once a run of already known paintings is found
+    known_count = 0
+    def reach_known(paintings):
+        nonlocal known_count
+        for painting in paintings:
+            known_count = known_count + 1 if str(painting['id']) in known_ids else 0
+        return known_count >= known_run
+
+    started_at = time.time()
+    paintings = fetch_pages(fetch_page, start_page=start_page, workers=workers, should_stop=reach_known if incremental else None)
+    listed_ids = [str(painting['id']) for painting in paintings]
+
+    # report the changes
+    added_ids = [paint_id for paint_id in dict.fromkeys(listed_ids) if not paint_id in known_ids]
+    removed_ids = []
+    if not incremental and start_page == 1:
+        removed_ids = sorted(known_ids - set(listed_ids))
+    print(f'{len(added_ids)} paintings added, {len(removed_ids)} paintings removed')
+    for paint_id in added_ids: print(f'Added: {paint_id}')
+    for paint_id in removed_ids: print(f'Removed: {paint_id}')
+
+    if catalog is not None:
+        # only the listed paintings are written
+        catalog.upsert(website, paintings)
+    else:
         # append the new paintings to the existing dataframe
-        df = pd.concat([df, pd.DataFrame(paintings)], ignore_index=True)
+        added = set(added_ids)
+        new_paintings = [painting for painting in paintings if str(painting['id']) in added]
+        if len(new_paintings) > 0:
+            new_df = pd.DataFrame(new_paintings)
+            new_df['id'] = new_df['id'].astype(str)
+            df = pd.concat([df, new_df], ignore_index=True)
+
+        # remove duplicates (a painting can be listed on two pages)
+        df = df.drop_duplicates(subset=['id'])
+
+        # save the dataframe to csv
+        save_csv(df, csv_file)
+
+    # save the crawl state
+    state = load_crawl_state()
+    state[website] = {
+        'mode': 'incremental' if incremental else 'full',
+        'started_at': started_at,
+        'finished_at': time.time(),
+        'start_page': start_page,
+        'pages_fetched': len(pages_fetched),
+        'paintings_listed': len(listed_ids),
+        'first_ids': listed_ids[:known_run],
+        'added_ids': added_ids,
+        'removed_ids': removed_ids
+    }
+    save_crawl_state(state)
 
-        # next page
-        page += 1
+    metrics.export()
+    if details: fetch_details(website, workers=workers, catalog=catalog)
 
-    # remove duplicates
-    df = df.drop_duplicates(subset=['id'])
+    return {'added': added_ids, 'removed': removed_ids}
 
-    # save the dataframe to csv
-    df.to_csv(csv_file, index=False)
-
-    if details: fetch_details(website)
+# write the dataframe to a temporary file first so that an interrupted save
+# never leaves a truncated csv behind
+def save_csv(df, csv_file):
+    tmp_file = f'{csv_file}.tmp'
+    df.to_csv(tmp_file, index=False)
+    os.replace(tmp_file, csv_file)
 
 # obtain more details for all paintings
-def fetch_details(website):
-    # read data
-    csv_file = 'paintings.csv'
-    if os.path.exists(csv_file):
-        df = pd.read_csv(csv_file)
-    else:
-        raise ValueError(f'Cannot find {csv_file}')
-
+# details are fetched by `workers` threads and the csv is saved after every
+# `checkpoint_every` paintings; rows whose detail columns are already filled
+# are skipped so that an interrupted run can be resumed
+# the raw detail text is stored, and material, color, height and width are
+# derived from each batch by normalize.normalize_details()
+# with `catalog`, details are written to the sqlite catalog instead
+def fetch_details(website, workers=8, checkpoint_every=100, catalog=None):
     # create new columns
     columns = {
-        'mhj': ['material', 'color', 'height', 'width'],
-        'collection': ['mhj_id', 'inventory_id', 'material', 'color', 'height', 'width']
+        'mhj': ['detail_text', *derived_columns],
+        'collection': ['mhj_id', 'inventory_id', 'detail_text', *derived_columns],
+        'digicol': ['detail_text', *derived_columns]
     }
     if not website in columns:
         raise ValueError(f'Unknown website: {website}')
 
-    for col in columns[website]:
-        if col not in df.columns: df[col] = ''
+    # read data
+    csv_file = 'paintings.csv'
+    catalog = open_catalog(catalog)
+    if catalog is not None:
+        # only fetch paintings without any details
+        pending = pd.Series(catalog.get_ids(website, status=['listed', 'failed'], missing=columns[website]))
+        total = sum(catalog.count(website).values())
+    else:
+        if os.path.exists(csv_file):
+            df = pd.read_csv(csv_file, dtype={'id': str})
+        else:
+            raise ValueError(f'Cannot find {csv_file}')
 
-    # fetch details for each painting
-    for idx, paint_id in df['id'].iteritems():
-        if website == 'mhj':
-            info = fetch_detail_mhj(paint_id)
-        elif website == 'collection':
-            info = fetch_detail_collection(paint_id)
         for col in columns[website]:
-            df.loc[idx, col] = info[col]
+            if col not in df.columns: df[col] = ''
+        df[columns[website]] = df[columns[website]].astype(object)
+
+        # only fetch paintings without any details
+        details = df[columns[website]]
+        pending = df.loc[(details.isna() | (details == '')).all(axis=1), 'id']
+        total = len(df)
+    print(f'Fetching details for {len(pending)} of {total} paintings...')
+
+    fetch_detail = get_detail_fetcher(website)
+
+    # apply the fetched details in bulk and save the csv (or the catalog)
+    results = {}
+    def checkpoint():
+        if len(results) > 0:
+            rows = normalize_details(pd.DataFrame.from_dict(results, orient='index'), website)[columns[website]]
+            results.clear()
+            if catalog is not None:
+                rows.insert(0, 'id', pending[rows.index].values)
+                catalog.upsert(website, rows.to_dict('records'), status='enriched')
+            else:
+                df.loc[rows.index, columns[website]] = rows.values
+        if catalog is None: save_csv(df, csv_file)
+
+    http_client.ensure_pool_size(workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(fetch_detail, paint_id): idx for idx, paint_id in pending.items()}
+        for count, future in enumerate(as_completed(futures), 1):
+            idx = futures[future]
+            try:
+                results[idx] = future.result()
+            except Exception as e:
+                # leave the row empty so that it is retried on the next run
+                print(f'Failed to fetch details for painting {pending[idx]}: {e}')
+                metrics.count('failures', site=website)
+                if catalog is not None: catalog.set_status(website, pending[idx], 'failed', error=str(e))
+            if count % checkpoint_every == 0: checkpoint()
 
     # save the dataframe to csv
-    df.to_csv(csv_file, index=False)
-
+    checkpoint()
+    metrics.export()
 
 if __name__ == '__main__':
+    # only fetch newly listed paintings
+    incremental = '--incremental' in sys.argv
+    if incremental: sys.argv.remove('--incremental')
+    # store paintings in the sqlite catalog instead of paintings.csv
+    catalog = None
+    if '--db' in sys.argv:
+        catalog = sys.argv.pop(sys.argv.index('--db') + 1)
+        sys.argv.remove('--db')
+
     website = sys.argv[1]
     # start from the specified page
     start_page = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    # number of listing pages fetched concurrently
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else 8
 
-    fetch_all(website=website, start_page=start_page, details=False)
\ No newline at end of file
+    with metrics.profile():
+        fetch_all(website=website, start_page=start_page, details=False, workers=workers, incremental=incremental, catalog=catalog)
+    metrics.print_summary()
\ No newline at end of file
@@ -1,14 +1,23 @@
 import base64
 from Crypto.Cipher import AES
 from Crypto.Util.Padding import unpad
-from bs4 import BeautifulSoup
 import xml.etree.ElementTree as ET
-import requests
+import http_client
+import metadata_cache
+import metrics
+import manifest
+from parsing import make_soup, only_tag, only_id
+from site_urls import paint_urls, image_urls, gv_urls
 import re
 import xml.dom.minidom
 import sys
 import os
 import pandas as pd
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# number of threads fetching the images (leaves) of one painting concurrently
+leaf_workers = 8
 
 ################################################################
 ## Minghua Ji (https://minghuaji.dpm.org.cn/)
@@ -16,11 +25,18 @@ import pandas as pd
 
 # get gv info from url (minghuaji)
 def get_info_mhj():
-    gv_url = 'https://minghuaji.dpm.org.cn/js/gve.js'
+    gv_url = gv_urls['mhj']
 
-    # get response from the url
-    res_text = get_text_from_url(gv_url)
+    # get response from the url (or the metadata cache)
+    res_text = metadata_cache.fetch_text(gv_url)
 
+    try:
+        return parse_info_mhj(gv_url, res_text)
+    except ValueError:
+        metadata_cache.delete(gv_url)
+        raise
+
+def parse_info_mhj(gv_url, res_text):
     # find all substrings surrounded by double quotes
     info = re.findall(r'"(.*?)"', res_text)
 
@@ -30,45 +46,39 @@ def get_info_mhj():
 
     return info
 
-# generate the dzi file
-def generate_dzi_file_mhj(paint_id, info=None):
-    paint_url = f'https://minghuaji.dpm.org.cn/paint/appreciate?id={paint_id}'
+# get the dzi info of all images of a painting
+def get_dzi_infos_mhj(paint_id, info=None):
+    paint_url = paint_urls['mhj'].format(paint_id=paint_id)
     html_string = get_text_from_url(paint_url)
-    soup = BeautifulSoup(html_string, 'html.parser')
-    image_items = soup.select_one('#gundong_id').find_all('li')
+    paint_detail_urls = get_leaf_urls_mhj(paint_url, html_string)
 
     # get info
     if info is None: info = get_info_mhj()
+    key, iv, xmlns, overlap = get_keys_mhj(info)
+
+    # fetch the encrypted strings of all leaves concurrently
+    encrypted_texts = fetch_all_urls(get_encrypted_text, paint_detail_urls)
+
+    return [make_dzi_info(decrypt(encrypted, key, iv), xmlns, overlap) for encrypted in encrypted_texts]
+
+# get the urls of the leaves listed on the appreciate page
+def get_leaf_urls_mhj(paint_url, html_string):
+    soup = make_soup(html_string, parse_only=only_id('gundong_id'))
+    image_items = soup.find(id='gundong_id').find_all('li')
+    return [f'{paint_url}&type={item.get("value")}' for item in image_items]
 
-    # get key and vi and use them to decrypt the encrypted string
+# get key and iv (used to decrypt the encrypted string), xmlns and overlap from gv info
+def get_keys_mhj(info):
     key = info2bytes(info[1])
     iv = info2bytes(info[4])
+    xmlns = info2bytes(info[28]).decode('utf-8')
+    overlap = info2bytes(info[29]).decode('utf-8')
+    return key, iv, xmlns, overlap
 
-    for idx, item in enumerate(image_items):
-        paint_detail_url = f'{paint_url}&type={item.get("value")}'
-
-        encrypted = get_encrypted_text(paint_detail_url)
-        decrypted = decrypt(encrypted, key, iv)
-
-        # get xmlns and overlap
-        xmlns = info2bytes(info[28]).decode('utf-8')
-        overlap = info2bytes(info[29]).decode('utf-8')
-
-        # create dzi file
-        dzi_info = {
-            'xmlns': xmlns,
-            'url': decrypted[0],
-            'overlap': overlap,
-            'tilesize': decrypted[4],
-            'format': decrypted[1],
-            'width': str(int(float(decrypted[2]))),
-            'height': str(int(float(decrypted[3])))
-        }
-        if len(image_items) == 1:
-            dzi_filename = f'{paint_id}.dzi'
-        else:
-            dzi_filename = f'{paint_id}_{idx}.dzi'
-        write_dzi_file(dzi_filename, dzi_info)
+# generate the dzi file
+def generate_dzi_file_mhj(paint_id, info=None):
+    dzi_infos = get_cached_dzi_infos('mhj', paint_id, get_dzi_infos_mhj, get_info_mhj, gv_urls['mhj'], info)
+    return write_dzi_files(paint_id, dzi_infos)
 
 ################################################################
 ## Collection (https://www.dpm.org.cn/explore/collections.html)
@@ -77,7 +87,10 @@ def generate_dzi_file_mhj(paint_id, info=None):
 # get dzi info from an uncommon type of url
 def get_dzi_info_bigimg(url):
     html_string = get_text_from_url(url)
-    soup = BeautifulSoup(html_string, 'html.parser')
+    return parse_dzi_info_bigimg(url, html_string)
+
+def parse_dzi_info_bigimg(url, html_string):
+    soup = make_soup(html_string, parse_only=only_tag('script'))
     script = soup.find_all('script')[-1].text
 
     if not 'OpenSeadragon' in script:
@@ -92,10 +105,22 @@ def get_dzi_info_bigimg(url):
     return dzi_info
 
 
-def generate_dzi_file_collection(paint_id):
-    url = f'https://www.dpm.org.cn/collection/paint/{paint_id}.html'
+# get the dzi info of all images of a painting
+def get_dzi_infos_collection(paint_id):
+    url = paint_urls['collection'].format(paint_id=paint_id)
     html_string = get_text_from_url(url)
-    soup = BeautifulSoup(html_string, 'html.parser')
+    tilegenerator_urls = get_tilegenerator_urls(html_string)
+
+    # fetch the descriptors of all images concurrently
+    def fetch_descriptor(tilegenerator_url):
+        if 'bigimg' in tilegenerator_url: return get_dzi_info_bigimg(tilegenerator_url)
+        return parse_tilegenerator(tilegenerator_url, get_text_from_url(tilegenerator_url))
+
+    return fetch_all_urls(fetch_descriptor, tilegenerator_urls)
+
+# get the urls of the tile generators of all images on the detail page
+def get_tilegenerator_urls(html_string):
+    soup = make_soup(html_string, parse_only=only_tag('img'))
 
     # get dzi url
     #item = soup.select_one('#hl_content')
@@ -103,83 +128,86 @@ def generate_dzi_file_collection(paint_id):
 
     tilegenerator_urls = [item.get('custom_tilegenerator').replace('dyx.html?path=/', '') for item in image_items]
     # remove duplicates
-    tilegenerator_urls =pd.Series(tilegenerator_urls).drop_duplicates().tolist()
-
-    for idx, tilegenerator_url in enumerate(tilegenerator_urls):
-        if not 'bigimg' in tilegenerator_url:
-            tilegenerator = get_text_from_url(tilegenerator_url)
-
-            # get dzi info
-            root = ET.fromstring(tilegenerator)
-            dzi_info = {
-                'xmlns': root.attrib['xmnls'],
-                'url': tilegenerator_url.replace('http:','https:').replace('.xml', '_files/'),
-                'overlap': root.attrib['Overlap'],
-                'tilesize': root.attrib['TileSize'],
-                'format': root.attrib['Format'],
-                'width': root[0].attrib['Width'],
-                'height': root[0].attrib['Height']
-            }
-        else:
-            dzi_info = get_dzi_info_bigimg(tilegenerator_url)
+    return pd.Series(tilegenerator_urls, dtype=object).drop_duplicates().tolist()
+
+# get dzi info from the tile generator descriptor
+def parse_tilegenerator(tilegenerator_url, tilegenerator):
+    root = ET.fromstring(tilegenerator)
+    return {
+        'xmlns': root.attrib['xmnls'],
+        'url': tilegenerator_url.replace('http:','https:').replace('.xml', '_files/'),
+        'overlap': root.attrib['Overlap'],
+        'tilesize': root.attrib['TileSize'],
+        'format': root.attrib['Format'],
+        'width': root[0].attrib['Width'],
+        'height': root[0].attrib['Height']
+    }
 
-        if len(image_items) == 1:
-            dzi_filename = f'{paint_id}.dzi'
-        else:
-            dzi_filename = f'{paint_id}_{idx}.dzi'
-        write_dzi_file(dzi_filename, dzi_info)
+def generate_dzi_file_collection(paint_id):
+    key = f'dzi:collection:{paint_id}'
+    dzi_infos = metadata_cache.get(key)
+    if dzi_infos is None:
+        with metrics.span('dzi_info', 'collection'):
+            dzi_infos = get_dzi_infos_collection(paint_id)
+        if len(dzi_infos) > 0: metadata_cache.put(key, dzi_infos)
+    return write_dzi_files(paint_id, dzi_infos)
 
 
 ################################################################
 ## Digital Catalog (https://digicol.dpm.org.cn/)
 ################################################################
 
+# the digicol pages do not include the xmlns of the descriptor
+xmlns_digicol = 'http://schemas.microsoft.com/deepzoom/2009'
+
 # get gv info from url (digicol)
 def get_info_digicol():
-    gv_url = 'https://digicol.dpm.org.cn/js/gve.js'
+    gv_url = gv_urls['digicol']
 
-    # get response from the url
-    res_text = get_text_from_url(gv_url)
+    # get response from the url (or the metadata cache)
+    res_text = metadata_cache.fetch_text(gv_url)
+    return parse_info_digicol(res_text)
 
+def parse_info_digicol(res_text):
     info = re.findall(r'"(.*?)"', res_text)[3]
     info = info2bytes(info).decode('utf-8').split('|')
 
     return info
 
-# generate the dzi file
-def generate_dzi_file_digicol(paint_id, info=None):
-    paint_url = f'https://digicol.dpm.org.cn/cultural/listCulturalImage?id={paint_id}'
+# get the dzi info of all images of a painting
+def get_dzi_infos_digicol(paint_id, info=None):
+    paint_url = paint_urls['digicol'].format(paint_id=paint_id)
     html_string = get_text_from_url(paint_url)
-    soup = BeautifulSoup(html_string, 'html.parser')
-
-    # get image id
-    image_id = soup.select_one('#swiper-wrapper-img').select_one('div').get('value')
+    paint_detail_urls = get_image_urls_digicol(html_string)
 
     # get info
     if info is None: info = get_info_digicol()
+    key, iv = get_keys_digicol(info)
 
-    # get key and vi and use them to decrypt the encrypted string
-    key = info[35].encode('utf-8')
-    iv = info[45].encode('utf-8')
+    # fetch the encrypted strings of all images concurrently
+    encrypted_texts = fetch_all_urls(get_encrypted_text, paint_detail_urls)
 
-    paint_detail_url = f'https://digicol.dpm.org.cn/cultural/details?id={image_id}'
+    return [make_dzi_info(decrypt(encrypted, key, iv), xmlns_digicol, '1') for encrypted in encrypted_texts]
 
-    encrypted = get_encrypted_text(paint_detail_url)
-    decrypted = decrypt(encrypted, key, iv)
+# get the urls of all images listed on the image list page (several for albums)
+def get_image_urls_digicol(html_string):
+    soup = make_soup(html_string, parse_only=only_id('swiper-wrapper-img'))
+    image_items = soup.find(id='swiper-wrapper-img').find_all('div', value=True)
 
-    # create dzi file
-    dzi_info = {
-        'xmlns': 'http://schemas.microsoft.com/deepzoom/2009',
-        'url': decrypted[0],
-        'overlap': '1',
-        'tilesize': decrypted[4],
-        'format': decrypted[1],
-        'width': str(int(float(decrypted[2]))),
-        'height': str(int(float(decrypted[3])))
-    }
+    # get image ids, removing duplicates
+    image_ids = list(dict.fromkeys(item.get('value') for item in image_items))
+    return [image_urls['digicol'].format(image_id=image_id) for image_id in image_ids]
 
-    dzi_filename = f'{paint_id}.dzi'
-    write_dzi_file(dzi_filename, dzi_info)
+# get key and iv (used to decrypt the encrypted string) from gv info
+def get_keys_digicol(info):
+    key = info[35].encode('utf-8')
+    iv = info[45].encode('utf-8')
+    return key, iv
+
+# generate the dzi file
+def generate_dzi_file_digicol(paint_id, info=None):
+    dzi_infos = get_cached_dzi_infos('digicol', paint_id, get_dzi_infos_digicol, get_info_digicol, gv_urls['digicol'], info)
+    return write_dzi_files(paint_id, dzi_infos)
 
 
 ################################################################
@@ -190,7 +218,7 @@ def generate_dzi_file_digicol(paint_id, info=None):
 def get_text_from_url(url):
 
     # get response from the url
-    res = requests.get(url)
+    res = http_client.get(url)
 
     # check for successful request
     if res.status_code != 200:
@@ -202,22 +230,63 @@ def get_text_from_url(url):
 def info2bytes(info):
     return bytes.fromhex(info.replace('\\x',''))
 
+# raised when the encrypted string cannot be decrypted, usually because the key has changed
+class DecryptionError(ValueError):
+    pass
+
+# fetch several urls concurrently, keeping their order
+def fetch_all_urls(fetch, urls):
+    if len(urls) <= 1: return [fetch(url) for url in urls]
+    with ThreadPoolExecutor(max_workers=min(leaf_workers, len(urls))) as executor:
+        return list(executor.map(fetch, urls))
+
+# block ciphers are set up once per key and thread and reused for every decryption
+_ciphers = threading.local()
+
+def get_block_cipher(key):
+    ciphers = getattr(_ciphers, 'ciphers', None)
+    if ciphers is None: ciphers = _ciphers.ciphers = {}
+    if not key in ciphers: ciphers[key] = AES.new(key, AES.MODE_ECB)
+    return ciphers[key]
+
 # decrypt the encrypted string
+# cbc decryption is done with the reusable ecb cipher of the key, xoring each
+# decrypted block with the previous ciphertext block (or the iv)
 def decrypt(encrypted, key, iv):
-    # create cipher object
-    cipher = AES.new(key, AES.MODE_CBC, iv)
-
-    # decrypt the encrypted string
-    decrypted = cipher.decrypt(base64.b64decode(encrypted))
-    decrypted = unpad(decrypted, 16).decode('utf-8').split('^')
+    with metrics.span('decrypt'):
+        return decrypt_cbc(encrypted, key, iv)
+
+def decrypt_cbc(encrypted, key, iv):
+    try:
+        data = base64.b64decode(encrypted)
+        decrypted = get_block_cipher(key).decrypt(data)
+        previous = iv + data[:-16]
+        decrypted = (int.from_bytes(decrypted, 'big') ^ int.from_bytes(previous, 'big')).to_bytes(len(data), 'big')
+        decrypted = unpad(decrypted, 16).decode('utf-8').split('^')
+    except ValueError as e:
+        raise DecryptionError(f'Cannot decrypt the encrypted string: {e}')
 
     return decrypted
 
+# create the dzi info from the decrypted string
+def make_dzi_info(decrypted, xmlns, overlap):
+    return {
+        'xmlns': xmlns,
+        'url': decrypted[0],
+        'overlap': overlap,
+        'tilesize': decrypted[4],
+        'format': decrypted[1],
+        'width': str(int(float(decrypted[2]))),
+        'height': str(int(float(decrypted[3])))
+    }
+
 # get the encrypted string from the paint url
 def get_encrypted_text(paint_url):
     # get response from the url
     res_text = get_text_from_url(paint_url)
+    return parse_encrypted_text(paint_url, res_text)
 
+def parse_encrypted_text(paint_url, res_text):
     # find the first substring that matches the encrypted string
     match = re.search(r'gv.init\("(.*?)"', res_text)
     if match:
@@ -226,23 +295,110 @@ def get_encrypted_text(paint_url):
     else:
         raise ValueError(f'Cannot find encrypted string in {paint_url}')
 
+# generate the dzi files of a painting and return their paths
 def generate_dzi_file(website, paint_id, info=None):
     if website == 'mhj':
-        generate_dzi_file_mhj(paint_id, info)
+        return generate_dzi_file_mhj(paint_id, info)
     elif website == 'collection':
-        generate_dzi_file_collection(paint_id)
+        return generate_dzi_file_collection(paint_id)
     elif website == 'digicol':
-        generate_dzi_file_digicol(paint_id, info)
+        return generate_dzi_file_digicol(paint_id, info)
     else:
         raise ValueError(f'Unknown website {website}')
 
-def write_dzi_file(dzi_filename, dzi_info):
-    # check if paintings folder exists
-    if not os.path.exists('paintings'):
-        os.makedirs('paintings')
+# gv info fetched again after a decryption failure, by website
+# it replaces the info passed by callers (which keep passing the info they read
+# at the start of a run), so a key rotation is only handled once
+_refreshed_infos = {}
+_refresh_lock = threading.Lock()
+
+def get_current_info(website, info):
+    return _refreshed_infos.get(website, info)
+
+# discard the cached key material and fetch it again after decrypting with
+# `failed_info` failed, unless another thread has refreshed it in the meantime
+def refresh_info(website, failed_info, get_site_info, gv_url):
+    with _refresh_lock:
+        info = _refreshed_infos.get(website)
+        if info is None or info is failed_info:
+            metadata_cache.delete(gv_url)
+            info = _refreshed_infos[website] = get_site_info()
+        return info
+
+# get the dzi info of a painting from the metadata cache, or fetch and cache it
+# if decryption fails, the cached key material is discarded and fetched again once
+def get_cached_dzi_infos(website, paint_id, get_dzi_infos, get_site_info, gv_url, info=None):
+    key = f'dzi:{website}:{paint_id}'
+    dzi_infos = metadata_cache.get(key)
+    if dzi_infos is not None:
+        metrics.count('metadata_cache_hits', site=website)
+        return dzi_infos
+
+    info = get_current_info(website, info)
+    try:
+        with metrics.span('dzi_info', website):
+            dzi_infos = get_dzi_infos(paint_id, info)
+    except DecryptionError:
+        metrics.count('decryption_failures', site=website)
+        dzi_infos = get_dzi_infos(paint_id, refresh_info(website, info, get_site_info, gv_url))
+
+    if len(dzi_infos) > 0: metadata_cache.put(key, dzi_infos)
+    return dzi_infos
+
+# write the dzi files of a painting, with an index suffix for albums, and
+# return their paths
+# all files are written to temporary files first and only renamed once every
+# file of the painting has been written, so no partial album is left behind;
+# the files are then recorded in the manifest
+def write_dzi_files(paint_id, dzi_infos):
+    painting_dir = manifest.get_painting_dir(paint_id)
+    dzi_files = []
+    for idx, dzi_info in enumerate(dzi_infos):
+        if len(dzi_infos) == 1:
+            dzi_filename = f'{paint_id}.dzi'
+        else:
+            dzi_filename = f'{paint_id}_{idx}.dzi'
+        dzi_files.append(os.path.join(painting_dir, dzi_filename))
+
+    try:
+        for dzi_file, dzi_info in zip(dzi_files, dzi_infos):
+            write_dzi_file(f'{dzi_file}.tmp', dzi_info)
+    except Exception:
+        for dzi_file in dzi_files:
+            if os.path.exists(f'{dzi_file}.tmp'): os.remove(f'{dzi_file}.tmp')
+        raise
+
+    for dzi_file in dzi_files:
+        os.replace(f'{dzi_file}.tmp', dzi_file)
+    if len(dzi_files) > 0: manifest.put_dzi_files(paint_id, dzi_files, dzi_infos[0]['format'])
+    return dzi_files
+
+# generate the dzi files of many paintings concurrently
+# returns the dzi file paths of each painting, or the exception if it failed
+def generate_dzi_files(website, paint_ids, info=None, workers=8):
+    if info is None: info = get_info(website)
+    http_client.ensure_pool_size(workers * leaf_workers)
+
+    def generate(paint_id):
+        try:
+            return generate_dzi_file(website, paint_id, info=info)
+        except Exception as e:
+            print(f'Failed to generate dzi files for painting {paint_id}: {e}')
+            return e
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(paint_ids, executor.map(generate, paint_ids)))
+
+def write_dzi_file(dzi_file, dzi_info):
+    with metrics.span('write_dzi'):
+        write_dzi_descriptor(dzi_file, dzi_info)
+
+def write_dzi_descriptor(dzi_file, dzi_info):
+    # check if the folder exists
+    os.makedirs(os.path.dirname(dzi_file) or '.', exist_ok=True)
 
     # create dzi file
-    file = open(f'paintings/{dzi_filename}', 'wb')
+    file = open(dzi_file, 'wb')
     doc = xml.dom.minidom.Document()
     image = doc.createElementNS(dzi_info['xmlns'], 'Image')
     image.setAttribute('xmlns', dzi_info['xmlns'])
@@ -275,4 +431,4 @@ if __name__ == '__main__':
     website = sys.argv[1]
     paint_id = sys.argv[2]
 
-    generate_dzi_file(website=website, id=paint_id)
\ No newline at end of file
+    generate_dzi_file(website=website, paint_id=paint_id)
\ No newline at end of file
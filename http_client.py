@@ -0,0 +1,129 @@
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import rate_limit
+import metrics
+
+################################################################
+## shared http client
+################################################################
+
+# settings of the shared session, which can be changed with configure()
+settings = {
+    # number of pooled connections kept per host, should match the worker count
+    'pool_size': 16,
+    # number of retries on connection errors and the status codes below
+    'retries': 3,
+    'status_forcelist': (429, 500, 502, 503, 504),
+    # exponential backoff between retries (seconds) and the maximum random jitter added to it
+    'backoff_factor': 0.5,
+    'backoff_jitter': 0.5,
+    # (connect, read) timeout in seconds, can be overridden per host
+    'timeout': (10, 60),
+    'host_timeouts': {},
+    # url prefixes replaced before sending requests, e.g. to point the scripts
+    # at a local mock of the websites ({'https://minghuaji.dpm.org.cn': 'http://127.0.0.1:8000/mhj'})
+    'url_map': {},
+}
+
+_session = None
+_lock = threading.Lock()
+
+# retry policy with random jitter added to the exponential backoff
+class JitterRetry(Retry):
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        if backoff <= 0: return backoff
+        return backoff + random.uniform(0, settings['backoff_jitter'])
+
+# update the settings, the session is recreated on next use
+# the previous session is not closed, since other threads may be in the middle
+# of a request with it; it is garbage-collected once they are done
+def configure(**kwargs):
+    global _session
+    for key in kwargs:
+        if not key in settings:
+            raise ValueError(f'Unknown http client setting: {key}')
+    with _lock:
+        settings.update(kwargs)
+        _session = None
+
+# grow the connection pool so that it can serve the given number of workers
+def ensure_pool_size(workers):
+    if workers > settings['pool_size']: configure(pool_size=workers)
+
+# create the session shared by all network calls
+# the adapter retries connection errors, while responses with a status in
+# status_forcelist are retried by request() so that every attempt passes
+# through the rate limiter
+def create_session():
+    retry = JitterRetry(
+        total=settings['retries'],
+        backoff_factor=settings['backoff_factor'],
+        status=0,
+        # listing pages are fetched with POST but are safe to retry
+        allowed_methods=None,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(
+        pool_connections=settings['pool_size'],
+        pool_maxsize=settings['pool_size'],
+        max_retries=retry
+    )
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update({'Connection': 'keep-alive'})
+    return session
+
+def get_session():
+    global _session
+    with _lock:
+        if _session is None: _session = create_session()
+        return _session
+
+# get the timeout for the host of the url
+def get_timeout(url):
+    host = urlsplit(url).hostname
+    return settings['host_timeouts'].get(host, settings['timeout'])
+
+# exponential backoff with random jitter before the given retry
+def get_backoff_time(attempt):
+    return settings['backoff_factor'] * 2 ** attempt + random.uniform(0, settings['backoff_jitter'])
+
+def map_url(url):
+    for prefix, replacement in settings['url_map'].items():
+        if url.startswith(prefix): return replacement + url[len(prefix):]
+    return url
+
+def request(method, url, **kwargs):
+    url = map_url(url)
+    host = urlsplit(url).hostname
+    kwargs.setdefault('timeout', get_timeout(url))
+    for attempt in range(settings['retries'] + 1):
+        rate_limit.acquire(url)
+        try:
+            with metrics.span('http', host, method=method, url=url):
+                res = get_session().request(method, url, **kwargs)
+        except Exception:
+            metrics.count('failures', site=host)
+            raise
+        metrics.count('requests', site=host)
+        metrics.count('bytes', len(res.content), site=host)
+        rate_limit.update(url, res.status_code, res.headers.get('Retry-After'))
+        if not res.status_code in settings['status_forcelist'] or attempt == settings['retries']: break
+        # Retry-After is honoured by the rate limiter before the next attempt
+        metrics.count('retries', site=host)
+        time.sleep(get_backoff_time(attempt))
+    if res.status_code >= 400: metrics.count('failures', site=host)
+    return res
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
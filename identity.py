@@ -0,0 +1,167 @@
+import sqlite3
+import threading
+import time
+import deepzoom
+from generate_dzi import generate_dzi_file, get_info
+
+################################################################
+## cross-site identity index
+################################################################
+
+# sites preferred (in this order) between sources of the same resolution
+site_priority = ['mhj', 'collection', 'digicol']
+
+# statuses of the copies that are never chosen as the source of a painting
+excluded_statuses = ['failed', 'duplicate']
+
+def normalize_inventory_id(inventory_id):
+    return str(inventory_id).replace(' ', '').upper()
+
+# paintings of different websites linked by a shared minghuaji id (listed on
+# the collection detail pages) or inventory number, kept in the catalog
+# database together with the resolution of each source
+# every painting (and inventory number, stored with the site 'inventory')
+# belongs to one identity; linking two identities merges them
+class IdentityIndex:
+    def __init__(self, path='paintings.db'):
+        self.path = path
+        self.local = threading.local()
+        self.infos = {}
+        self.lock = threading.Lock()
+        connection = self.get_connection()
+        connection.execute('''
+            CREATE TABLE IF NOT EXISTS identities (
+                site TEXT NOT NULL,
+                id TEXT NOT NULL,
+                identity TEXT NOT NULL,
+                PRIMARY KEY (site, id)
+            )''')
+        connection.execute('CREATE INDEX IF NOT EXISTS identities_identity ON identities (identity)')
+        connection.execute('''
+            CREATE TABLE IF NOT EXISTS resolutions (
+                site TEXT NOT NULL,
+                id TEXT NOT NULL,
+                width INTEGER,
+                height INTEGER,
+                pixels INTEGER,
+                updated_at REAL,
+                PRIMARY KEY (site, id)
+            )''')
+
+    # each thread uses its own connection to the database
+    def get_connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self.local.connection = connection
+        return connection
+
+    # link a painting to its minghuaji id and inventory number
+    def link(self, site, paint_id, mhj_id=None, inventory_id=None):
+        self.link_many([(site, paint_id, mhj_id, inventory_id)])
+
+    def link_many(self, paintings):
+        connection = self.get_connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            for site, paint_id, mhj_id, inventory_id in paintings:
+                nodes = [(site, str(paint_id))]
+                if mhj_id: nodes.append(('mhj', str(mhj_id)))
+                if inventory_id: nodes.append(('inventory', normalize_inventory_id(inventory_id)))
+
+                identities = set()
+                for node in nodes:
+                    row = connection.execute('SELECT identity FROM identities WHERE site = ? AND id = ?', node).fetchone()
+                    if row is not None: identities.add(row[0])
+                identity = min(identities) if len(identities) > 0 else f'{site}:{paint_id}'
+
+                for other in identities - {identity}:
+                    connection.execute('UPDATE identities SET identity = ? WHERE identity = ?', (identity, other))
+                connection.executemany(
+                    'INSERT OR REPLACE INTO identities (site, id, identity) VALUES (?, ?, ?)',
+                    [(*node, identity) for node in nodes]
+                )
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+    # link all paintings of the catalog
+    def build(self, catalog):
+        rows = catalog.get_connection().execute('SELECT site, id, mhj_id, inventory_id FROM paintings ORDER BY rowid')
+        self.link_many([(row[0], row[1], row[2], row[3]) for row in rows])
+
+    # the paintings (of any site) sharing the identity of a painting, itself included
+    def get_members(self, site, paint_id):
+        rows = self.get_connection().execute('''
+            SELECT site, id FROM identities WHERE site != 'inventory' AND identity = (
+                SELECT identity FROM identities WHERE site = ? AND id = ?
+            ) ORDER BY site, id''', (site, str(paint_id))).fetchall()
+        members = [(row[0], row[1]) for row in rows]
+        if not (site, str(paint_id)) in members: members.append((site, str(paint_id)))
+        return members
+
+    # number of pixels of all images of a painting, or None if it is not known
+    def get_resolution(self, site, paint_id):
+        row = self.get_connection().execute(
+            'SELECT pixels FROM resolutions WHERE site = ? AND id = ?', (site, str(paint_id))
+        ).fetchone()
+        return None if row is None else row[0]
+
+    # generate the dzi files of a painting (usually from the metadata cache) to
+    # record its resolution; returns the number of pixels, or None on failure
+    def fetch_resolution(self, site, paint_id):
+        try:
+            with self.lock:
+                if not site in self.infos: self.infos[site] = get_info(site)
+            dzi_files = generate_dzi_file(site, paint_id, info=self.infos[site])
+        except Exception as e:
+            print(f'Failed to get the resolution of painting {paint_id} ({site}): {e}')
+            return None
+        if len(dzi_files) == 0: return None
+        self.record_dzi_files(site, paint_id, dzi_files)
+        return self.get_resolution(site, paint_id)
+
+    # record the resolution of a painting from its dzi files
+    def record_dzi_files(self, site, paint_id, dzi_files):
+        dzis = [deepzoom.read_dzi_file(dzi_file) for dzi_file in dzi_files]
+        width = max(dzi['width'] for dzi in dzis)
+        height = max(dzi['height'] for dzi in dzis)
+        self.set_resolution(site, paint_id, width, height, sum(dzi['width'] * dzi['height'] for dzi in dzis))
+
+    def set_resolution(self, site, paint_id, width, height, pixels):
+        self.get_connection().execute(
+            'INSERT OR REPLACE INTO resolutions (site, id, width, height, pixels, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+            (site, str(paint_id), width, height, pixels, time.time())
+        )
+
+    # the painting to download among those sharing the identity of a painting:
+    # the one with the most pixels, then one already downloaded, then the one of
+    # the preferred site
+    # only paintings in `catalog` are candidates, since the others are never
+    # downloaded, and copies that failed or are duplicates themselves are left
+    # out; unknown resolutions are only fetched (see fetch_resolution()) with
+    # `fetch_missing`, otherwise those copies are left out too
+    def get_best_source(self, site, paint_id, catalog, fetch_missing=False):
+        candidates = []
+        for member_site, member_id in self.get_members(site, paint_id):
+            status = None
+            if (member_site, member_id) != (site, str(paint_id)):
+                painting = catalog.get(member_site, member_id)
+                if painting is None or painting['status'] in excluded_statuses: continue
+                status = painting['status']
+            pixels = self.get_resolution(member_site, member_id)
+            if pixels is None and fetch_missing: pixels = self.fetch_resolution(member_site, member_id)
+            if pixels is None: continue
+            downloaded = 0 if status == 'downloaded' else 1
+            priority = site_priority.index(member_site) if member_site in site_priority else len(site_priority)
+            candidates.append(((-pixels, downloaded, priority, member_id), (member_site, member_id)))
+        if len(candidates) == 0: return site, str(paint_id)
+        return min(candidates)[1]
+
+    def close(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
@@ -0,0 +1,269 @@
+import hashlib
+import os
+import sqlite3
+import struct
+import threading
+import time
+from PIL import Image
+
+################################################################
+## manifest of dzi files and downloaded images
+################################################################
+
+# the dzi files of each painting and every completed image (with its size and
+# sha256) are recorded in a sqlite database, so deciding what to skip is one
+# indexed lookup per painting instead of a scan of the paintings directory
+# with `sharded`, the files of each painting are kept in one of 256
+# subdirectories (paintings/ab/...) chosen by the hash of its id
+settings = {
+    'root': 'paintings',
+    'path': os.environ.get('DPM_MANIFEST', os.path.join('paintings', 'manifest.db')),
+    'sharded': os.environ.get('DPM_SHARDED', '') not in ['', '0'],
+}
+
+_local = threading.local()
+_build_lock = threading.Lock()
+
+def configure(**kwargs):
+    for key in kwargs:
+        if not key in settings:
+            raise ValueError(f'Unknown manifest setting: {key}')
+    settings.update(kwargs)
+
+# each thread uses its own connection to the database, which is reopened if
+# the database was removed (e.g. together with the paintings directory)
+# a new manifest is filled once from the files already in the paintings directory
+def get_connection():
+    path = settings['path']
+    if getattr(_local, 'path', None) != path or not os.path.exists(path):
+        if getattr(_local, 'connection', None) is not None: _local.connection.close()
+        if os.path.dirname(path): os.makedirs(os.path.dirname(path), exist_ok=True)
+        connection = sqlite3.connect(path, timeout=60)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute('''
+            CREATE TABLE IF NOT EXISTS dzi_files (
+                paint_id TEXT NOT NULL,
+                path TEXT NOT NULL,
+                format TEXT,
+                PRIMARY KEY (paint_id, path)
+            )''')
+        connection.execute('''
+            CREATE TABLE IF NOT EXISTS outputs (
+                path TEXT PRIMARY KEY,
+                paint_id TEXT,
+                size INTEGER,
+                sha256 TEXT,
+                updated_at REAL
+            )''')
+        connection.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)')
+        connection.commit()
+        _local.connection = connection
+        _local.path = path
+
+        with _build_lock:
+            if connection.execute("SELECT value FROM state WHERE key = 'built'").fetchone() is None:
+                build(connection)
+    return _local.connection
+
+# directory holding the files of a painting
+def get_painting_dir(paint_id):
+    if not settings['sharded']: return settings['root']
+    return os.path.join(settings['root'], hashlib.md5(str(paint_id).encode('utf-8')).hexdigest()[:2])
+
+# the painting id of a dzi file or image named [paint_id].dzi, [paint_id]_[index].dzi, etc.
+def get_paint_id(filename):
+    return os.path.basename(filename).split('.')[0].split('_')[0]
+
+def get_format(dzi_file):
+    with open(dzi_file, 'r') as file:
+        text = file.read()
+    start = text.find('Format="') + len('Format="')
+    return text[start:text.index('"', start)]
+
+# signatures starting and markers ending complete jpeg and png files
+signatures = {
+    '.jpg': (b'\xff\xd8\xff', b'\xff\xd9'),
+    '.jpeg': (b'\xff\xd8\xff', b'\xff\xd9'),
+    '.png': (b'\x89PNG\r\n\x1a\n', b'IEND\xaeB`\x82'),
+}
+
+# tiff field types of the strip and tile offsets and their sizes
+tiff_types = {3: 'H', 4: 'I', 16: 'Q'}
+
+# whether a tiff file is complete: its header points to an ifd (the streaming
+# writer sets it last), and every strip or tile lies within the file
+def is_complete_tiff(file, size):
+    header = file.read(16)
+    order = {b'II': '<', b'MM': '>'}.get(header[:2])
+    if order is None or len(header) < 8: return False
+    version = struct.unpack(f'{order}H', header[2:4])[0]
+    if version == 42:
+        num_fmt, count_fmt, offset_fmt, inline_size = 'H', 'I', 'I', 4
+        ifd_offset = struct.unpack(f'{order}I', header[4:8])[0]
+    elif version == 43 and len(header) == 16:
+        num_fmt, count_fmt, offset_fmt, inline_size = 'Q', 'Q', 'Q', 8
+        ifd_offset = struct.unpack(f'{order}Q', header[8:16])[0]
+    else:
+        return False
+    if ifd_offset == 0 or ifd_offset >= size: return False
+
+    file.seek(ifd_offset)
+    num_size = struct.calcsize(num_fmt)
+    entry_fmt = f'{order}HH{count_fmt}{inline_size}s'
+    entry_size = struct.calcsize(entry_fmt)
+    data = file.read(num_size)
+    if len(data) < num_size: return False
+    num_entries = struct.unpack(f'{order}{num_fmt}', data)[0]
+    data = file.read(num_entries * entry_size)
+    if len(data) < num_entries * entry_size: return False
+
+    # strip (273, 279) or tile (324, 325) offsets and byte counts
+    fields = {}
+    for index in range(num_entries):
+        tag, type, count, field = struct.unpack_from(entry_fmt, data, index * entry_size)
+        if not tag in [273, 279, 324, 325]: continue
+        if not type in tiff_types: return False
+        value_fmt = f'{order}{count}{tiff_types[type]}'
+        value_size = struct.calcsize(value_fmt)
+        if value_size > inline_size:
+            value_offset = struct.unpack(f'{order}{offset_fmt}', field)[0]
+            if value_offset + value_size > size: return False
+            file.seek(value_offset)
+            field = file.read(value_size)
+        fields[tag] = struct.unpack(value_fmt, field[:value_size])
+    offsets = fields.get(273, fields.get(324))
+    byte_counts = fields.get(279, fields.get(325))
+    if not offsets or byte_counts is None or len(offsets) != len(byte_counts): return False
+    return all(offset + count <= size for offset, count in zip(offsets, byte_counts))
+
+# whether an image found on disk is complete, without decoding it: jpeg and png
+# files start with their signature and end with their end marker, and the
+# strips of tiff files lie within the file (other formats are only opened)
+# images written by an interrupted dezoomify-rs run are cut short
+def is_complete_image(path):
+    extension = os.path.splitext(path)[1].lower()
+    size = os.path.getsize(path)
+    try:
+        with open(path, 'rb') as file:
+            if extension in signatures:
+                signature, end_marker = signatures[extension]
+                if file.read(len(signature)) != signature: return False
+                file.seek(max(0, size - 64))
+                return file.read().rstrip(b'\x00').endswith(end_marker)
+            if extension in ['.tif', '.tiff']:
+                return is_complete_tiff(file, size)
+        # only the header is read; large images are not decompression bombs here
+        with Image.open(path):
+            return True
+    except Image.DecompressionBombError:
+        return True
+    except Exception:
+        return False
+
+# record the dzi files and images already in the paintings directory
+# images are recorded with their size only; their checksum is filled by verify()
+# incomplete images are left out, so that they are downloaded again
+def build(connection):
+    print(f'Building the manifest of {settings["root"]}...')
+    dzi_rows, output_rows = [], []
+    for dir_path, _, filenames in os.walk(settings['root']):
+        for filename in filenames:
+            path = os.path.join(dir_path, filename)
+            if filename.endswith('.dzi'):
+                dzi_rows.append((get_paint_id(filename), path, get_format(path)))
+            elif filename.endswith(('.tmp', '.part', '.db', '.db-wal', '.db-shm')):
+                continue
+            elif is_complete_image(path):
+                output_rows.append((path, get_paint_id(filename), os.path.getsize(path), None, time.time()))
+            else:
+                print(f'Incomplete image: {path}')
+    with connection:
+        connection.executemany('INSERT OR IGNORE INTO dzi_files (paint_id, path, format) VALUES (?, ?, ?)', dzi_rows)
+        connection.executemany('INSERT OR IGNORE INTO outputs (path, paint_id, size, sha256, updated_at) VALUES (?, ?, ?, ?, ?)', output_rows)
+        connection.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('built', ?)", (str(time.time()),))
+    print(f'Found {len(dzi_rows)} dzi files and {len(output_rows)} images')
+
+# the dzi files of a painting in album order, or an empty list
+def get_dzi_files(paint_id):
+    rows = get_connection().execute(
+        'SELECT path FROM dzi_files WHERE paint_id = ? ORDER BY rowid', (str(paint_id),)
+    ).fetchall()
+    return [row[0] for row in rows]
+
+def get_dzi_format(dzi_file):
+    row = get_connection().execute('SELECT format FROM dzi_files WHERE path = ?', (dzi_file,)).fetchone()
+    if row is None or row[0] is None: return get_format(dzi_file)
+    return row[0]
+
+# replace the dzi files recorded for a painting
+def put_dzi_files(paint_id, dzi_files, format):
+    connection = get_connection()
+    with connection:
+        connection.execute('DELETE FROM dzi_files WHERE paint_id = ?', (str(paint_id),))
+        connection.executemany(
+            'INSERT INTO dzi_files (paint_id, path, format) VALUES (?, ?, ?)',
+            [(str(paint_id), dzi_file, format) for dzi_file in dzi_files]
+        )
+
+def delete_dzi_files(paint_id):
+    connection = get_connection()
+    with connection:
+        connection.execute('DELETE FROM dzi_files WHERE paint_id = ?', (str(paint_id),))
+
+def get_checksum(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+# record a completed image
+def put_output(path, paint_id=None):
+    connection = get_connection()
+    with connection:
+        connection.execute(
+            'INSERT OR REPLACE INTO outputs (path, paint_id, size, sha256, updated_at) VALUES (?, ?, ?, ?, ?)',
+            (path, str(paint_id or get_paint_id(path)), os.path.getsize(path), get_checksum(path), time.time())
+        )
+
+def delete_output(path):
+    connection = get_connection()
+    with connection:
+        connection.execute('DELETE FROM outputs WHERE path = ?', (path,))
+
+# whether an image is complete: recorded in the manifest and still of the
+# recorded size; an image found on disk but not recorded (e.g. left behind by
+# an interrupted dezoomify-rs run) is not complete
+def has_output(path):
+    row = get_connection().execute('SELECT size FROM outputs WHERE path = ?', (path,)).fetchone()
+    if row is None: return False
+    try:
+        return os.path.getsize(path) == row[0]
+    except OSError:
+        return False
+
+# check every recorded image against its size and checksum (recording the
+# checksum if it is unknown); corrupt or missing images are removed from the
+# manifest so that they are downloaded again, and returned
+def verify():
+    connection = get_connection()
+    rows = connection.execute('SELECT path, size, sha256 FROM outputs').fetchall()
+    invalid = []
+    for path, size, sha256 in rows:
+        if not os.path.exists(path) or os.path.getsize(path) != size:
+            invalid.append(path)
+            continue
+        checksum = get_checksum(path)
+        if sha256 is None:
+            with connection:
+                connection.execute('UPDATE outputs SET sha256 = ? WHERE path = ?', (checksum, path))
+        elif checksum != sha256:
+            invalid.append(path)
+    with connection:
+        connection.executemany('DELETE FROM outputs WHERE path = ?', [(path,) for path in invalid])
+    for path in invalid: print(f'Invalid image: {path}')
+    return invalid
+
+if __name__ == '__main__':
+    verify()
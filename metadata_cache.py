@@ -0,0 +1,114 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import http_client
+
+################################################################
+## persistent metadata cache
+################################################################
+
+# key material (gve.js) and decrypted dzi info are kept in a sqlite database
+# downloaded texts are considered fresh for `ttl` seconds and revalidated with
+# ETag / Last-Modified afterwards
+settings = {
+    'enabled': True,
+    'path': os.environ.get('DPM_METADATA_CACHE', os.path.join('cache', 'metadata.db')),
+    'ttl': 24 * 3600,
+}
+
+_local = threading.local()
+
+def configure(**kwargs):
+    for key in kwargs:
+        if not key in settings:
+            raise ValueError(f'Unknown metadata cache setting: {key}')
+    settings.update(kwargs)
+
+# each thread uses its own connection to the database
+def get_connection():
+    path = settings['path']
+    if getattr(_local, 'path', None) != path:
+        if os.path.dirname(path): os.makedirs(os.path.dirname(path), exist_ok=True)
+        connection = sqlite3.connect(path, timeout=30)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('''
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                value TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                updated_at REAL
+            )''')
+        connection.commit()
+        _local.connection = connection
+        _local.path = path
+    return _local.connection
+
+# return the cached entry as a dict, or None if it does not exist
+def get_entry(key):
+    if not settings['enabled']: return None
+    row = get_connection().execute(
+        'SELECT value, etag, last_modified, updated_at FROM entries WHERE key = ?', (key,)
+    ).fetchone()
+    if row is None: return None
+    return {
+        'value': json.loads(row[0]),
+        'etag': row[1],
+        'last_modified': row[2],
+        'updated_at': row[3]
+    }
+
+# return the cached value, or None if it does not exist or is older than ttl seconds
+def get(key, ttl=None):
+    entry = get_entry(key)
+    if entry is None: return None
+    if ttl is not None and time.time() - entry['updated_at'] > ttl: return None
+    return entry['value']
+
+def put(key, value, etag=None, last_modified=None):
+    if not settings['enabled']: return
+    connection = get_connection()
+    connection.execute(
+        'INSERT OR REPLACE INTO entries (key, value, etag, last_modified, updated_at) VALUES (?, ?, ?, ?, ?)',
+        (key, json.dumps(value, ensure_ascii=False), etag, last_modified, time.time())
+    )
+    connection.commit()
+
+def touch(key):
+    if not settings['enabled']: return
+    connection = get_connection()
+    connection.execute('UPDATE entries SET updated_at = ? WHERE key = ?', (time.time(), key))
+    connection.commit()
+
+def delete(key):
+    if not settings['enabled']: return
+    connection = get_connection()
+    connection.execute('DELETE FROM entries WHERE key = ?', (key,))
+    connection.commit()
+
+# get text from url through the cache
+# a fresh entry is returned without any request, a stale one is revalidated
+# with a conditional request
+def fetch_text(url, ttl=None):
+    if ttl is None: ttl = settings['ttl']
+    entry = get_entry(url)
+    if entry is not None and time.time() - entry['updated_at'] <= ttl:
+        return entry['value']
+
+    headers = {}
+    if entry is not None:
+        if entry['etag']: headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']: headers['If-Modified-Since'] = entry['last_modified']
+
+    res = http_client.get(url, headers=headers)
+    if res.status_code == 304 and entry is not None:
+        touch(url)
+        return entry['value']
+    # check for successful request
+    if res.status_code != 200:
+        raise ValueError(f'Encountered error when visiting {url}: {res.status_code}')
+
+    put(url, res.text, etag=res.headers.get('ETag'), last_modified=res.headers.get('Last-Modified'))
+    return res.text
@@ -0,0 +1,164 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+################################################################
+## instrumentation
+################################################################
+
+# timing spans and counters of the hot paths, exported as json lines (one
+# event per span) and as a prometheus text file
+# the files are only written when their paths are set
+settings = {
+    'jsonl_path': os.environ.get('DPM_METRICS_JSONL'),
+    'prometheus_path': os.environ.get('DPM_METRICS_PROM'),
+    # 'cprofile' or 'pyinstrument'
+    'profile': os.environ.get('DPM_PROFILE'),
+    'profile_path': os.environ.get('DPM_PROFILE_PATH', 'profile.out'),
+}
+
+_lock = threading.Lock()
+_spans = {} # (stage, site) -> [count, total seconds, max seconds]
+_counters = {} # (name, site) -> value
+_jsonl_file = None
+
+def configure(**kwargs):
+    global _jsonl_file
+    for key in kwargs:
+        if not key in settings:
+            raise ValueError(f'Unknown metrics setting: {key}')
+    with _lock:
+        settings.update(kwargs)
+        if _jsonl_file is not None:
+            _jsonl_file.close()
+            _jsonl_file = None
+
+def write_event(event):
+    global _jsonl_file
+    if settings['jsonl_path'] is None: return
+    with _lock:
+        if _jsonl_file is None: _jsonl_file = open(settings['jsonl_path'], 'a')
+        _jsonl_file.write(json.dumps(event, ensure_ascii=False) + '\n')
+
+# time a stage, e.g. `with span('decrypt', 'mhj'): ...`
+@contextlib.contextmanager
+def span(stage, site=None, **labels):
+    started_at = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        record(stage, time.perf_counter() - started_at, site, error=error, **labels)
+
+# record the duration of a stage timed outside of span(), e.g. across threads
+def record(stage, duration, site=None, error=None, **labels):
+    with _lock:
+        stats = _spans.setdefault((stage, site), [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += duration
+        stats[2] = max(stats[2], duration)
+    if settings['jsonl_path'] is not None:
+        event = {'time': time.time(), 'stage': stage, 'site': site, 'seconds': duration, **labels}
+        if error is not None: event['error'] = error
+        write_event(event)
+
+# increase a counter, e.g. bytes, tiles, retries or failures
+def count(name, value=1, site=None):
+    with _lock:
+        _counters[(name, site)] = _counters.get((name, site), 0) + value
+
+def get_spans():
+    with _lock:
+        return {key: list(value) for key, value in _spans.items()}
+
+def get_counters():
+    with _lock:
+        return dict(_counters)
+
+def reset():
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+
+def format_labels(**labels):
+    labels = {key: value for key, value in labels.items() if value is not None}
+    if len(labels) == 0: return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+# metrics in the prometheus text format
+def to_prometheus():
+    lines = [
+        '# HELP dpm_stage_seconds Time spent in each stage.',
+        '# TYPE dpm_stage_seconds summary',
+    ]
+    spans = get_spans()
+    for (stage, site), (number, total, _) in sorted(spans.items(), key=str):
+        lines.append(f'dpm_stage_seconds_count{format_labels(stage=stage, site=site)} {number}')
+        lines.append(f'dpm_stage_seconds_sum{format_labels(stage=stage, site=site)} {total:.6f}')
+    lines += [
+        '# HELP dpm_stage_seconds_max Longest time spent in each stage.',
+        '# TYPE dpm_stage_seconds_max gauge',
+    ]
+    for (stage, site), (_, _, longest) in sorted(spans.items(), key=str):
+        lines.append(f'dpm_stage_seconds_max{format_labels(stage=stage, site=site)} {longest:.6f}')
+
+    counters = get_counters()
+    for name in sorted(set(name for name, _ in counters)):
+        lines.append(f'# TYPE dpm_{name}_total counter')
+        for (counter, site), value in sorted(counters.items(), key=str):
+            if counter == name: lines.append(f'dpm_{name}_total{format_labels(site=site)} {value}')
+    return '\n'.join(lines) + '\n'
+
+# write the prometheus text file (atomically, as expected by textfile collectors)
+def export():
+    if settings['jsonl_path'] is not None and _jsonl_file is not None:
+        with _lock:
+            _jsonl_file.flush()
+    if settings['prometheus_path'] is None: return
+    tmp_path = f'{settings["prometheus_path"]}.tmp'
+    with open(tmp_path, 'w') as file:
+        file.write(to_prometheus())
+    os.replace(tmp_path, settings['prometheus_path'])
+
+def print_summary():
+    for (stage, site), (number, total, longest) in sorted(get_spans().items(), key=str):
+        print(f'{stage} ({site or "-"}): {number} calls, {total:.2f} s total, {total / number * 1000:.1f} ms mean, {longest * 1000:.1f} ms max')
+    for (name, site), value in sorted(get_counters().items(), key=str):
+        print(f'{name} ({site or "-"}): {value}')
+
+# profile the enclosed code with cProfile or pyinstrument if enabled
+@contextlib.contextmanager
+def profile(profiler=None):
+    profiler = profiler or settings['profile']
+    if not profiler:
+        yield
+        return
+
+    if profiler == 'cprofile':
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(settings['profile_path'])
+            print(f'Saved profile to {settings["profile_path"]}')
+    elif profiler == 'pyinstrument':
+        from pyinstrument import Profiler
+        profile = Profiler()
+        profile.start()
+        try:
+            yield
+        finally:
+            profile.stop()
+            with open(settings['profile_path'], 'w') as file:
+                file.write(profile.output_html())
+            print(f'Saved profile to {settings["profile_path"]}')
+    else:
+        raise ValueError(f'Unknown profiler: {profiler}')
@@ -0,0 +1,104 @@
+import sys
+import time
+import pandas as pd
+from catalog import open_catalog
+
+################################################################
+## normalization of the raw detail text
+################################################################
+
+# fetch_details only stores the raw text of each detail page (detail_text);
+# the columns below are derived from it for the whole catalog at once, so the
+# parsing rules can be changed and re-applied offline without refetching
+derived_columns = ['material', 'color', 'height', 'width']
+
+# Minghua Ji, e.g. "宋，佚名，绢本，设色，纵24.5厘米，横25.5厘米"
+# the items between the author and the height are the material and the color(s)
+mhj_pattern = (
+    r'^(?:[^，]*，){2}'
+    r'(?:(?P<material>(?!纵)[^，]*)，)?'
+    r'(?P<color>(?:(?!纵)[^，]*，)*?)'
+    r'纵(?P<height>[^，]*)，横(?P<width>[^，]*)'
+)
+
+# Collection and Digital Catalog, e.g. "……，绢本，设色，纵24.5厘米，横25.5厘米。"
+materials = ['绢本', '纸本', '金笺']
+colors = ['设色', '淡设色', '水墨', '墨笔']
+
+# first number of each value as a float, or '' if there is none
+def to_number(values):
+    numbers = values.str.extract(r'([\d\.,]+)', expand=False).str.replace(',', '', regex=False)
+    return pd.to_numeric(numbers, errors='coerce').astype(float).astype(object).where(lambda x: x.notna(), '')
+
+def normalize_mhj(text):
+    text = text.str.strip().str.replace(r'\s*，\s*', '，', regex=True)
+    parts = text.str.extract(mhj_pattern)
+    return pd.DataFrame({
+        'material': parts['material'].fillna('').str.strip(),
+        'color': parts['color'].fillna('').str.rstrip('，'),
+        'height': to_number(parts['height'].fillna('')),
+        'width': to_number(parts['width'].fillna(''))
+    }, index=text.index)
+
+def normalize_collection(text):
+    text = text.str.replace(' ', '', regex=False)
+    return pd.DataFrame({
+        'material': text.str.extract(f'({"|".join(materials)})[，。]', expand=False).fillna(''),
+        'color': text.str.extract(f'[，。]({"|".join(colors)})[，。]', expand=False).fillna(''),
+        'height': to_number(text.str.extract(r'[，。]纵([\d\.,]+)厘米', expand=False).fillna('')),
+        'width': to_number(text.str.extract(r'[，。]横([\d\.,]+)厘米', expand=False).fillna(''))
+    }, index=text.index)
+
+normalizers = {
+    'mhj': normalize_mhj,
+    'collection': normalize_collection,
+    'digicol': normalize_collection,
+}
+
+# derive the detail columns of all rows with a detail text
+# rows without a detail text (e.g. fetched before it was stored) are unchanged
+def normalize_details(df, website):
+    if not website in normalizers:
+        raise ValueError(f'Unknown website: {website}')
+    df = df.copy()
+    for col in derived_columns:
+        if not col in df.columns: df[col] = ''
+    df[derived_columns] = df[derived_columns].astype(object)
+    if not 'detail_text' in df.columns: return df
+
+    text = df['detail_text']
+    has_text = text.notna() & (text.astype(str) != '')
+    if has_text.any():
+        df.loc[has_text, derived_columns] = normalizers[website](text[has_text].astype(str))[derived_columns].values
+    return df
+
+# re-derive the detail columns of paintings.csv
+def normalize_csv(website, csv_file='paintings.csv'):
+    from fetch_paintings import save_csv
+    df = normalize_details(pd.read_csv(csv_file, dtype={'detail_text': str}), website)
+    save_csv(df, csv_file)
+    return df
+
+# re-derive the detail columns of the paintings of a website in the catalog
+def normalize_catalog(website, catalog='paintings.db'):
+    catalog = open_catalog(catalog)
+    df = catalog.to_dataframe(website)
+    df = normalize_details(df[df['detail_text'].notna()], website)
+    catalog.upsert(website, df[['id', *derived_columns]].to_dict('records'))
+    return df
+
+if __name__ == '__main__':
+    # normalize the sqlite catalog instead of paintings.csv
+    catalog = None
+    if '--db' in sys.argv:
+        catalog = sys.argv.pop(sys.argv.index('--db') + 1)
+        sys.argv.remove('--db')
+
+    website = sys.argv[1]
+
+    started_at = time.time()
+    if catalog is not None:
+        df = normalize_catalog(website, catalog)
+    else:
+        df = normalize_csv(website)
+    print(f'Normalized {len(df)} paintings in {time.time() - started_at:.2f} s')
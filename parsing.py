@@ -0,0 +1,35 @@
+import os
+from bs4 import BeautifulSoup, SoupStrainer
+import metrics
+
+################################################################
+## html parsing
+################################################################
+
+# lxml is much faster than the built-in html.parser, which is only used as a fallback
+# the parser can be forced with the environment variable DPM_HTML_PARSER
+def get_default_parser():
+    parser = os.environ.get('DPM_HTML_PARSER')
+    if parser: return parser
+    try:
+        import lxml
+        return 'lxml'
+    except ImportError:
+        return 'html.parser'
+
+parser = get_default_parser()
+
+# parse an html page, optionally keeping only the tags matched by `parse_only`
+def make_soup(html_string, parse_only=None):
+    with metrics.span('parse'):
+        return BeautifulSoup(html_string, parser, parse_only=parse_only)
+
+# strainers restricting parsing to the subtrees needed by each page
+def only_tag(name):
+    return SoupStrainer(name)
+
+def only_class(class_name):
+    return SoupStrainer(attrs={'class': class_name})
+
+def only_id(id):
+    return SoupStrainer(attrs={'id': id})
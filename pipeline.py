@@ -0,0 +1,324 @@
+import argparse
+import os
+import sqlite3
+import sys
+import threading
+import time
+from catalog import Catalog
+from fetch_paintings import fetch_pages, get_page_fetcher, get_detail_fetcher
+from generate_dzi import get_info
+from download_images import prepare_dzi_files, download_dzi_files, set_max_processes, parse_sizes
+from normalize import normalize_catalog
+from identity import IdentityIndex
+import http_client
+import deepzoom
+import metrics
+import manifest
+
+################################################################
+## durable job queue
+################################################################
+
+# stages of the pipeline after listing, in order
+stages = ['detail', 'dzi', 'download']
+
+# jobs of all stages are kept in the catalog database so that a killed process
+# resumes exactly where it stopped
+class JobQueue:
+    def __init__(self, path='paintings.db'):
+        self.path = path
+        self.local = threading.local()
+        connection = self.get_connection()
+        connection.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                stage TEXT NOT NULL,
+                site TEXT NOT NULL,
+                id TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                updated_at REAL,
+                PRIMARY KEY (stage, site, id)
+            )''')
+        connection.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (stage, site, state)')
+        connection.commit()
+
+    # each thread uses its own connection to the database
+    def get_connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self.local.connection = connection
+        return connection
+
+    # add jobs unless they already exist (finished jobs are not repeated)
+    # with `requeue`, finished jobs are made pending again, e.g. for a painting
+    # that was a duplicate and has to be downloaded after all
+    def put(self, stage, site, paint_ids, requeue=False):
+        sql = 'INSERT OR IGNORE INTO jobs (stage, site, id, updated_at) VALUES (?, ?, ?, ?)'
+        if requeue:
+            sql = '''
+                INSERT INTO jobs (stage, site, id, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT (stage, site, id) DO UPDATE SET state = 'pending', error = NULL, updated_at = excluded.updated_at
+                WHERE state = 'done'
+            '''
+        connection = self.get_connection()
+        connection.execute('BEGIN IMMEDIATE')
+        connection.executemany(sql, [(stage, site, str(paint_id), time.time()) for paint_id in paint_ids])
+        connection.execute('COMMIT')
+
+    # take the oldest pending job of a stage, or return None if there is none
+    def claim(self, stage, site):
+        connection = self.get_connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute(
+                "SELECT id FROM jobs WHERE stage = ? AND site = ? AND state = 'pending' ORDER BY rowid LIMIT 1",
+                (stage, site)
+            ).fetchone()
+            if row is not None:
+                connection.execute(
+                    "UPDATE jobs SET state = 'running', attempts = attempts + 1, updated_at = ? WHERE stage = ? AND site = ? AND id = ?",
+                    (time.time(), stage, site, row[0])
+                )
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return None if row is None else row[0]
+
+    def finish(self, stage, site, paint_id, error=None):
+        connection = self.get_connection()
+        connection.execute(
+            'UPDATE jobs SET state = ?, error = ?, updated_at = ? WHERE stage = ? AND site = ? AND id = ?',
+            ('done' if error is None else 'failed', error, time.time(), stage, site, str(paint_id))
+        )
+
+    # number of jobs of a stage that are pending or running
+    def remaining(self, stage, site):
+        return self.get_connection().execute(
+            "SELECT COUNT(*) FROM jobs WHERE stage = ? AND site = ? AND state IN ('pending', 'running')",
+            (stage, site)
+        ).fetchone()[0]
+
+    def counts(self, site):
+        rows = self.get_connection().execute(
+            'SELECT stage, state, COUNT(*) FROM jobs WHERE site = ? GROUP BY stage, state', (site,)
+        )
+        return {(row[0], row[1]): row[2] for row in rows}
+
+    # jobs left running by a killed process are started again
+    def reset_running(self, site):
+        self.get_connection().execute(
+            "UPDATE jobs SET state = 'pending' WHERE site = ? AND state = 'running'", (site,)
+        )
+
+    def reset_failed(self, site):
+        self.get_connection().execute(
+            "UPDATE jobs SET state = 'pending', error = NULL WHERE site = ? AND state = 'failed'", (site,)
+        )
+
+################################################################
+## pipeline
+################################################################
+
+# run list -> detail -> dzi -> download as a streaming pipeline
+# each painting is queued for the next stage as soon as the previous one
+# finishes it, with `workers[stage]` threads working on each stage
+def run_pipeline(website, db='paintings.db', workers=None, list_pages=True, start_page=1, incremental=False,
+                 details=True, max_processes=None, download_largest=True, backend='dezoomify', retry_failed=False, sizes=None, tile_workers=None, dedup=False):
+    workers = {'list': 8, 'detail': 8, 'dzi': 4, 'download': 2, **(workers or {})}
+    catalog = Catalog(db)
+    queue = JobQueue(db)
+    queue.reset_running(website)
+    if retry_failed: queue.reset_failed(website)
+
+    # the detail stage is skipped for websites without details
+    fetch_detail = get_detail_fetcher(website) if details else None
+    first_stage = 'detail' if fetch_detail is not None else 'dzi'
+
+    # paintings already in the catalog continue from the stage matching their status
+    # (finished jobs are repeated, e.g. for duplicates that have been revived)
+    queue.put(first_stage, website, catalog.get_ids(website, status='listed'), requeue=True)
+    queue.put('dzi', website, catalog.get_ids(website, status='enriched'), requeue=True)
+    queue.put('download', website, catalog.get_ids(website, status='dzi-generated'), requeue=True)
+
+    http_client.ensure_pool_size(max(workers.values()))
+    set_max_processes(max_processes or workers['download'])
+    if tile_workers is not None: deepzoom.set_tile_workers(tile_workers)
+    info = get_info(website)
+    index = None
+    if dedup:
+        index = IdentityIndex(db)
+        index.build(catalog)
+
+    # a stage is finished once its upstream stage is finished and its queue is empty
+    finished = {stage: threading.Event() for stage in ['list', *stages]}
+    upstream = {'detail': 'list', 'dzi': 'detail' if first_stage == 'detail' else 'list', 'download': 'dzi'}
+    if first_stage == 'dzi': finished['detail'].set()
+
+    # process one painting at a given stage, returning the next stage or None
+    def detail_job(paint_id):
+        catalog.upsert(website, [{'id': paint_id, **fetch_detail(paint_id)}], status='enriched')
+        return 'dzi'
+
+    def dzi_job(paint_id):
+        dzi_files = prepare_dzi_files(website, paint_id, info=info)
+        if len(dzi_files) == 0:
+            raise ValueError('Failed to generate dzi files')
+        if index is not None:
+            # link the ids found by the detail stage, then skip the painting if
+            # another website has a better copy
+            painting = catalog.get(website, paint_id)
+            index.link(website, paint_id, painting['mhj_id'], painting['inventory_id'])
+            index.record_dzi_files(website, paint_id, dzi_files)
+            best_source = index.get_best_source(website, paint_id, catalog, fetch_missing=True)
+            if best_source != (website, str(paint_id)):
+                catalog.set_status(website, paint_id, 'duplicate', error=f'{best_source[0]}:{best_source[1]}')
+                return None
+        catalog.set_status(website, paint_id, 'dzi-generated')
+        return 'download'
+
+    def download_job(paint_id):
+        download_dzi_files(prepare_dzi_files(website, paint_id, info=info), download_largest=download_largest, backend=backend, sizes=sizes)
+        catalog.set_status(website, paint_id, 'downloaded')
+        return None
+
+    jobs = {'detail': detail_job, 'dzi': dzi_job, 'download': download_job}
+
+    def work(stage):
+        while True:
+            paint_id = queue.claim(stage, website)
+            if paint_id is None:
+                if finished[upstream[stage]].is_set() and queue.remaining(stage, website) == 0:
+                    finished[stage].set()
+                    return
+                time.sleep(0.5)
+                continue
+
+            try:
+                next_stage = jobs[stage](paint_id)
+                if next_stage is not None: queue.put(next_stage, website, [paint_id], requeue=True)
+            except Exception as e:
+                print(f'[{stage}] Failed to process painting {paint_id}: {e}')
+                # the job is finished even if the status cannot be recorded,
+                # otherwise it stays running and the stage never ends
+                try:
+                    catalog.set_status(website, paint_id, 'failed', error=f'{stage}: {e}')
+                    if index is not None:
+                        # revived duplicates of this website start over in this run
+                        revived = catalog.revive_duplicates(website, paint_id)
+                        queue.put(first_stage, website, [id for site, id in revived if site == website], requeue=True)
+                except Exception as status_error:
+                    print(f'[{stage}] Failed to record the failure of painting {paint_id}: {status_error}')
+                queue.finish(stage, website, paint_id, error=str(e))
+                continue
+            queue.finish(stage, website, paint_id)
+
+    # list stage: new paintings are queued page by page as they are fetched
+    list_error = None
+    def list_paintings():
+        nonlocal list_error
+        try:
+            if not list_pages: return
+            known_ids = set(catalog.get_ids(website))
+            def on_page(paintings):
+                catalog.upsert(website, paintings)
+                new_ids = [painting['id'] for painting in paintings if not str(painting['id']) in known_ids]
+                queue.put(first_stage, website, new_ids)
+
+            known_count = 0
+            def reach_known(paintings):
+                nonlocal known_count
+                for painting in paintings:
+                    known_count = known_count + 1 if str(painting['id']) in known_ids else 0
+                return known_count >= 50
+
+            fetch_pages(get_page_fetcher(website), start_page=start_page, workers=workers['list'],
+                        should_stop=reach_known if incremental else None, on_page=on_page)
+        except Exception as e:
+            print(f'[list] Failed to list paintings: {e}')
+            list_error = e
+        finally:
+            finished['list'].set()
+
+    threads = [threading.Thread(target=list_paintings)]
+    for stage in stages:
+        if finished[stage].is_set(): continue
+        threads += [threading.Thread(target=work, args=(stage,)) for _ in range(workers[stage])]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+
+    # derive the detail columns from the detail text fetched by the detail stage
+    if fetch_detail is not None: normalize_catalog(website, catalog)
+
+    metrics.export()
+    counts = queue.counts(website)
+    if list_pages: print(f'list: {"failed" if list_error is not None else "done"}')
+    for stage in stages:
+        print(f'{stage}: {counts.get((stage, "done"), 0)} done, {counts.get((stage, "failed"), 0)} failed')
+
+    # the paintings already queued are processed, but a failed crawl must not
+    # look like a successful run
+    if list_error is not None:
+        raise ValueError(f'Failed to list paintings: {list_error}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the list -> detail -> dzi -> download pipeline.')
+    parser.add_argument('website', choices=['mhj', 'collection', 'digicol'])
+    parser.add_argument('--db', default='paintings.db', help='sqlite catalog and job queue')
+    parser.add_argument('--no-list', action='store_true', help='only process paintings already in the catalog')
+    parser.add_argument('--start-page', type=int, default=1)
+    parser.add_argument('--incremental', action='store_true', help='stop listing at a run of known paintings')
+    parser.add_argument('--no-details', action='store_true', help='skip fetching painting details')
+    parser.add_argument('--list-workers', type=int, default=8)
+    parser.add_argument('--detail-workers', type=int, default=8)
+    parser.add_argument('--dzi-workers', type=int, default=4)
+    parser.add_argument('--download-workers', type=int, default=2)
+    parser.add_argument('--max-processes', type=int, default=None, help='maximum number of dezoomify-rs processes')
+    parser.add_argument('--tile-workers', type=int, default=None, help='threads fetching tiles for the native backend')
+    parser.add_argument('--backend', choices=['dezoomify', 'native'], default='dezoomify')
+    parser.add_argument('--sizes', type=parse_sizes, help='save several sizes of each image, e.g. full,4096,256')
+    parser.add_argument('--dedup', action='store_true', help='skip paintings with a better copy on another website')
+    parser.add_argument('--sharded', action='store_true', help='keep the files of each painting in one of 256 subdirectories')
+    parser.add_argument('--retry-failed', action='store_true', help='retry jobs that failed in a previous run')
+    parser.add_argument('--metrics-jsonl', help='write a json line for every timed span to this file')
+    parser.add_argument('--metrics-prom', help='write prometheus metrics to this file')
+    parser.add_argument('--profile', choices=['cprofile', 'pyinstrument'], help='profile the run')
+    args = parser.parse_args()
+
+    # create directory if not exists
+    if not os.path.exists('paintings'): os.makedirs('paintings')
+    if args.sharded: manifest.configure(sharded=True)
+
+    metrics.configure(
+        jsonl_path=args.metrics_jsonl or metrics.settings['jsonl_path'],
+        prometheus_path=args.metrics_prom or metrics.settings['prometheus_path'],
+        profile=args.profile or metrics.settings['profile']
+    )
+    try:
+        with metrics.profile():
+            run_pipeline(
+                args.website,
+                db=args.db,
+                workers={
+                    'list': args.list_workers,
+                    'detail': args.detail_workers,
+                    'dzi': args.dzi_workers,
+                    'download': args.download_workers
+                },
+                list_pages=not args.no_list,
+                start_page=args.start_page,
+                incremental=args.incremental,
+                details=not args.no_details,
+                max_processes=args.max_processes,
+                backend=args.backend,
+                sizes=args.sizes,
+                tile_workers=args.tile_workers,
+                dedup=args.dedup,
+                retry_failed=args.retry_failed
+            )
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
@@ -0,0 +1,161 @@
+import asyncio
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+################################################################
+## per-host rate limiter
+################################################################
+
+# requests per second allowed for each host (hosts not listed use default_rate)
+# the rate is halved on 429/503 responses (down to min_rate) and recovers
+# gradually while responses are successful
+settings = {
+    'enabled': True,
+    'default_rate': 20.0,
+    'host_rates': {
+        'minghuaji.dpm.org.cn': 5.0,
+        'www.dpm.org.cn': 5.0,
+        'digicol.dpm.org.cn': 3.0,
+    },
+    'burst': 5,
+    'min_rate': 0.2,
+    'recovery': 0.05,
+    'throttle_statuses': (429, 503),
+}
+
+# token bucket of one host
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.configured_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0
+        self.waiting = 0
+        self.requests = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    # take a token if a request may be sent now, otherwise return the time to wait
+    def try_acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if now >= self.blocked_until and self.tokens >= 1:
+                self.tokens -= 1
+                self.requests += 1
+                return 0
+            return max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+
+    # wait until a request may be sent
+    def acquire(self):
+        with self.lock:
+            self.waiting += 1
+        try:
+            while True:
+                delay = self.try_acquire()
+                if delay <= 0: return
+                time.sleep(min(delay, 1))
+        finally:
+            with self.lock:
+                self.waiting -= 1
+
+    # same as acquire() without blocking the event loop
+    async def acquire_async(self):
+        with self.lock:
+            self.waiting += 1
+        try:
+            while True:
+                delay = self.try_acquire()
+                if delay <= 0: return
+                await asyncio.sleep(min(delay, 1))
+        finally:
+            with self.lock:
+                self.waiting -= 1
+
+    # adapt the rate to the response
+    def update(self, status_code, retry_after=None):
+        with self.lock:
+            if status_code in settings['throttle_statuses']:
+                self.throttled += 1
+                self.rate = max(settings['min_rate'], self.rate / 2)
+                self.tokens = 0
+                if retry_after is not None:
+                    self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+            elif self.rate < self.configured_rate:
+                self.rate = min(self.configured_rate, self.rate + self.configured_rate * settings['recovery'])
+
+_buckets = {}
+_lock = threading.Lock()
+
+def configure(**kwargs):
+    for key in kwargs:
+        if not key in settings:
+            raise ValueError(f'Unknown rate limit setting: {key}')
+    with _lock:
+        settings.update(kwargs)
+        _buckets.clear()
+
+def get_host_rate(host):
+    return settings['host_rates'].get(host, settings['default_rate'])
+
+def get_bucket(url):
+    host = urlsplit(url).hostname
+    with _lock:
+        if not host in _buckets:
+            _buckets[host] = TokenBucket(get_host_rate(host), settings['burst'])
+        return _buckets[host]
+
+# minimum interval in seconds between the requests of one of `processes`
+# processes sharing the rate of the host of the url (used for dezoomify-rs)
+def get_min_interval(url, processes=1):
+    return processes / get_bucket(url).rate
+
+# wait until a request to the host of the url may be sent
+def acquire(url):
+    if not settings['enabled']: return
+    get_bucket(url).acquire()
+
+async def acquire_async(url):
+    if not settings['enabled']: return
+    await get_bucket(url).acquire_async()
+
+# report the response of a request to the host of the url
+def update(url, status_code, retry_after=None):
+    if not settings['enabled']: return
+    get_bucket(url).update(status_code, parse_retry_after(retry_after))
+
+# the Retry-After header is either a number of seconds or an http date
+def parse_retry_after(retry_after):
+    if retry_after is None: return None
+    try:
+        return max(0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+# current rate, queue depth and counters of each host
+def get_stats():
+    with _lock:
+        buckets = dict(_buckets)
+    return {
+        host: {
+            'rate': bucket.rate,
+            'configured_rate': bucket.configured_rate,
+            'waiting': bucket.waiting,
+            'requests': bucket.requests,
+            'throttled': bucket.throttled
+        }
+        for host, bucket in buckets.items()
+    }
+
+def print_stats():
+    for host, stats in get_stats().items():
+        print(f'{host}: {stats["rate"]:.2f}/{stats["configured_rate"]:.2f} req/s, {stats["waiting"]} waiting, {stats["requests"]} requests, {stats["throttled"]} throttled')
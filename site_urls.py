@@ -0,0 +1,43 @@
+################################################################
+## urls of the websites
+################################################################
+
+# templates are filled with str.format(), e.g.
+# detail_urls['mhj'].format(paint_id=paint_id)
+
+# page setting the xsrf token needed by the listing (mhj)
+token_urls = {
+    'mhj': 'https://minghuaji.dpm.org.cn/paint/list',
+}
+
+# listing pages, fetched with POST
+list_urls = {
+    'mhj': 'https://minghuaji.dpm.org.cn/paint/queryList?page={page}&showType=0',
+    'collection': 'https://www.dpm.org.cn/searchs/paints/category_id/91/p/{page}.html',
+    'digicol': 'https://digicol.dpm.org.cn/cultural/queryList',
+}
+
+# detail pages of a painting
+detail_urls = {
+    'mhj': 'https://minghuaji.dpm.org.cn/paint/detail?id={paint_id}',
+    'collection': 'https://www.dpm.org.cn/collection/paint/{paint_id}.html',
+    'digicol': 'https://digicol.dpm.org.cn/cultural/detail?id={paint_id}',
+}
+
+# pages listing the images (leaves) of a painting
+paint_urls = {
+    'mhj': 'https://minghuaji.dpm.org.cn/paint/appreciate?id={paint_id}',
+    'collection': 'https://www.dpm.org.cn/collection/paint/{paint_id}.html',
+    'digicol': 'https://digicol.dpm.org.cn/cultural/listCulturalImage?id={paint_id}',
+}
+
+# pages of one image of a painting
+image_urls = {
+    'digicol': 'https://digicol.dpm.org.cn/cultural/details?id={image_id}',
+}
+
+# the scripts holding the key material of each website
+gv_urls = {
+    'mhj': 'https://minghuaji.dpm.org.cn/js/gve.js',
+    'digicol': 'https://digicol.dpm.org.cn/js/gve.js',
+}
@@ -0,0 +1,105 @@
+import hashlib
+import itertools
+import sys
+import pandas as pd
+
+################################################################
+## streaming sources of paintings
+################################################################
+
+# paintings are read in chunks of `chunksize` rows, so a catalog of any size is
+# never loaded at once; each chunk is sharded and filtered before its ids are
+# handed over, and nothing is read ahead of the consumer
+chunksize = 10000
+
+# columns that can be filtered on, with one value or a list of values
+filter_columns = ['site', 'dynasty', 'author']
+
+# chunks of a csv file with an `id` column ('-' reads the csv from stdin)
+def read_csv_chunks(csv_file):
+    if csv_file == '-': csv_file = sys.stdin
+    yield from pd.read_csv(csv_file, dtype=str, chunksize=chunksize)
+
+# chunks of ids, one per line (e.g. stdin)
+def read_id_lines(lines):
+    paint_ids = (line.strip() for line in lines)
+    yield from iter_chunks(paint_id for paint_id in paint_ids if paint_id != '')
+
+# chunks of ids from a file with one id per line ('-' for stdin)
+# the file is closed once it has been read, or when the chunks are dropped
+def read_id_file(ids_file):
+    if ids_file == '-':
+        yield from read_id_lines(sys.stdin)
+        return
+    with open(ids_file, 'r', encoding='utf-8') as file:
+        yield from read_id_lines(file)
+
+# chunks of an iterable of ids, or of dicts with an `id` key
+def iter_chunks(items):
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, chunksize))
+        if len(chunk) == 0: return
+        if isinstance(chunk[0], dict):
+            yield pd.DataFrame(chunk)
+        else:
+            yield pd.DataFrame({'id': chunk})
+
+# chunks of a source: a path to a csv file ('-' for stdin), a list or
+# generator of ids or dicts, or an iterable of dataframes
+def get_chunks(source):
+    if isinstance(source, str): return read_csv_chunks(source)
+    if isinstance(source, pd.DataFrame): return iter([source])
+    items = iter(source)
+    first = next(items, None)
+    if first is None: return iter([])
+    items = itertools.chain([first], items)
+    if isinstance(first, pd.DataFrame): return items
+    return iter_chunks(items)
+
+# shard (0 to shards - 1) of a painting, the same on every machine
+def get_shard(paint_id, shards):
+    return int(hashlib.md5(str(paint_id).encode('utf-8')).hexdigest()[:8], 16) % shards
+
+# parse a shard such as '2/8' (the third of eight shards)
+def parse_shard(text):
+    try:
+        index, count = [int(value) for value in text.split('/')]
+    except ValueError:
+        raise ValueError(f'Invalid shard: {text}')
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f'Invalid shard: {text}')
+    return index, count
+
+# rows of a chunk matching `filters`: column values (see filter_columns) and
+# min_size/max_size, the range of the longer side in centimeters; rows of
+# unknown size do not match a size filter
+def filter_chunk(df, filters):
+    for key, value in filters.items():
+        if value is None: continue
+        if key in filter_columns:
+            if not key in df.columns:
+                raise ValueError(f'Cannot filter on {key}, which is not in the source')
+            values = [value] if isinstance(value, str) else list(value)
+            df = df[df[key].isin(values)]
+        elif key in ['min_size', 'max_size']:
+            if not ('height' in df.columns and 'width' in df.columns):
+                raise ValueError('Cannot filter on the size, which is not in the source')
+            size = pd.concat([pd.to_numeric(df['height'], errors='coerce'), pd.to_numeric(df['width'], errors='coerce')], axis=1).max(axis=1, skipna=False)
+            df = df[size >= value] if key == 'min_size' else df[size <= value]
+        else:
+            raise ValueError(f'Unknown filter: {key}')
+    return df
+
+# ids of the paintings of a source in the given shard (index, count) that
+# match `filters`, read lazily chunk by chunk
+# chunks without a `site` column (e.g. paintings.csv) are taken to be from `site`
+def iter_paint_ids(source, shard=None, filters=None, site=None):
+    for df in get_chunks(source):
+        df = df[df['id'].notna()]
+        if site is not None and not 'site' in df.columns: df = df.assign(site=site)
+        if shard is not None:
+            index, count = shard
+            df = df[df['id'].map(lambda paint_id: get_shard(paint_id, count) == index)]
+        if filters: df = filter_chunk(df, filters)
+        yield from df['id'].astype(str)
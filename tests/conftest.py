@@ -0,0 +1,41 @@
+import os
+import sys
+import pytest
+
+# the modules are run as scripts from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import http_client
+import manifest
+import metadata_cache
+import rate_limit
+import tile_cache
+from benchmarks.mock_server import MockSite
+
+# an empty working directory, with the caches and the manifest inside it
+# local servers are not rate limited
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(rate_limit.settings, 'enabled', False)
+    monkeypatch.setitem(metadata_cache.settings, 'path', str(tmp_path / 'cache' / 'metadata.db'))
+    monkeypatch.setitem(manifest.settings, 'path', str(tmp_path / 'paintings' / 'manifest.db'))
+    tile_cache.configure(cache_dir=str(tmp_path / 'cache' / 'tiles'))
+    yield tmp_path
+    tile_cache.configure(cache_dir=os.path.join('cache', 'tiles'))
+
+# start mock websites (see benchmarks/mock_server.py) in an empty working
+# directory, with the network calls sent to the last one started
+@pytest.fixture
+def mock_site(workdir):
+    sites = []
+
+    def start(site_class=MockSite, **kwargs):
+        site = site_class(**kwargs)
+        site.start()
+        sites.append(site)
+        http_client.configure(url_map=site.url_map())
+        return site
+
+    yield start
+    for site in sites: site.stop()
+    http_client.configure(url_map={})
@@ -0,0 +1,151 @@
+import io
+import math
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from PIL import Image, ImageChops
+import deepzoom
+import tile_cache
+
+################################################################
+## synthetic tile pyramid
+################################################################
+
+# a deep zoom pyramid cut from a random image, with lossless png tiles
+class TilePyramid:
+    def __init__(self, width, height, tilesize, overlap, seed=0):
+        self.width = width
+        self.height = height
+        self.tilesize = tilesize
+        self.overlap = overlap
+        generator = random.Random(seed)
+        self.image = Image.frombytes('RGB', (width, height), bytes(generator.getrandbits(8) for _ in range(width * height * 3)))
+        self.tiles = {}
+        self.corrupt = set()
+        self.requests = 0
+        max_level = math.ceil(math.log2(max(width, height)))
+        for level in range(max_level + 1):
+            level_image = self.get_level_image(level)
+            cols, rows = math.ceil(level_image.width / tilesize), math.ceil(level_image.height / tilesize)
+            for col in range(cols):
+                for row in range(rows):
+                    x0, y0 = max(0, col * tilesize - overlap), max(0, row * tilesize - overlap)
+                    x1 = min(level_image.width, (col + 1) * tilesize + overlap)
+                    y1 = min(level_image.height, (row + 1) * tilesize + overlap)
+                    buffer = io.BytesIO()
+                    level_image.crop((x0, y0, x1, y1)).save(buffer, format='PNG')
+                    self.tiles[f'/tiles/{level}/{col}_{row}.png'] = buffer.getvalue()
+
+    def get_level_image(self, level):
+        scale = 2 ** (math.ceil(math.log2(max(self.width, self.height))) - level)
+        size = (math.ceil(self.width / scale), math.ceil(self.height / scale))
+        return self.image if size == self.image.size else self.image.resize(size)
+
+    def start(self):
+        pyramid = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                pyramid.requests += 1
+                body = pyramid.tiles.get(self.path)
+                if self.path in pyramid.corrupt:
+                    # a broken tile is only served once
+                    pyramid.corrupt.discard(self.path)
+                    body = b'not an image'
+                self.send_response(200 if body is not None else 404)
+                self.send_header('Content-Length', str(len(body or b'')))
+                self.end_headers()
+                if body is not None: self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def write_dzi_file(self, dzi_file):
+        with open(dzi_file, 'w', encoding='utf-8') as file:
+            file.write(
+                f'<?xml version="1.0" encoding="UTF-8"?>'
+                f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Url="http://127.0.0.1:{self.server.server_port}/tiles/" '
+                f'Format="png" Overlap="{self.overlap}" TileSize="{self.tilesize}">'
+                f'<Size Width="{self.width}" Height="{self.height}"/></Image>'
+            )
+
+@pytest.fixture(params=[0, 1, 2], ids=['overlap0', 'overlap1', 'overlap2'])
+def pyramid(request, workdir):
+    # sizes that are not multiples of the tile size, with a partial last row and column
+    pyramid = TilePyramid(333, 251, 64, request.param)
+    pyramid.start()
+    pyramid.write_dzi_file('painting.dzi')
+    yield pyramid
+    pyramid.stop()
+
+def assert_same_pixels(path, expected):
+    with Image.open(path) as image:
+        assert image.size == expected.size
+        assert ImageChops.difference(image.convert('RGB'), expected).getbbox() is None
+
+################################################################
+## stitching
+################################################################
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_download_dzi(pyramid, streaming):
+    paint_file = 'painting.tif' if streaming else 'painting.png'
+    deepzoom.download_dzi('painting.dzi', paint_file, workers=4, streaming=streaming)
+    assert_same_pixels(paint_file, pyramid.image)
+
+def test_download_lower_level(pyramid):
+    deepzoom.download_dzi('painting.dzi', 'painting.png', level=7, workers=4)
+    assert_same_pixels('painting.png', pyramid.get_level_image(7))
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_tile_queue(pyramid, streaming):
+    paint_file = 'painting.tif' if streaming else 'painting.png'
+    tile_queue = deepzoom.TileQueue(workers=4)
+    try:
+        jobs = [tile_queue.submit('painting.dzi', paint_file, streaming=streaming), tile_queue.submit('painting.dzi', 'small.png', level=6)]
+        for job in jobs: job.wait()
+    finally:
+        tile_queue.close()
+    assert_same_pixels(paint_file, pyramid.image)
+    assert_same_pixels('small.png', pyramid.get_level_image(6))
+
+def test_tiff_writer(workdir):
+    image = TilePyramid(150, 70, 32, 0).image
+    writer = deepzoom.TiffWriter('image.tif', image.width, image.height, 32)
+    for y in range(0, image.height, 32):
+        writer.write_strip(image.crop((0, y, image.width, min(image.height, y + 32))).tobytes())
+    writer.close()
+    assert_same_pixels('image.tif', image)
+
+################################################################
+## tile cache
+################################################################
+
+def test_tiles_are_cached(pyramid):
+    deepzoom.download_dzi('painting.dzi', 'first.png', workers=4)
+    requests = pyramid.requests
+    deepzoom.download_dzi('painting.dzi', 'second.png', workers=4)
+    assert pyramid.requests == requests
+    assert_same_pixels('second.png', pyramid.image)
+
+def test_undecodable_tile_is_evicted(pyramid):
+    dzi = deepzoom.read_dzi_file('painting.dzi')
+    level = deepzoom.get_max_level(dzi)
+    pyramid.corrupt.add(f'/tiles/{level}/1_1.png')
+    tile_queue = deepzoom.TileQueue(workers=4)
+    try:
+        with pytest.raises(Exception):
+            tile_queue.submit('painting.dzi', 'painting.png').wait()
+        assert tile_cache.get(dzi['url'], level, 1, 1) is None
+        # the next attempt downloads the tile again
+        tile_queue.submit('painting.dzi', 'painting.png').wait()
+    finally:
+        tile_queue.close()
+    assert_same_pixels('painting.png', pyramid.image)
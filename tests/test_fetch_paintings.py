@@ -0,0 +1,30 @@
+import pandas as pd
+from benchmarks.mock_server import MockSite
+import fetch_paintings
+
+################################################################
+## crawls saved to paintings.csv
+################################################################
+
+# collection ids are numbers
+class NumericSite(MockSite):
+    def paint_ids(self):
+        return [str(100000 + idx) for idx in range(1, self.paintings + 1)]
+
+def test_recrawl_does_not_duplicate_rows(mock_site):
+    site = mock_site(NumericSite, paintings=45)
+    assert fetch_paintings.fetch_all('collection', workers=2)['added'] == site.paint_ids()
+    assert fetch_paintings.fetch_all('collection', workers=2, incremental=True, known_run=10)['added'] == []
+    assert fetch_paintings.fetch_all('collection', workers=2)['added'] == []
+
+    df = pd.read_csv('paintings.csv', dtype={'id': str})
+    assert df['id'].tolist() == site.paint_ids()
+
+def test_recrawl_appends_new_paintings(mock_site):
+    mock_site(NumericSite, paintings=20)
+    fetch_paintings.fetch_all('collection', workers=2)
+    site = mock_site(NumericSite, paintings=25)
+    assert fetch_paintings.fetch_all('collection', workers=2)['added'] == site.paint_ids()[20:]
+
+    df = pd.read_csv('paintings.csv', dtype={'id': str})
+    assert sorted(df['id']) == site.paint_ids()
@@ -0,0 +1,110 @@
+import pytest
+from catalog import Catalog
+from identity import IdentityIndex
+from pipeline import JobQueue
+
+################################################################
+## identity index
+################################################################
+
+@pytest.fixture
+def catalog(tmp_path):
+    catalog = Catalog(str(tmp_path / 'paintings.db'))
+    yield catalog
+    catalog.close()
+
+@pytest.fixture
+def index(catalog):
+    index = IdentityIndex(catalog.path)
+    yield index
+    index.close()
+
+def test_link_by_mhj_id_and_inventory_id(index):
+    index.link('collection', 'c1', mhj_id='m1', inventory_id='故 00006433')
+    index.link('digicol', 'd1', inventory_id='故00006433')
+    index.link('mhj', 'm1')
+    index.link('collection', 'c2', mhj_id='m2')
+
+    assert index.get_members('digicol', 'd1') == [('collection', 'c1'), ('digicol', 'd1'), ('mhj', 'm1')]
+    assert index.get_members('mhj', 'm2') == [('collection', 'c2'), ('mhj', 'm2')]
+    # a painting that was never linked only has itself
+    assert index.get_members('digicol', 'd9') == [('digicol', 'd9')]
+
+def test_link_merges_identities(index):
+    index.link('collection', 'c1', mhj_id='m1')
+    index.link('digicol', 'd1', inventory_id='新00140541')
+    # linked to both groups at once
+    index.link_many([('collection', 'c2', 'm1', '新 00140541')])
+
+    members = [('collection', 'c1'), ('collection', 'c2'), ('digicol', 'd1'), ('mhj', 'm1')]
+    for site, paint_id in members:
+        assert index.get_members(site, paint_id) == members
+
+def test_build_from_catalog(catalog, index):
+    catalog.upsert('collection', [{'id': 'c1', 'mhj_id': 'm1', 'inventory_id': '故00006433'}])
+    catalog.upsert('digicol', [{'id': 'd1', 'inventory_id': '故00006433'}])
+    catalog.upsert('mhj', [{'id': 'm1'}])
+    index.build(catalog)
+    assert index.get_members('mhj', 'm1') == [('collection', 'c1'), ('digicol', 'd1'), ('mhj', 'm1')]
+
+# three copies of one painting, listed in the catalog with their resolution
+def add_copies(catalog, index, copies):
+    for site, paint_id, pixels, status in copies:
+        catalog.upsert(site, [{'id': paint_id}], status=status)
+        index.link(site, paint_id, inventory_id='故00006433')
+        if pixels is not None: index.set_resolution(site, paint_id, pixels, 1, pixels)
+
+def test_best_source_prefers_the_most_pixels(catalog, index):
+    add_copies(catalog, index, [('mhj', 'm1', 100, 'listed'), ('collection', 'c1', 300, 'listed'), ('digicol', 'd1', 200, 'listed')])
+    for site, paint_id in [('mhj', 'm1'), ('collection', 'c1'), ('digicol', 'd1')]:
+        assert index.get_best_source(site, paint_id, catalog) == ('collection', 'c1')
+
+def test_best_source_ties_break_by_site(catalog, index):
+    add_copies(catalog, index, [('digicol', 'd1', 100, 'listed'), ('collection', 'c1', 100, 'listed'), ('mhj', 'm1', 100, 'listed')])
+    assert index.get_best_source('digicol', 'd1', catalog) == ('mhj', 'm1')
+
+def test_best_source_prefers_a_downloaded_copy_of_equal_resolution(catalog, index):
+    add_copies(catalog, index, [('mhj', 'm1', 100, 'listed'), ('digicol', 'd1', 100, 'downloaded')])
+    assert index.get_best_source('mhj', 'm1', catalog) == ('digicol', 'd1')
+    # but not over a copy with more pixels
+    index.set_resolution('mhj', 'm1', 200, 1, 200)
+    assert index.get_best_source('mhj', 'm1', catalog) == ('mhj', 'm1')
+
+def test_best_source_skips_failed_and_duplicate_copies(catalog, index):
+    add_copies(catalog, index, [('mhj', 'm1', 300, 'failed'), ('collection', 'c1', 200, 'duplicate'), ('digicol', 'd1', 100, 'listed')])
+    assert index.get_best_source('digicol', 'd1', catalog) == ('digicol', 'd1')
+
+def test_best_source_skips_copies_outside_the_catalog(catalog, index):
+    add_copies(catalog, index, [('digicol', 'd1', 100, 'listed')])
+    index.link('mhj', 'm1', inventory_id='故00006433')
+    index.set_resolution('mhj', 'm1', 300, 1, 300)
+    assert index.get_best_source('digicol', 'd1', catalog) == ('digicol', 'd1')
+
+def test_unknown_resolutions_are_not_fetched_by_default(catalog, index):
+    add_copies(catalog, index, [('mhj', 'm1', None, 'listed'), ('digicol', 'd1', 100, 'listed')])
+    assert index.get_resolution('mhj', 'm1') is None
+    assert index.get_best_source('digicol', 'd1', catalog) == ('digicol', 'd1')
+    assert index.get_resolution('mhj', 'm1') is None
+
+def test_failed_source_revives_its_duplicates(catalog):
+    catalog.upsert('digicol', [{'id': 'd1'}])
+    catalog.set_status('digicol', 'd1', 'duplicate', error='mhj:m1')
+    assert catalog.revive_duplicates('mhj', 'm1') == [('digicol', 'd1')]
+    assert catalog.get('digicol', 'd1')['status'] == 'listed'
+
+def test_revived_duplicate_is_queued_again(catalog):
+    queue = JobQueue(catalog.path)
+    queue.put('dzi', 'digicol', ['d1'])
+    assert queue.claim('dzi', 'digicol') == 'd1'
+    queue.finish('dzi', 'digicol', 'd1')
+    # finished jobs are not repeated, unless requeued
+    queue.put('dzi', 'digicol', ['d1'])
+    assert queue.remaining('dzi', 'digicol') == 0
+    queue.put('dzi', 'digicol', ['d1'], requeue=True)
+    assert queue.claim('dzi', 'digicol') == 'd1'
+    # running and failed jobs are left as they are
+    queue.put('dzi', 'digicol', ['d1'], requeue=True)
+    assert queue.claim('dzi', 'digicol') is None
+    queue.finish('dzi', 'digicol', 'd1', error='failed')
+    queue.put('dzi', 'digicol', ['d1'], requeue=True)
+    assert queue.remaining('dzi', 'digicol') == 0
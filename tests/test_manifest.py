@@ -0,0 +1,57 @@
+import os
+from PIL import Image
+import manifest
+from deepzoom import TiffWriter
+
+################################################################
+## complete images
+################################################################
+
+def truncate(path, size):
+    with open(path, 'r+b') as file:
+        file.truncate(size)
+
+def write_tiff(path, width, height, strips):
+    writer = TiffWriter(path, width, height, 1)
+    for _ in range(strips): writer.write_strip(b'\x80' * width * 3)
+    writer.close()
+
+def test_jpeg_and_png(tmp_path):
+    for extension in ['jpg', 'png']:
+        path = str(tmp_path / f'image.{extension}')
+        Image.new('RGB', (300, 200), 'red').save(path)
+        assert manifest.is_complete_image(path)
+        truncate(path, os.path.getsize(path) // 2)
+        assert not manifest.is_complete_image(path)
+
+def test_tiff(tmp_path):
+    path = str(tmp_path / 'image.tif')
+    write_tiff(path, 30, 20, 20)
+    with Image.open(path) as image:
+        assert image.size == (30, 20)
+    assert manifest.is_complete_image(path)
+    # cut within the ifd, and within the strips
+    truncate(path, os.path.getsize(path) - 10)
+    assert not manifest.is_complete_image(path)
+    truncate(path, 30 * 3 * 10)
+    assert not manifest.is_complete_image(path)
+
+def test_unfinished_tiff(tmp_path):
+    # the header only points to the ifd once the writer is closed
+    path = str(tmp_path / 'image.tif')
+    writer = TiffWriter(path, 30, 20, 1)
+    for _ in range(20): writer.write_strip(b'\x80' * 90)
+    writer.file.close()
+    assert not manifest.is_complete_image(path)
+
+def test_large_images_are_not_decoded(tmp_path):
+    # a bigtiff header, above the decompression bomb limit of pillow
+    path = str(tmp_path / 'image.tif')
+    write_tiff(path, 100, 20000000, 3)
+    assert manifest.is_complete_image(path)
+    # only the headers of other formats are read
+    path = str(tmp_path / 'image.bmp')
+    Image.new('RGB', (30, 20)).save(path)
+    assert manifest.is_complete_image(path)
+    truncate(path, 10)
+    assert not manifest.is_complete_image(path)
@@ -0,0 +1,88 @@
+import os
+import pytest
+from bs4 import BeautifulSoup
+import fetch_paintings
+import generate_dzi
+import parsing
+
+################################################################
+## parity of the fast parsing path with the html.parser baseline
+################################################################
+
+fixtures_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+def read_fixture(name):
+    with open(os.path.join(fixtures_dir, name), 'r', encoding='utf-8') as file:
+        return file.read()
+
+# parse the whole page with html.parser, as before lxml and the strainers
+def make_baseline_soup(html_string, parse_only=None):
+    return BeautifulSoup(html_string, 'html.parser')
+
+# run a parser with the fast path and with the baseline
+def parse_both(monkeypatch, module, parse, *args):
+    fast = parse(*args)
+    with monkeypatch.context() as patch:
+        patch.setattr(module, 'make_soup', make_baseline_soup)
+        baseline = parse(*args)
+    return fast, baseline
+
+def test_default_parser_is_lxml():
+    if os.environ.get('DPM_HTML_PARSER'): pytest.skip('parser forced by DPM_HTML_PARSER')
+    assert parsing.parser == 'lxml'
+
+def test_parse_page_mhj(monkeypatch):
+    fast, baseline = parse_both(monkeypatch, fetch_paintings, fetch_paintings.parse_page_mhj, read_fixture('mhj_list.html'))
+    assert fast == baseline
+    assert [painting['id'] for painting in fast] == [
+        '0196af7228c14f098185c9bdbd19b6e7', '2c558301d5ff4dbf8e19ad07ed36adfe', '5f6895a548884d4e889ed9b791bc3bd7'
+    ]
+    assert fast[2] == {'id': '5f6895a548884d4e889ed9b791bc3bd7', 'name': '周官观灯倡咏图卷 & 跋', 'author': '戴进', 'dynasty': '明'}
+
+def test_parse_detail_mhj(monkeypatch):
+    fast, baseline = parse_both(monkeypatch, fetch_paintings, fetch_paintings.parse_detail_mhj, 'id', read_fixture('mhj_detail.html'))
+    assert fast == baseline
+    assert fast == {'detail_text': '宋，李公麟，绢本，设色，纵46.2厘米，横429.8厘米'}
+
+def test_parse_page_collection(monkeypatch):
+    fast, baseline = parse_both(monkeypatch, fetch_paintings, fetch_paintings.parse_page_collection, read_fixture('collection_list.html'))
+    assert fast == baseline
+    assert [painting['id'] for painting in fast] == ['228208', '228337', '231234']
+    assert fast[0] == {'id': '228208', 'name': '清 郎世宁 弘历雪景行乐图轴', 'author': '郎世宁', 'dynasty': '清', 'category': '绘画'}
+    assert fast[2]['name'] == '宋 佚名 <无款> 山水图页'
+
+def test_parse_detail_collection(monkeypatch):
+    fast, baseline = parse_both(monkeypatch, fetch_paintings, fetch_paintings.parse_detail_collection, 'id', read_fixture('collection_detail.html'))
+    assert fast == baseline
+    assert fast['mhj_id'] == '7b9c1e0fbd0a4cc5a9c4b8e35f3f7a29'
+    assert fast['inventory_id'] == '故00006433'
+    assert fast['detail_text'].startswith('《弘历雪景行乐图》轴，清，郎世宁等绘，绢本，设色，纵289.5厘米，横196.7厘米。')
+
+def test_parse_page_digicol():
+    # the listing is json, parsed without beautifulsoup
+    paintings = fetch_paintings.parse_page_digicol(read_fixture('digicol_list.json'))
+    assert paintings == [
+        {'id': '8a1d4b2f6c0e4f1d9e3a5b7c9d1e3f50', 'name': '弘历雪景行乐图轴', 'author': '郎世宁', 'dynasty': '清', 'inventory_id': '故00006433'},
+        {'id': '1f2e3d4c5b6a79881726354453627180', 'name': '秀石疏林图卷', 'author': '', 'dynasty': '元', 'inventory_id': '新00140541'},
+    ]
+
+def test_parse_detail_digicol(monkeypatch):
+    fast, baseline = parse_both(monkeypatch, fetch_paintings, fetch_paintings.parse_detail_digicol, 'id', read_fixture('digicol_detail.html'))
+    assert fast == baseline
+    assert fast == {'detail_text': '故00006433，绘画，清，绢本，设色，纵289.5厘米，横196.7厘米。'}
+
+def test_get_leaf_urls_mhj(monkeypatch):
+    paint_url = 'https://minghuaji.dpm.org.cn/paint/appreciate?id=0196af7228c14f098185c9bdbd19b6e7'
+    fast, baseline = parse_both(monkeypatch, generate_dzi, generate_dzi.get_leaf_urls_mhj, paint_url, read_fixture('mhj_appreciate.html'))
+    assert fast == baseline
+    assert fast == [f'{paint_url}&type={leaf}' for leaf in ['1', '2', '3']]
+
+def test_get_tilegenerator_urls(monkeypatch):
+    fast, baseline = parse_both(monkeypatch, generate_dzi, generate_dzi.get_tilegenerator_urls, read_fixture('collection_detail.html'))
+    assert fast == baseline
+    assert fast == ['http://en.dpm.org.cn/tiles/paint/228208.xml']
+
+def test_get_image_urls_digicol(monkeypatch):
+    fast, baseline = parse_both(monkeypatch, generate_dzi, generate_dzi.get_image_urls_digicol, read_fixture('digicol_images.html'))
+    assert fast == baseline
+    assert fast == [f'https://digicol.dpm.org.cn/cultural/details?id={image_id}' for image_id in ['a1b2c3d4e5f6', 'b2c3d4e5f6a1']]
@@ -0,0 +1,80 @@
+import gc
+import pandas as pd
+import pytest
+import sources
+
+################################################################
+## streaming sources
+################################################################
+
+def test_site_filter_on_source_without_site_column():
+    df = pd.DataFrame({'id': ['a', 'b'], 'dynasty': ['宋', '明']})
+    assert list(sources.iter_paint_ids(df, filters={'site': 'mhj'}, site='mhj')) == ['a', 'b']
+    assert list(sources.iter_paint_ids(df, filters={'site': 'digicol', 'dynasty': '宋'}, site='mhj')) == []
+    # without the website the filter cannot be applied
+    with pytest.raises(ValueError):
+        list(sources.iter_paint_ids(df, filters={'site': 'mhj'}))
+
+def test_site_column_of_source_is_kept():
+    df = pd.DataFrame({'id': ['a', 'b'], 'site': ['mhj', 'digicol']})
+    assert list(sources.iter_paint_ids(df, filters={'site': 'digicol'}, site='mhj')) == ['b']
+
+def test_id_file_is_closed(tmp_path, monkeypatch):
+    ids_file = tmp_path / 'ids.txt'
+    ids_file.write_text('a\n\nb\n', encoding='utf-8')
+    opened = []
+    real_open = open
+    def tracking_open(*args, **kwargs):
+        file = real_open(*args, **kwargs)
+        opened.append(file)
+        return file
+    monkeypatch.setattr('builtins.open', tracking_open)
+
+    # closed once read
+    assert list(sources.iter_paint_ids(sources.read_id_file(str(ids_file)))) == ['a', 'b']
+    assert opened[0].closed
+
+    # closed when the chunks are dropped before the end
+    chunks = sources.read_id_file(str(ids_file))
+    next(chunks)
+    del chunks
+    gc.collect()
+    assert opened[1].closed
+
+################################################################
+## shards and size filters
+################################################################
+
+def test_shards_partition_the_ids():
+    paint_ids = [f'{idx:032x}' for idx in range(1000)] + [str(idx) for idx in range(1000)]
+    shards = [list(sources.iter_paint_ids(paint_ids, shard=(index, 7))) for index in range(7)]
+    assert sorted(paint_id for shard in shards for paint_id in shard) == sorted(paint_ids)
+    assert all(len(shard) > 0 for shard in shards)
+    # the shard of a painting only depends on its id
+    assert all(sources.get_shard(paint_id, 7) == index for index, shard in enumerate(shards) for paint_id in shard)
+
+def test_shards_are_read_in_chunks(monkeypatch):
+    monkeypatch.setattr(sources, 'chunksize', 10)
+    paint_ids = [str(idx) for idx in range(95)]
+    shards = [list(sources.iter_paint_ids(iter(paint_ids), shard=(index, 3))) for index in range(3)]
+    assert sorted(paint_id for shard in shards for paint_id in shard) == sorted(paint_ids)
+
+def test_parse_shard():
+    assert sources.parse_shard('0/1') == (0, 1)
+    assert sources.parse_shard('3/4') == (3, 4)
+    for text in ['4/4', '-1/2', '1/0', '1', 'a/b', '1/2/3']:
+        with pytest.raises(ValueError):
+            sources.parse_shard(text)
+
+def test_size_filters():
+    df = pd.DataFrame({
+        'id': ['a', 'b', 'c', 'd', 'e'],
+        'height': ['120.5', '80', None, '', '50'],
+        'width': ['40', '90', '60', '70', None],
+    })
+    # the longer side is compared; rows of unknown size are dropped
+    assert list(sources.iter_paint_ids(df, filters={'min_size': 100})) == ['a']
+    assert list(sources.iter_paint_ids(df, filters={'max_size': 100})) == ['b']
+    assert list(sources.iter_paint_ids(df, filters={'min_size': 85, 'max_size': 100})) == ['b']
+    with pytest.raises(ValueError):
+        list(sources.iter_paint_ids(pd.DataFrame({'id': ['a']}), filters={'min_size': 100}))
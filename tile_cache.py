@@ -0,0 +1,135 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+################################################################
+## persistent tile cache
+################################################################
+
+# tiles are stored under cache_dir by the hash of (dzi url, level, column, row)
+# and the least recently used tiles are evicted once the cache exceeds max_size bytes
+settings = {
+    'enabled': True,
+    'cache_dir': os.environ.get('DPM_TILE_CACHE', os.path.join('cache', 'tiles')),
+    'max_size': 20 * 1024 ** 3,
+    # tile cache of dezoomify-rs, kept outside cache_dir since its size is not
+    # tracked by the index below
+    'dezoomify_dir': os.environ.get('DPM_DEZOOMIFY_CACHE', os.path.join('cache', 'dezoomify')),
+}
+
+_lock = threading.Lock()
+# cached tiles (path -> size) from least to most recently used, and their
+# total size; read from the cache directory once, on first use
+_index = None
+_size = 0
+
+def configure(**kwargs):
+    global _index
+    for key in kwargs:
+        if not key in settings:
+            raise ValueError(f'Unknown tile cache setting: {key}')
+    with _lock:
+        settings.update(kwargs)
+        _index = None
+
+def get_tile_path(dzi_url, level, col, row):
+    key = hashlib.sha256(f'{dzi_url}|{level}|{col}|{row}'.encode('utf-8')).hexdigest()
+    return os.path.join(settings['cache_dir'], key[:2], key)
+
+# the lru index, seeded from the cache directory if needed (call with _lock held)
+def get_index():
+    global _index, _size
+    if _index is None:
+        _index = OrderedDict((tile_path, size) for tile_path, size, _ in sorted(list_tiles(), key=lambda tile: tile[2]))
+        _size = sum(_index.values())
+    return _index
+
+# return the cached tile, or None if it has not been downloaded yet
+def get(dzi_url, level, col, row):
+    global _size
+    if not settings['enabled']: return None
+    tile_path = get_tile_path(dzi_url, level, col, row)
+    try:
+        with open(tile_path, 'rb') as file:
+            data = file.read()
+    except FileNotFoundError:
+        return None
+    # mark the tile as recently used, also on disk for the next run
+    with _lock:
+        index = get_index()
+        if tile_path in index:
+            index.move_to_end(tile_path)
+        else:
+            index[tile_path] = len(data)
+            _size += len(data)
+    try:
+        os.utime(tile_path)
+    except OSError:
+        pass
+    return data
+
+def put(dzi_url, level, col, row, data):
+    global _size
+    if not settings['enabled']: return
+    tile_path = get_tile_path(dzi_url, level, col, row)
+    os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+    # write to a temporary file first so that readers never see a partial tile
+    tmp_path = f'{tile_path}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(data)
+    os.replace(tmp_path, tile_path)
+
+    with _lock:
+        index = get_index()
+        _size += len(data) - index.pop(tile_path, 0)
+        index[tile_path] = len(data)
+        evicted = evict(settings['max_size'] * 0.9) if _size > settings['max_size'] else []
+    remove_tiles(evicted)
+
+# remove a tile from the cache, e.g. one that cannot be decoded
+def delete(dzi_url, level, col, row):
+    global _size
+    tile_path = get_tile_path(dzi_url, level, col, row)
+    with _lock:
+        if _index is not None and tile_path in _index: _size -= _index.pop(tile_path)
+    remove_tiles([tile_path])
+
+# list all cached tiles as (path, size, last used time)
+def list_tiles():
+    tiles = []
+    for root, dirs, files in os.walk(settings['cache_dir']):
+        for name in files:
+            if name.endswith('.tmp'): continue
+            try:
+                stat = os.stat(os.path.join(root, name))
+            except FileNotFoundError:
+                continue
+            tiles.append((os.path.join(root, name), stat.st_size, stat.st_mtime))
+    return tiles
+
+def get_cache_size():
+    with _lock:
+        get_index()
+        return _size
+
+# drop the least recently used tiles from the index until the cache is not
+# larger than target_size (call with _lock held)
+# returns the paths of the dropped tiles, which are removed by remove_tiles()
+# outside the lock
+def evict(target_size):
+    global _size
+    index = get_index()
+    evicted = []
+    while _size > target_size and len(index) > 0:
+        tile_path, tile_size = index.popitem(last=False)
+        _size -= tile_size
+        evicted.append(tile_path)
+    return evicted
+
+def remove_tiles(tile_paths):
+    for tile_path in tile_paths:
+        try:
+            os.remove(tile_path)
+        except FileNotFoundError:
+            pass